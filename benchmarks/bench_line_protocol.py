@@ -0,0 +1,67 @@
+"""
+Benchmark of serializing a 100k-metric batch from an MQTTMetricsNode buffer to
+InfluxDB line protocol, comparing per-metric formatting with
+LineProtocolSerializer.
+
+Usage:
+    python benchmarks/bench_line_protocol.py
+"""
+
+import random
+import timeit
+
+from mqtt_node_network.line_protocol import LineProtocolSerializer, format_metric
+from mqtt_node_network.metrics_node import MetricRecord, TopicStructure
+
+NUM_METRICS = 100_000
+NUMBER = 3
+
+
+def make_batch(datatype):
+    # 50 machines with 20 sensors each, as parsed from their topics
+    random.seed(0)
+    structure = TopicStructure("machine/module/measurement/field*")
+    metrics = []
+    for i in range(NUM_METRICS):
+        topic = f"line{i % 50}/sensorbox/temperature/sensor {i % 20}"
+        parsed, tags = structure.parse_with_tags(topic)
+        fields = {parsed["field"]: round(random.uniform(15, 30), 3)}
+        metric_time = 1700000000 + i / 1000
+        if datatype is MetricRecord:
+            metrics.append(
+                MetricRecord(parsed["measurement"], fields, metric_time, tags)
+            )
+        else:
+            metrics.append(
+                {
+                    "measurement": parsed["measurement"],
+                    "fields": fields,
+                    "time": metric_time,
+                    "tags": dict(tags),
+                }
+            )
+    return metrics
+
+
+def naive(metrics):
+    return "".join(format_metric(metric) + "\n" for metric in metrics).encode()
+
+
+if __name__ == "__main__":
+    print(f"Serializing {NUM_METRICS} metrics to line protocol")
+    for datatype in (dict, MetricRecord):
+        metrics = make_batch(datatype)
+        serializer = LineProtocolSerializer()
+        assert serializer.serialize(metrics) == naive(metrics)
+        for name, serialize in (
+            ("per-metric", naive),
+            ("LineProtocolSerializer", serializer.serialize),
+        ):
+            seconds = min(
+                timeit.repeat(lambda: serialize(metrics), number=NUMBER, repeat=3)
+            )
+            print(
+                f"{datatype.__name__:<14}{name:<24}"
+                f"{seconds / NUMBER * 1e3:>10.1f} ms"
+                f"{NUM_METRICS * NUMBER / seconds:>14,.0f} metrics/s"
+            )
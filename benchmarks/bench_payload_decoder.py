@@ -0,0 +1,54 @@
+"""
+Micro-benchmark comparing PayloadDecoder against the original payload handling
+in MQTTMetricsNode.on_message: decode to a string, then attempt json.loads.
+
+Usage:
+    python benchmarks/bench_payload_decoder.py
+"""
+
+import json
+import timeit
+
+from mqtt_node_network.decoders import PayloadDecoder
+
+NUMBER = 200_000
+
+PAYLOADS = {
+    "float": b"22.5",
+    "int": b"42",
+    "string": b"online",
+    "json": b'{"value": 22.5}',
+}
+
+
+def legacy_decode(topic, payload):
+    data = payload.decode()
+    data = payload.decode()
+    try:
+        return json.loads(data)
+    except json.JSONDecodeError:
+        return data
+
+
+def bench(decode, payload):
+    return min(
+        timeit.repeat(
+            lambda: decode("machine/module/measurement/field", payload),
+            number=NUMBER,
+            repeat=3,
+        )
+    )
+
+
+if __name__ == "__main__":
+    decoders = {
+        "legacy": legacy_decode,
+        "PayloadDecoder(json)": PayloadDecoder(json_backend="json").decode,
+        "PayloadDecoder(auto)": PayloadDecoder(json_backend="auto").decode,
+    }
+    print(f"{'payload':<10}" + "".join(f"{name:>24}" for name in decoders))
+    for payload_name, payload in PAYLOADS.items():
+        results = [
+            bench(decode, payload) / NUMBER * 1e9 for decode in decoders.values()
+        ]
+        print(f"{payload_name:<10}" + "".join(f"{ns:>21.0f} ns" for ns in results))
@@ -0,0 +1,74 @@
+"""
+Benchmark of a PublishScheduler firing many periodic publications: the lag of
+publications behind their due time, and the CPU time of the scheduler thread.
+
+Usage:
+    python benchmarks/bench_publish_scheduler.py [num_publications] [interval] [seconds]
+"""
+
+import logging
+import sys
+import time
+
+from mqtt_node_network.publish_scheduler import PublishScheduler
+
+NUM_PUBLICATIONS = 5000
+INTERVAL = 1.0
+SECONDS = 5.0
+
+
+class NullNode:
+    node_type = "NullNode"
+    hostname = "localhost"
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, node_id):
+        self.node_id = node_id
+        self.name = node_id
+
+    def publish(self, topic, payload, qos=0, retain=False, properties=None):
+        pass
+
+
+def quantile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+if __name__ == "__main__":
+    num_publications = int(sys.argv[1]) if len(sys.argv) > 1 else NUM_PUBLICATIONS
+    interval = float(sys.argv[2]) if len(sys.argv) > 2 else INTERVAL
+    seconds = float(sys.argv[3]) if len(sys.argv) > 3 else SECONDS
+    scheduler = PublishScheduler()
+    nodes = [NullNode(f"node-{i}") for i in range(100)]
+    lags = []
+    publications = []
+    for index in range(num_publications):
+        publication = scheduler.schedule(
+            nodes[index % len(nodes)],
+            f"bench/{index}",
+            None,
+            interval,
+            jitter=interval / 2,
+        )
+        # Record the publication's lag when its payload is taken
+        publication.payload_func = lambda publication=publication: lags.append(
+            time.monotonic() - publication.due
+        )
+        publications.append(publication)
+
+    start_cpu = time.process_time()
+    time.sleep(seconds)
+    elapsed_cpu = time.process_time() - start_cpu
+    for publication in publications:
+        publication.cancel()
+    print(
+        f"{num_publications} publications every {interval}s for {seconds}s: "
+        f"{len(lags)} published"
+    )
+    print(
+        f"lag p50 {quantile(lags, 0.5) * 1000:.2f} ms  "
+        f"p99 {quantile(lags, 0.99) * 1000:.2f} ms  "
+        f"max {max(lags) * 1000:.2f} ms"
+    )
+    print(f"process CPU {elapsed_cpu / seconds * 100:.1f}%")
@@ -0,0 +1,52 @@
+"""
+Benchmark of the time taken to create many nodes from a configuration file:
+parsing the file for every node, creating each node with from_config_file and
+the parsed-config cache, and creating all nodes with from_config_file_many.
+
+Usage:
+    python benchmarks/bench_startup.py [config_file] [num_nodes]
+"""
+
+import sys
+import time
+
+from mqtt_node_network.configuration import clear_config_cache, initialize_config
+from mqtt_node_network.node import MQTTNode
+
+CONFIG_FILE = "tests/config-test.toml"
+NUM_NODES = 500
+
+
+def uncached(config_file, num_nodes):
+    for index in range(num_nodes):
+        configs = initialize_config(config=config_file)
+        MQTTNode(**{**configs["MQTTNode"], "name": f"device-{index}"})
+
+
+def cached(config_file, num_nodes):
+    clear_config_cache()
+    for index in range(num_nodes):
+        MQTTNode.from_config_file(config_file, name=f"device-{index}")
+
+
+def many(config_file, num_nodes):
+    clear_config_cache()
+    MQTTNode.from_config_file_many(num_nodes, config_file, name_template="device-{}")
+
+
+if __name__ == "__main__":
+    config_file = sys.argv[1] if len(sys.argv) > 1 else CONFIG_FILE
+    num_nodes = int(sys.argv[2]) if len(sys.argv) > 2 else NUM_NODES
+    print(f"Creating {num_nodes} nodes from {config_file}")
+    for name, func in [
+        ("parse per node", uncached),
+        ("from_config_file", cached),
+        ("from_config_file_many", many),
+    ]:
+        start = time.perf_counter()
+        func(config_file, num_nodes)
+        elapsed = time.perf_counter() - start
+        print(
+            f"{name:<24}{elapsed * 1000:>10.1f} ms"
+            f"{elapsed / num_nodes * 1e6:>10.0f} us/node"
+        )
@@ -0,0 +1,85 @@
+"""
+Micro-benchmark of matching topics against 10k topic filters, comparing
+TopicRouter with a linear scan using paho's topic_matches_sub and with paho's
+own MQTTMatcher, as used by Client.message_callback_add.
+
+Usage:
+    python benchmarks/bench_topic_router.py
+"""
+
+import random
+import timeit
+
+from paho.mqtt.client import topic_matches_sub
+from paho.mqtt.matcher import MQTTMatcher
+
+from mqtt_node_network.node import TopicRouter
+
+NUM_FILTERS = 10_000
+
+
+def make_filters(num_filters):
+    # A gateway's worth of per-device filters, with a mix of wildcards
+    filters = []
+    for i in range(num_filters):
+        kind = i % 4
+        if kind == 0:
+            filters.append(f"site/{i // 100}/device{i}/+/temperature")
+        elif kind == 1:
+            filters.append(f"site/{i // 100}/device{i}/#")
+        elif kind == 2:
+            filters.append(f"site/+/device{i}/status")
+        else:
+            filters.append(f"site/{i // 100}/device{i}/sensor/humidity")
+    return filters
+
+
+def make_topics(num_filters, count=100):
+    random.seed(0)
+    return [
+        f"site/{i // 100}/device{i}/sensor/temperature"
+        for i in (random.randrange(num_filters) for _ in range(count))
+    ]
+
+
+def bench(match, topics, number):
+    seconds = min(
+        timeit.repeat(lambda: [match(topic) for topic in topics], number=number, repeat=3)
+    )
+    return seconds / (number * len(topics))
+
+
+if __name__ == "__main__":
+    filters = make_filters(NUM_FILTERS)
+    topics = make_topics(NUM_FILTERS)
+
+    router = TopicRouter()
+    matcher = MQTTMatcher()
+    for topic_filter in filters:
+        router[topic_filter] = topic_filter
+        matcher[topic_filter] = topic_filter
+
+    def linear(topic):
+        return [f for f in filters if topic_matches_sub(f, topic)]
+
+    # name: (match, number of passes over the topics)
+    matchers = {
+        "linear scan": (linear, 1),
+        "paho MQTTMatcher": (lambda topic: list(matcher.iter_match(topic)), 1),
+        "TopicRouter": (router.match, 100),
+    }
+    for topic in topics[:10]:
+        assert sorted(router.match(topic)) == sorted(linear(topic))
+
+    print(f"Matching one topic against {NUM_FILTERS} filters")
+    for name, (match, number) in matchers.items():
+        print(f"{name:<20}{bench(match, topics, number) * 1e6:>12.2f} us")
+
+    print(f"\nChecking a filter is subscribed, {NUM_FILTERS} subscriptions")
+    filter_list = list(filters)
+    probe = filters[-1]
+    for name, container in (("list", filter_list), ("TopicRouter", router)):
+        seconds = min(
+            timeit.repeat(lambda: probe in container, number=10_000, repeat=3)
+        )
+        print(f"{name:<20}{seconds / 10_000 * 1e6:>12.2f} us")
@@ -0,0 +1,48 @@
+"""
+Benchmark of MetricsWAL append throughput, in metrics per second, for the
+batch sizes produced by inline parsing (one message at a time) and by the
+ingest workers.
+
+Usage:
+    python benchmarks/bench_wal.py [directory]
+"""
+
+import sys
+import tempfile
+import time
+
+from mqtt_node_network.wal import MetricsWAL
+
+NUM_METRICS = 200_000
+TARGET = 50_000
+
+
+def make_metric(i):
+    return {
+        "measurement": "temperature",
+        "fields": {f"sensor{i % 100}": 20.0 + i % 7},
+        "time": 1700000000.0 + i / 1000,
+        "tags": {"machine": "line1", "module": f"box{i % 10}"},
+    }
+
+
+def bench(directory, batch_size, **kwargs):
+    metrics = [make_metric(i) for i in range(NUM_METRICS)]
+    batches = [metrics[i : i + batch_size] for i in range(0, NUM_METRICS, batch_size)]
+    wal = MetricsWAL(directory, **kwargs)
+    start = time.perf_counter()
+    for batch in batches:
+        wal.append(batch)
+    wal.flush()
+    elapsed = time.perf_counter() - start
+    wal.close()
+    return NUM_METRICS / elapsed
+
+
+if __name__ == "__main__":
+    base = sys.argv[1] if len(sys.argv) > 1 else None
+    print(f"Appending {NUM_METRICS} metrics, target {TARGET} metrics/s")
+    for batch_size in (1, 100):
+        with tempfile.TemporaryDirectory(dir=base) as directory:
+            rate = bench(directory, batch_size)
+        print(f"batch size {batch_size:<8}{rate:>12,.0f} metrics/s")
@@ -1,12 +1,12 @@
 import sys
 import time
 import random
-import threading
 import logging
 
 from mqtt_node_network.configuration import initialize_logging
 from mqtt_node_network.node import MQTTNode
 from mqtt_node_network.metrics_node import MQTTMetricsNode
+from mqtt_node_network.swarm import NodeSwarm
 
 logger = initialize_logging("./config/logging.yaml")
 
@@ -105,15 +105,11 @@ def create_node():
 
 
 def create_node_swarm(num_nodes):
-    """Publish random temperature data to the broker every PUBLISH_PERIOD seconds."""
-    threads = []
-    for _ in range(num_nodes):
-        thread = threading.Thread(target=create_node)
-        threads.append(thread)
-        thread.start()
-
-    for thread in threads:
-        thread.join()
+    """Connect num_nodes nodes, all driven by a single network thread."""
+    with NodeSwarm.from_config_file(num_nodes, "config/config.toml") as swarm:
+        swarm.connect()
+        while True:
+            time.sleep(1)
 
 
 def simple_create_node(config_file) -> MQTTNode:
@@ -1,9 +1,51 @@
-from mqtt_node_network.node import MQTTNode
-from mqtt_node_network.metrics_node import MQTTMetricsNode
-from mqtt_node_network.configuration import (
-    initialize_config,
-    MQTTBrokerConfig,
-    MQTTNodeConfig,
-    LatencyMonitoringConfig,
-    SubscribeConfig,
-)
+"""
+Public names are imported lazily on first access, so importing the package, or
+a light module such as mqtt_node_network.topic_structure, does not pull in
+paho-mqtt, prometheus_client or the config file parsers.
+"""
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from mqtt_node_network.node import MQTTNode
+    from mqtt_node_network.metrics_node import MQTTMetricsNode
+    from mqtt_node_network.topic_structure import TopicStructure, parse_topic
+    from mqtt_node_network.configuration import (
+        initialize_config,
+        load_config_cached,
+        MQTTBrokerConfig,
+        MQTTNodeConfig,
+        LatencyMonitoringConfig,
+        SubscribeConfig,
+    )
+
+# Public names, mapped to the module defining them
+_EXPORTS = {
+    "MQTTNode": "mqtt_node_network.node",
+    "MQTTMetricsNode": "mqtt_node_network.metrics_node",
+    "TopicStructure": "mqtt_node_network.topic_structure",
+    "parse_topic": "mqtt_node_network.topic_structure",
+    "initialize_config": "mqtt_node_network.configuration",
+    "load_config_cached": "mqtt_node_network.configuration",
+    "MQTTBrokerConfig": "mqtt_node_network.configuration",
+    "MQTTNodeConfig": "mqtt_node_network.configuration",
+    "LatencyMonitoringConfig": "mqtt_node_network.configuration",
+    "SubscribeConfig": "mqtt_node_network.configuration",
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name: str):
+    module = _EXPORTS.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    # __import__ rather than importlib.import_module, which -X importtime misses
+    value = getattr(__import__(module, fromlist=(name,)), name)
+    # Cache the name, so later lookups skip __getattr__
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,269 @@
+"""Windowed aggregation of received metrics before they are buffered"""
+
+from __future__ import annotations
+import logging
+import math
+import threading
+import time
+from typing import Callable, Dict, List, Mapping, Optional, Sequence, Tuple
+
+from prometheus_client import Counter
+
+from mqtt_node_network.configuration import AggregationConfig
+from mqtt_node_network.node import TopicRouter
+
+logger = logging.getLogger(__name__)
+
+STATISTICS = ("min", "max", "mean", "count", "last")
+
+
+def _make_dict(measurement: str, fields: Dict, time: float, tags: Mapping) -> Dict:
+    return {
+        "measurement": measurement,
+        "fields": fields,
+        "time": time,
+        "tags": dict(tags),
+    }
+
+
+class _Window:
+    """The running statistics of one series over one window."""
+
+    __slots__ = ("start", "count", "total", "min", "max", "last", "numeric")
+
+    def __init__(self, start: float, value):
+        self.start = start
+        self.count = 1
+        self.last = value
+        self.numeric = type(value) is float or type(value) is int
+        if self.numeric:
+            self.total = self.min = self.max = value
+        else:
+            self.total = self.min = self.max = None
+
+    def add(self, value) -> None:
+        self.count += 1
+        self.last = value
+        if not self.numeric:
+            return
+        if type(value) is float or type(value) is int:
+            self.total += value
+            if value < self.min:
+                self.min = value
+            elif value > self.max:
+                self.max = value
+        else:
+            # Mixed types leave only the count and last value meaningful
+            self.numeric = False
+            self.total = self.min = self.max = None
+
+
+class WindowedAggregator:
+    """
+    Aggregates metrics over tumbling windows, per series.
+
+    A series is a measurement, tag set and field. Each window keeps a running
+    min, max, mean, count and last value of its series, and is emitted as one
+    metric with a field per statistic, named "<field>_<statistic>" and stamped
+    with the start of the window. Windows are aligned to multiples of their
+    length since the epoch, so nodes aggregating the same series agree on them.
+    Non-numeric values only have a count and last value.
+
+    The window of each topic is that of the first configured topic filter
+    matching it, or the default window. A window of 0 passes metrics through
+    unaggregated. A window is emitted when a sample of its series arrives in a
+    later window, or by `collect` once it has ended, after a grace period for
+    late samples. Samples older than their series' current window are counted
+    in it. Windows still open are lost if the process crashes, as they are only
+    logged to a node's write-ahead log once emitted.
+    """
+
+    metric_aggregated_samples = Counter(
+        "metric_aggregated_samples_total",
+        "Total number of samples folded into aggregation windows",
+        labelnames=("aggregator",),
+    )
+    metric_aggregated_windows = Counter(
+        "metric_aggregated_windows_total",
+        "Total number of aggregation windows emitted",
+        labelnames=("aggregator",),
+    )
+
+    @classmethod
+    def from_config(
+        cls,
+        config: AggregationConfig,
+        factory: Optional[Callable] = None,
+        name: str = "aggregator",
+    ) -> WindowedAggregator:
+        return cls(
+            window=config.window,
+            windows=config.windows,
+            statistics=config.statistics,
+            grace=config.grace,
+            factory=factory,
+            name=name,
+        )
+
+    def __init__(
+        self,
+        window: float = 0,
+        windows: Optional[Mapping[str, float]] = None,
+        statistics: Sequence[str] = STATISTICS,
+        grace: float = 0,
+        factory: Optional[Callable] = None,
+        name: str = "aggregator",
+        topic_cache_size: int = 4096,
+    ):
+        """
+        :param window: The window in seconds of topics not matching `windows`.
+            0 passes them through unaggregated.
+        :param windows: A mapping of MQTT topic filters to windows in seconds.
+        :param statistics: The statistics emitted, any of STATISTICS.
+        :param grace: Seconds after a window ends before `collect` emits it.
+        :param factory: Called with (measurement, fields, time, tags) to create
+            each emitted metric. Defaults to creating a dictionary.
+        :param name: The name of the aggregator in its metrics.
+        :param topic_cache_size: The maximum number of topics whose window is
+            cached. The cache is cleared when it is full.
+        """
+        unknown = set(statistics) - set(STATISTICS)
+        if unknown:
+            raise ValueError(
+                f"Unknown statistics {sorted(unknown)}. Must be in {STATISTICS}"
+            )
+        if window < 0 or any(w < 0 for w in (windows or {}).values()):
+            raise ValueError("Aggregation windows must not be negative")
+
+        self.window = window
+        self.statistics = tuple(statistics)
+        self.grace = grace
+        self.factory = factory or _make_dict
+        self.name = name
+        self.topic_cache_size = topic_cache_size
+
+        # Values are (priority, window), so the first configured filter wins
+        self.router = TopicRouter(
+            {
+                topic_filter: (index, length)
+                for index, (topic_filter, length) in enumerate((windows or {}).items())
+            }
+        )
+        self._topic_windows: Dict[str, float] = {}
+        self._series: Dict[Tuple, Tuple[float, Mapping, _Window]] = {}
+        self._lock = threading.Lock()
+
+        self._samples_count = self.metric_aggregated_samples.labels(name)
+        self._windows_count = self.metric_aggregated_windows.labels(name)
+
+    def __len__(self) -> int:
+        """The number of open windows."""
+        return len(self._series)
+
+    def __repr__(self) -> str:
+        return (
+            f"{self.__class__.__name__}(window={self.window}, "
+            f"windows={dict((f, v[1]) for f, v in self.router.items())})"
+        )
+
+    def window_for(self, topic: str) -> float:
+        """Get the window in seconds of a topic. 0 is unaggregated."""
+        length = self._topic_windows.get(topic)
+        if length is None:
+            matches = self.router.match(topic)
+            length = min(matches)[1] if matches else self.window
+            if len(self._topic_windows) >= self.topic_cache_size:
+                self._topic_windows.clear()
+            self._topic_windows[topic] = length
+        return length
+
+    def add(self, topic: str, metric: Mapping) -> List:
+        """
+        Fold a metric received on a topic into the windows of its series.
+
+        :return: The metrics of any windows closed by it, or the metric itself
+            if its topic is not aggregated.
+        """
+        length = self.window_for(topic)
+        if not length:
+            return [metric]
+        if type(metric) is dict:
+            measurement = metric["measurement"]
+            tags = metric["tags"]
+            fields = metric["fields"]
+            metric_time = metric["time"]
+        else:
+            measurement = metric.measurement
+            tags = metric.tags
+            fields = metric.fields
+            metric_time = metric.time
+        start = math.floor(metric_time / length) * length
+        tags_key = tuple(tags.items())
+
+        emitted = []
+        with self._lock:
+            for field_key, value in fields.items():
+                key = (measurement, tags_key, field_key)
+                series = self._series.get(key)
+                if series is None:
+                    self._series[key] = (length, tags, _Window(start, value))
+                    continue
+                window = series[2]
+                if start > window.start:
+                    emitted.append(self._emit(key, series))
+                    self._series[key] = (length, tags, _Window(start, value))
+                else:
+                    window.add(value)
+            self._samples_count.inc(len(fields))
+        if emitted:
+            self._windows_count.inc(len(emitted))
+        return emitted
+
+    def _emit(self, key: Tuple, series: Tuple[float, Mapping, _Window]):
+        measurement, _, field_key = key
+        _, tags, window = series
+        fields = {}
+        for statistic in self.statistics:
+            if statistic == "count":
+                value = window.count
+            elif statistic == "last":
+                value = window.last
+            elif not window.numeric:
+                continue
+            elif statistic == "mean":
+                value = window.total / window.count
+            else:
+                value = getattr(window, statistic)
+            fields[f"{field_key}_{statistic}"] = value
+        return self.factory(measurement, fields, window.start, tags)
+
+    def collect(self, now: Optional[float] = None) -> List:
+        """
+        Emit the windows which ended more than the grace period before `now`.
+
+        :param now: The current time. Defaults to time.time().
+        :return: The metrics of the emitted windows.
+        """
+        if now is None:
+            now = time.time()
+        emitted = []
+        with self._lock:
+            ended = [
+                key
+                for key, (length, _, window) in self._series.items()
+                if window.start + length + self.grace <= now
+            ]
+            for key in ended:
+                emitted.append(self._emit(key, self._series.pop(key)))
+        if emitted:
+            self._windows_count.inc(len(emitted))
+        return emitted
+
+    def flush(self) -> List:
+        """Emit every open window, ended or not."""
+        with self._lock:
+            emitted = [self._emit(key, series) for key, series in self._series.items()]
+            self._series.clear()
+        if emitted:
+            self._windows_count.inc(len(emitted))
+        return emitted
@@ -0,0 +1,343 @@
+"""An MQTTNode driven natively by an asyncio event loop"""
+
+from __future__ import annotations
+import asyncio
+import logging
+from typing import AsyncIterator, Dict, List, NoReturn, Optional, Union
+
+import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+from mqtt_node_network.node import MQTTNode, NodeError
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncMQTTNode(MQTTNode):
+    """
+    An MQTTNode whose network traffic is driven by the running asyncio event loop,
+    rather than by paho's network thread.
+
+    The paho client's socket is watched with the loop's add_reader/add_writer,
+    and keepalives are handled by a task calling loop_misc. connect, publish and
+    subscribe are awaitable, and received messages are available as an async
+    stream from `messages()`. Prometheus counters and logging are the same as
+    MQTTNode.
+
+    All methods must be called from the event loop the node was connected on.
+    """
+
+    def __init__(self, *args, message_queue_size: int = 0, **kwargs):
+        """
+        Initialize an AsyncMQTTNode. Accepts the same arguments as MQTTNode.
+
+        :param message_queue_size: The maximum number of received messages waiting
+            to be read from `messages()`. 0 is unbounded. When full, new messages
+            are dropped.
+        """
+        super().__init__(*args, **kwargs)
+        self.message_queue_size = message_queue_size
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._misc_task: Optional[asyncio.Task] = None
+        self._connected_future: Optional[asyncio.Future] = None
+        self._disconnected_future: Optional[asyncio.Future] = None
+        self._pending_publishes: Dict[int, asyncio.Future] = {}
+        self._pending_subscribes: Dict[int, asyncio.Future] = {}
+        self._messages: Optional[asyncio.Queue] = None
+
+        self.client.on_socket_open = self._on_socket_open
+        self.client.on_socket_close = self._on_socket_close
+        self.client.on_socket_register_write = self._on_socket_register_write
+        self.client.on_socket_unregister_write = self._on_socket_unregister_write
+
+    async def __aenter__(self) -> AsyncMQTTNode:
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self.aclose()
+
+    # Socket callbacks
+    # ***************************************************************************
+    # paho may call these from the executor thread running client.connect, so
+    # they are scheduled onto the event loop. The file descriptor is captured
+    # up front, as the socket may be closed by the time the callback runs
+
+    def _call_soon(self, callback, *args):
+        if self._loop is None or self._loop.is_closed():
+            return
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is self._loop:
+            callback(*args)
+        else:
+            self._loop.call_soon_threadsafe(callback, *args)
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._call_soon(self._loop.add_reader, sock.fileno(), self._loop_read)
+
+    def _on_socket_close(self, client, userdata, sock):
+        fd = sock.fileno()
+        self._call_soon(self._loop.remove_reader, fd)
+        self._call_soon(self._loop.remove_writer, fd)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._call_soon(self._loop.add_writer, sock.fileno(), self.client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._call_soon(self._loop.remove_writer, sock.fileno())
+
+    def _loop_read(self):
+        rc = self.client.loop_read()
+        if rc not in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_AGAIN):
+            self.logger.debug(f"Read failed: {mqtt.error_string(rc)}")
+
+    async def _loop_misc(self) -> NoReturn:
+        # Sends keepalive pings, and reconnects if the connection is lost
+        reconnect_delay = 1
+        while True:
+            if self.client.loop_misc() == mqtt.MQTT_ERR_NO_CONN:
+                self.logger.warning(
+                    f"Connection lost. Reconnecting in {reconnect_delay}s ..."
+                )
+                await asyncio.sleep(reconnect_delay)
+                try:
+                    await self._loop.run_in_executor(None, self.client.reconnect)
+                    reconnect_delay = 1
+                except (OSError, mqtt.WebsocketConnectionError) as e:
+                    self.logger.error(f"Reconnection failed: {e}")
+                    reconnect_delay = min(reconnect_delay * 2, 30)
+                continue
+            await asyncio.sleep(1)
+
+    # Public API
+    # ***************************************************************************
+
+    async def connect(
+        self,
+        packet_properties: Optional[Properties] = None,
+        ensure_connected: bool = True,
+    ) -> AsyncMQTTNode:
+        """
+        Connect to the broker.
+
+        :param packet_properties: CONNECT packet properties. Defaults to those
+            configured for the node.
+        :param ensure_connected: Wait for the broker's CONNACK before returning.
+        :raises NodeError: If the broker refuses the connection, or it times out.
+        """
+        if self.is_connected():
+            return self
+        self._loop = asyncio.get_running_loop()
+        if self._messages is None:
+            self._messages = asyncio.Queue(maxsize=self.message_queue_size)
+        if packet_properties is None:
+            packet_properties = self.packet_properties[PacketTypes.CONNECT].build()
+
+        self._connected_future = self._loop.create_future()
+        # The TCP connect blocks, so it runs off the event loop
+        await self._loop.run_in_executor(
+            None,
+            lambda: self.client.connect(
+                host=self.hostname,
+                port=self.port,
+                keepalive=self.keepalive,
+                clean_start=self.clean_session,
+                properties=packet_properties,
+            ),
+        )
+        if self._misc_task is None or self._misc_task.done():
+            self._misc_task = self._loop.create_task(self._loop_misc())
+
+        if ensure_connected:
+            try:
+                await asyncio.wait_for(
+                    asyncio.shield(self._connected_future), timeout=self.timeout
+                )
+            except asyncio.TimeoutError:
+                raise NodeError(
+                    f"Timed out connecting to broker at {self.hostname}:{self.port}"
+                ) from None
+            await self.update_node_status()
+        return self
+
+    async def publish(
+        self,
+        topic,
+        payload,
+        qos=0,
+        retain=False,
+        properties=None,
+        ensure_published=True,
+        codec=None,
+    ) -> mqtt.MQTTMessageInfo:
+        """
+        Publish a message. See MQTTNode.publish.
+
+        :param ensure_published: Wait until the message is sent for QoS 0, acknowledged
+            with PUBACK for QoS 1, or completed with PUBCOMP for QoS 2. Messages
+            appended to the node's spool are returned straight away, with mid 0.
+        :raises NodeError: If the message cannot be sent, or the wait times out.
+        """
+        message_info = super().publish(
+            topic, payload, qos, retain, properties=properties, codec=codec
+        )
+        if message_info.rc != mqtt.MQTT_ERR_SUCCESS:
+            raise NodeError(
+                f"Failed to publish to topic {topic}: {mqtt.error_string(message_info.rc)}"
+            )
+        if message_info.mid == 0:
+            # Spooled, so only published once the spool is replayed
+            return message_info
+        if ensure_published and not message_info.is_published():
+            future = self._loop.create_future()
+            self._pending_publishes[message_info.mid] = future
+            try:
+                await asyncio.wait_for(future, timeout=self.timeout)
+            except asyncio.TimeoutError:
+                raise NodeError(
+                    f"Timed out waiting for publish to topic {topic} to complete"
+                ) from None
+            finally:
+                self._pending_publishes.pop(message_info.mid, None)
+        return message_info
+
+    async def publish_every_async(
+        self,
+        topic,
+        payload_func,
+        qos=0,
+        retain=False,
+        packet_properties=None,
+        interval=1,
+    ) -> NoReturn:
+        while True:
+            payload = payload_func()
+            await self.publish(topic, payload, qos, retain, packet_properties)
+            await asyncio.sleep(interval)
+
+    async def subscribe(
+        self,
+        topic: Union[str, tuple, list],
+        qos: Optional[int] = None,
+        options: mqtt.SubscribeOptions = None,
+    ) -> List:
+        """
+        Subscribe to a topic, and wait for the broker's SUBACK.
+
+        :return: The reason codes from the SUBACK, one per topic.
+        :raises NodeError: If the SUBACK times out.
+        """
+        result, mid = super().subscribe(topic, qos, options)
+        if result != mqtt.MQTT_ERR_SUCCESS:
+            return []
+        future = self._loop.create_future()
+        self._pending_subscribes[mid] = future
+        try:
+            return await asyncio.wait_for(future, timeout=self.timeout)
+        except asyncio.TimeoutError:
+            raise NodeError(f"Timed out subscribing to topic {topic}") from None
+        finally:
+            self._pending_subscribes.pop(mid, None)
+
+    async def update_node_status(
+        self, status: Union[str, int, float] = None, properties: Properties = None
+    ) -> None:
+        if self.status_config is None:
+            self.logger.debug("Status configuration not provided.")
+            return
+        status = status or self.status_config.payload
+        await self.publish(
+            self.status_config.topic,
+            status,
+            qos=self.status_config.qos,
+            retain=self.status_config.retain,
+            properties=properties,
+        )
+        logger.debug(f"Published status update: {status}")
+
+    async def messages(self) -> AsyncIterator[mqtt.MQTTMessage]:
+        """
+        Iterate over received messages.
+
+            async for message in node.messages():
+                ...
+        """
+        if self._messages is None:
+            raise NodeError("Node must be connected before reading messages")
+        while True:
+            yield await self._messages.get()
+
+    async def aclose(self) -> None:
+        """Disconnect from the broker and stop driving the client."""
+        if self.is_connected():
+            self._disconnected_future = self._loop.create_future()
+            self.disconnect()
+            try:
+                await asyncio.wait_for(self._disconnected_future, timeout=self.timeout)
+            except asyncio.TimeoutError:
+                self.logger.warning("Timed out waiting for disconnect")
+        if self._misc_task is not None:
+            self._misc_task.cancel()
+            self._misc_task = None
+
+    def loop_start(self) -> AsyncMQTTNode:
+        raise NodeError("AsyncMQTTNode is driven by the asyncio event loop")
+
+    def __del__(self):
+        # Disconnecting needs the event loop; use aclose() instead
+        pass
+
+    # Callbacks
+    # ***************************************************************************
+
+    def on_connect(self, client, userdata, flags, reason_code, properties):
+        super().on_connect(client, userdata, flags, reason_code, properties)
+        future = self._connected_future
+        if future is not None and not future.done():
+            if reason_code == 0:
+                future.set_result(reason_code)
+            else:
+                future.set_exception(
+                    NodeError(f"Connection failed with code {reason_code}")
+                )
+
+    def on_disconnect(
+        self, client, userdata, disconnect_flags, reason_code, properties
+    ):
+        super().on_disconnect(
+            client, userdata, disconnect_flags, reason_code, properties
+        )
+        future = self._disconnected_future
+        if future is not None and not future.done():
+            future.set_result(reason_code)
+
+    def on_message(self, client, userdata, message):
+        super().on_message(client, userdata, message)
+        try:
+            self._messages.put_nowait(message)
+        except asyncio.QueueFull:
+            self.logger.warning(
+                f"Message queue full. Dropped message on topic '{message.topic}'"
+            )
+
+    def on_publish(self, client, userdata, mid, reason_code, properties):
+        super().on_publish(client, userdata, mid, reason_code, properties)
+        future = self._pending_publishes.pop(mid, None)
+        if future is not None and not future.done():
+            future.set_result(reason_code)
+
+    def on_subscribe(self, client, userdata, mid, reason_code_list, properties):
+        # Resubscriptions are reported by MQTTNode.on_subscribe
+        super().on_subscribe(client, userdata, mid, reason_code_list, properties)
+        future = self._pending_subscribes.pop(mid, None)
+        if future is None:
+            return
+        for reason_code in reason_code_list:
+            if reason_code.is_failure:
+                self.logger.error(f"Subscription failed: {reason_code}")
+        if not future.done():
+            future.set_result(reason_code_list)
@@ -0,0 +1,333 @@
+"""Bounded buffers for storing parsed metrics until they are consumed"""
+
+from __future__ import annotations
+from collections import deque
+import json
+import logging
+from pathlib import Path
+import threading
+import time
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Union
+
+from prometheus_client import Counter
+
+from mqtt_node_network.configuration import MetricsBufferConfig
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_POLICIES = ("drop_oldest", "drop_newest", "block", "spill")
+
+
+class MetricsBufferError(Exception):
+    """
+    Exception raised for errors in a metrics buffer.
+    """
+
+    def __init__(self, message: str):
+        self.message = message
+        logger.error(self.message)
+        super().__init__(self.message)
+
+
+class BoundedMetricsBuffer:
+    """
+    A thread-safe, bounded FIFO buffer for metrics, with a configurable policy
+    for what happens when the buffer is full:
+
+    - drop_oldest: the oldest metric is discarded to make room.
+    - drop_newest: the incoming metric is discarded.
+    - block: the producer waits up to `block_timeout` seconds for room, and the
+      incoming metric is discarded if none becomes available.
+    - spill: the incoming metric is appended to a JSON lines file on disk, and
+      is read back into the buffer as the consumer makes room, rebuilt with
+      `factory`.
+
+    The buffer supports the deque methods used by MQTTMetricsNode and its
+    consumers: append, extend, popleft, clear, len() and iteration.
+    """
+
+    metric_buffer_dropped_count = Counter(
+        "metric_buffer_dropped_total",
+        "Total number of metrics dropped by a full metrics buffer",
+        labelnames=("buffer", "policy"),
+    )
+
+    metric_buffer_spilled_count = Counter(
+        "metric_buffer_spilled_total",
+        "Total number of metrics spilled to disk by a full metrics buffer",
+        labelnames=("buffer", "policy"),
+    )
+
+    @classmethod
+    def from_config(
+        cls,
+        config: MetricsBufferConfig,
+        name: str = "buffer",
+        on_high_watermark: Optional[Callable[[BoundedMetricsBuffer], Any]] = None,
+        on_drop: Optional[Callable[[Any], Any]] = None,
+        factory: Optional[Callable] = None,
+        spill_path: Optional[Union[str, Path]] = None,
+    ) -> BoundedMetricsBuffer:
+        return cls(
+            maxlen=config.maxlen,
+            policy=config.policy,
+            block_timeout=config.block_timeout,
+            spill_path=spill_path if spill_path is not None else config.spill_path,
+            high_watermark=config.high_watermark,
+            on_high_watermark=on_high_watermark,
+            on_drop=on_drop,
+            factory=factory,
+            name=name,
+        )
+
+    def __init__(
+        self,
+        maxlen: int,
+        policy: str = "drop_oldest",
+        block_timeout: float = 1.0,
+        spill_path: Optional[Union[str, Path]] = None,
+        high_watermark: float = 0.8,
+        on_high_watermark: Optional[Callable[[BoundedMetricsBuffer], Any]] = None,
+        on_drop: Optional[Callable[[Any], Any]] = None,
+        factory: Optional[Callable] = None,
+        name: str = "buffer",
+    ):
+        """
+        Initialize a BoundedMetricsBuffer.
+
+        :param maxlen: The maximum number of metrics held in memory.
+        :param policy: The overflow policy. One of OVERFLOW_POLICIES.
+        :param block_timeout: Seconds to wait for room with the "block" policy.
+        :param spill_path: File to spill metrics to with the "spill" policy.
+        :param high_watermark: Fraction of maxlen at which on_high_watermark is called.
+        :param on_high_watermark: Called with the buffer each time it fills past
+            the high watermark. It is re-armed once the buffer drains below it.
+        :param on_drop: Called with each metric the overflow policy discards,
+            with the buffer's lock held.
+        :param factory: Called with (measurement, fields, time, tags) to rebuild
+            metrics read back from the spill file. Defaults to dictionaries.
+        :param name: A name for the buffer, used to label Prometheus metrics.
+        """
+        if maxlen <= 0:
+            raise MetricsBufferError("Buffer maxlen must be greater than 0")
+        if policy not in OVERFLOW_POLICIES:
+            raise MetricsBufferError(
+                f"Unknown overflow policy '{policy}'. Must be one of {OVERFLOW_POLICIES}"
+            )
+        if policy == "spill" and spill_path is None:
+            raise MetricsBufferError(
+                "A spill_path must be provided for the 'spill' policy"
+            )
+
+        self.maxlen = maxlen
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.name = name
+        self.high_watermark = max(1, int(maxlen * high_watermark))
+        self.on_high_watermark = on_high_watermark
+        self._above_watermark = False
+        self.on_drop = on_drop
+
+        self._items = deque()
+        self._lock = threading.Lock()
+        self._not_full = threading.Condition(self._lock)
+
+        self.factory = factory
+        self.spill_path = Path(spill_path) if spill_path is not None else None
+        self._spill_count = 0
+        self._spill_read_offset = 0
+        self._spill_file = None
+        if self.spill_path is not None:
+            self.spill_path.parent.mkdir(parents=True, exist_ok=True)
+            # Start with an empty spill file; a stale one cannot be ordered
+            # relative to new metrics
+            self._spill_file = open(self.spill_path, "w")
+
+        self._dropped = self.metric_buffer_dropped_count.labels(name, policy)
+        self._spilled = self.metric_buffer_spilled_count.labels(name, policy)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __bool__(self) -> bool:
+        return len(self._items) > 0
+
+    def __iter__(self) -> Iterator:
+        with self._lock:
+            return iter(list(self._items))
+
+    def __getitem__(self, index: int):
+        return self._items[index]
+
+    def __repr__(self) -> str:
+        return (
+            f"{self.__class__.__name__}(name={self.name!r}, len={len(self)}, "
+            f"maxlen={self.maxlen}, policy={self.policy!r}, spilled={self._spill_count})"
+        )
+
+    @property
+    def spilled(self) -> int:
+        """The number of metrics currently held on disk."""
+        return self._spill_count
+
+    def append(self, item) -> bool:
+        """
+        Add a metric to the buffer, applying the overflow policy if it is full.
+
+        :return: True if the metric was stored, in memory or on disk.
+        """
+        spilled = []
+        with self._lock:
+            stored = self._append(item, spilled)
+            if spilled:
+                self._spill(spilled)
+        self._check_watermark()
+        return stored
+
+    def extend(self, items: Iterable) -> int:
+        """
+        Add several metrics to the buffer.
+
+        :return: The number of metrics stored, in memory or on disk.
+        """
+        spilled = []
+        with self._lock:
+            stored = sum(self._append(item, spilled) for item in items)
+            if spilled:
+                # Spilled in one write
+                self._spill(spilled)
+        self._check_watermark()
+        return stored
+
+    def popleft(self):
+        """Remove and return the oldest metric. Raises IndexError if empty."""
+        with self._lock:
+            item = self._items.popleft()
+            self._refill()
+            self._not_full.notify()
+        self._check_watermark()
+        return item
+
+    def drain(self, max_items: Optional[int] = None) -> List:
+        """Remove and return up to max_items of the oldest metrics."""
+        with self._lock:
+            count = len(self._items)
+            if max_items is not None:
+                count = min(count, max_items)
+            items = [self._items.popleft() for _ in range(count)]
+            self._refill()
+            self._not_full.notify_all()
+        self._check_watermark()
+        return items
+
+    def clear(self) -> None:
+        """Remove all metrics, including any spilled to disk."""
+        with self._lock:
+            self._items.clear()
+            self._reset_spill()
+            self._not_full.notify_all()
+        self._check_watermark()
+
+    def close(self) -> None:
+        """Close the spill file. Metrics spilled to disk are discarded."""
+        with self._lock:
+            if self._spill_file is not None:
+                self._spill_file.close()
+                self._spill_file = None
+
+    def _append(self, item, spilled: List) -> bool:
+        # Called with the lock held. Metrics to spill are added to `spilled`
+        if self._spill_count or spilled:
+            # Preserve ordering: once spilling, new metrics queue behind the spill
+            spilled.append(item)
+            return True
+        if len(self._items) < self.maxlen:
+            self._items.append(item)
+            return True
+
+        if self.policy == "drop_oldest":
+            self._drop(self._items.popleft())
+            self._items.append(item)
+            return True
+        elif self.policy == "drop_newest":
+            self._drop(item)
+            return False
+        elif self.policy == "block":
+            deadline = time.monotonic() + self.block_timeout
+            while len(self._items) >= self.maxlen:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._not_full.wait(remaining):
+                    self._drop(item)
+                    return False
+            self._items.append(item)
+            return True
+        else:
+            spilled.append(item)
+            return True
+
+    def _drop(self, item) -> None:
+        # Called with the lock held
+        self._dropped.inc()
+        if self.on_drop is not None:
+            try:
+                self.on_drop(item)
+            except Exception as e:
+                logger.error(f"Drop callback failed: {e}")
+
+    def _spill(self, items: List) -> None:
+        # Called with the lock held. Read-only mappings such as MetricRecord tags
+        # are written as objects
+        self._spill_file.write(
+            "".join(json.dumps(dict(item), default=dict) + "\n" for item in items)
+        )
+        self._spill_file.flush()
+        self._spill_count += len(items)
+        self._spilled.inc(len(items))
+
+    def _reset_spill(self) -> None:
+        # Called with the lock held
+        if self._spill_file is not None:
+            self._spill_file.seek(0)
+            self._spill_file.truncate()
+        self._spill_count = 0
+        self._spill_read_offset = 0
+
+    def _load(self, line: str):
+        metric = json.loads(line)
+        if self.factory is None:
+            return metric
+        return self.factory(
+            metric["measurement"], metric["fields"], metric["time"], metric["tags"]
+        )
+
+    def _refill(self) -> None:
+        # Called with the lock held. Read spilled metrics back into memory
+        if not self._spill_count:
+            return
+        room = self.maxlen - len(self._items)
+        if room <= 0:
+            return
+        with open(self.spill_path, "r") as file:
+            file.seek(self._spill_read_offset)
+            for _ in range(min(room, self._spill_count)):
+                line = file.readline()
+                if not line:
+                    break
+                self._items.append(self._load(line))
+                self._spill_count -= 1
+            self._spill_read_offset = file.tell()
+        if not self._spill_count:
+            # Everything has been read back, so the spill file can be reset
+            self._reset_spill()
+
+    def _check_watermark(self) -> None:
+        above = len(self._items) >= self.high_watermark
+        if above and not self._above_watermark:
+            self._above_watermark = True
+            if self.on_high_watermark is not None:
+                try:
+                    self.on_high_watermark(self)
+                except Exception as e:
+                    logger.error(f"High watermark callback failed: {e}")
+        elif not above:
+            self._above_watermark = False
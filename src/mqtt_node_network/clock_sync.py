@@ -0,0 +1,375 @@
+"""Estimation of the local clock's offset from NTP servers"""
+
+from __future__ import annotations
+from collections import deque
+from dataclasses import dataclass
+import logging
+import socket
+import struct
+import threading
+import time
+from typing import Deque, Dict, Optional, Sequence, Tuple
+
+from paho.mqtt.properties import Properties
+
+from mqtt_node_network.configuration import ClockSyncConfig
+
+logger = logging.getLogger(__name__)
+
+# User property holding the time a message was published, in nanoseconds since
+# the epoch by the publisher's corrected clock
+SOURCE_TIME_PROPERTY = "ts"
+
+# Seconds from the NTP epoch, 1900-01-01, to the Unix epoch
+NTP_EPOCH_OFFSET = 2208988800
+# An SNTP packet: flags, stratum, poll, precision, root delay, root dispersion,
+# reference id, and the reference, originate, receive and transmit timestamps
+NTP_PACKET = struct.Struct("!BBBbII4sQQQQ")
+# A client request only sets the flags and transmit timestamp
+NTP_REQUEST = struct.Struct("!B39xQ")
+NTP_MODE_CLIENT = 3
+NTP_MODE_SERVER = 4
+
+
+class ClockSyncError(Exception):
+    """
+    Exception raised when the clock offset cannot be measured.
+    """
+
+    def __init__(self, message: str):
+        self.message = message
+        logger.debug(self.message)
+        super().__init__(self.message)
+
+
+@dataclass
+class NTPSample:
+    """A measurement of the local clock's offset from an NTP server."""
+
+    offset: float  # Seconds to add to time.time() to get the server's time
+    delay: float  # Round trip delay to the server, in seconds
+    stratum: int
+    monotonic: float  # time.monotonic() when the response was received
+
+
+def _to_ntp(timestamp: float) -> int:
+    return int((timestamp + NTP_EPOCH_OFFSET) * 2**32)
+
+
+def _from_ntp(timestamp: int) -> float:
+    return timestamp / 2**32 - NTP_EPOCH_OFFSET
+
+
+def query_ntp(
+    server: str, port: int = 123, timeout: float = 1.0, version: int = 4
+) -> NTPSample:
+    """
+    Measure the local clock's offset from an NTP server with one SNTP request.
+
+    :param server: The hostname or address of the server.
+    :param port: The server's UDP port.
+    :param timeout: Seconds to wait for the response.
+    :param version: The NTP version of the request.
+    :return: The sample measured.
+    :raises ClockSyncError: If the server does not respond, or its response
+        is invalid.
+    """
+    try:
+        address = socket.getaddrinfo(server, port, 0, socket.SOCK_DGRAM)[0]
+    except OSError as e:
+        raise ClockSyncError(f"Failed to resolve NTP server '{server}': {e}")
+    family, _, _, _, sockaddr = address
+    with socket.socket(family, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        originate = time.time()
+        request_timestamp = _to_ntp(originate)
+        request = NTP_REQUEST.pack(version << 3 | NTP_MODE_CLIENT, request_timestamp)
+        try:
+            sock.sendto(request, sockaddr)
+            while True:
+                data, sender = sock.recvfrom(1024)
+                if sender[:2] == sockaddr[:2]:
+                    break
+        except OSError as e:
+            raise ClockSyncError(f"No response from NTP server '{server}': {e}")
+        destination = time.time()
+        received_monotonic = time.monotonic()
+
+    if len(data) < NTP_PACKET.size:
+        raise ClockSyncError(f"Truncated response from NTP server '{server}'")
+    flags, stratum, *_, echoed, receive, transmit = NTP_PACKET.unpack_from(data)
+    if flags & 0b111 != NTP_MODE_SERVER:
+        raise ClockSyncError(f"Invalid mode in response from NTP server '{server}'")
+    if stratum == 0 or flags >> 6 == 3:
+        # A kiss-o'-death packet, or an unsynchronised server
+        raise ClockSyncError(f"NTP server '{server}' is not synchronised")
+    if echoed != request_timestamp:
+        raise ClockSyncError(f"Response from NTP server '{server}' does not match")
+
+    receive, transmit = _from_ntp(receive), _from_ntp(transmit)
+    return NTPSample(
+        offset=((receive - originate) + (transmit - destination)) / 2,
+        delay=(destination - originate) - (transmit - receive),
+        stratum=stratum,
+        monotonic=received_monotonic,
+    )
+
+
+def get_source_time(properties: Optional[Properties]) -> Optional[float]:
+    """
+    Get the time a message was published, if its publisher sent one.
+
+    :param properties: The MQTT 5 properties of a received message.
+    :return: The time in seconds since the epoch, or None if the message has
+        no valid source time.
+    """
+    for key, value in getattr(properties, "UserProperty", None) or ():
+        if key == SOURCE_TIME_PROPERTY:
+            try:
+                return int(value) / 1e9
+            except ValueError:
+                return None
+    return None
+
+
+class ClockSync:
+    """
+    Estimates the offset of the local clock from NTP servers, polled on a
+    background thread.
+
+    Each poll sends a burst of requests and keeps the sample with the least
+    round trip delay, as its offset is the least disturbed by asymmetric
+    queueing; samples delayed by more than `max_delay` are discarded. The
+    offsets of the last `window` polls are fitted with a line against the
+    monotonic clock, whose slope is the local clock's drift, so the offset is
+    extrapolated between polls rather than held. An offset differing from the
+    fitted line by more than `step_threshold` means the local clock was
+    stepped, and the fit is restarted from that poll.
+
+    One instance is shared by all nodes in a process with the same
+    configuration, see `shared`.
+    """
+
+    _shared: Dict[Tuple, ClockSync] = {}
+    _shared_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: ClockSyncConfig) -> ClockSync:
+        return cls(
+            servers=config.servers,
+            port=config.port,
+            interval=config.interval,
+            burst=config.burst,
+            window=config.window,
+            max_delay=config.max_delay,
+            step_threshold=config.step_threshold,
+            timeout=config.timeout,
+        )
+
+    @classmethod
+    def shared(cls, config: ClockSyncConfig) -> ClockSync:
+        """Get the running instance shared by all nodes with this configuration."""
+        key = (
+            tuple(config.servers),
+            config.port,
+            config.interval,
+            config.burst,
+            config.window,
+            config.max_delay,
+            config.step_threshold,
+            config.timeout,
+        )
+        with cls._shared_lock:
+            clock = cls._shared.get(key)
+            if clock is None:
+                clock = cls._shared[key] = cls.from_config(config)
+                clock.start()
+            return clock
+
+    def __init__(
+        self,
+        servers: Sequence[str] = ("pool.ntp.org",),
+        port: int = 123,
+        interval: float = 64.0,
+        burst: int = 4,
+        window: int = 8,
+        max_delay: float = 0.5,
+        step_threshold: float = 0.128,
+        timeout: float = 1.0,
+    ):
+        """
+        :param servers: NTP servers, tried in order until one responds.
+        :param port: The servers' UDP port.
+        :param interval: Seconds between polls.
+        :param burst: Requests sent per poll.
+        :param window: Number of polls the offset and drift are fitted over.
+        :param max_delay: Samples with a longer round trip are discarded, in seconds.
+        :param step_threshold: A poll's offset differing from the fit by more
+            than this many seconds restarts the fit.
+        :param timeout: Seconds to wait for each response.
+        """
+        if not servers:
+            raise ValueError("At least one NTP server is required")
+        if burst < 1 or window < 1:
+            raise ValueError("burst and window must be positive")
+        self.servers = list(servers)
+        self.port = port
+        self.interval = interval
+        self.burst = burst
+        self.max_delay = max_delay
+        self.step_threshold = step_threshold
+        self.timeout = timeout
+
+        # (monotonic time, offset) of recent polls
+        self._samples: Deque[Tuple[float, float]] = deque(maxlen=window)
+        # Fit of the offset against the monotonic clock: offset at a reference
+        # monotonic time, and drift in seconds per second
+        self._fit: Optional[Tuple[float, float, float]] = None
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.last_sample: Optional[NTPSample] = None
+
+    @property
+    def synchronized(self) -> bool:
+        return self._fit is not None
+
+    @property
+    def drift(self) -> float:
+        """The drift of the local clock, in seconds per second."""
+        fit = self._fit
+        return fit[2] if fit is not None else 0.0
+
+    def offset(self, now: Optional[float] = None) -> float:
+        """
+        Get the estimated offset of the local clock.
+
+        :param now: The monotonic time to estimate the offset at. Defaults to
+            time.monotonic().
+        :return: Seconds to add to time.time() to get the servers' time, or 0.0
+            if no server has been reached yet.
+        """
+        fit = self._fit
+        if fit is None:
+            return 0.0
+        if now is None:
+            now = time.monotonic()
+        reference, offset, drift = fit
+        return offset + drift * (now - reference)
+
+    def time(self) -> float:
+        """The corrected time in seconds since the epoch."""
+        return time.time() + self.offset()
+
+    def time_ns(self) -> int:
+        """The corrected time in nanoseconds since the epoch."""
+        return time.time_ns() + int(self.offset() * 1e9)
+
+    def measure(self) -> NTPSample:
+        """
+        Measure the offset with a burst of requests to the first server to respond.
+
+        :return: The sample with the least delay.
+        :raises ClockSyncError: If no server gave a usable sample.
+        """
+        for server in self.servers:
+            samples = []
+            for _ in range(self.burst):
+                try:
+                    sample = query_ntp(server, self.port, self.timeout)
+                except ClockSyncError:
+                    continue
+                if sample.delay <= self.max_delay:
+                    samples.append(sample)
+            if samples:
+                return min(samples, key=lambda sample: sample.delay)
+        raise ClockSyncError(
+            f"No usable response from NTP servers {', '.join(self.servers)}"
+        )
+
+    def add_sample(self, offset: float, monotonic: float) -> None:
+        """
+        Add a poll's offset to the fit.
+
+        :param offset: The measured offset, in seconds.
+        :param monotonic: The monotonic time it was measured at.
+        """
+        with self._lock:
+            if (
+                self._fit is not None
+                and abs(offset - self.offset(monotonic)) > self.step_threshold
+            ):
+                logger.warning(
+                    "Local clock stepped, restarting clock offset estimation",
+                    extra={"offset": offset, "expected": self.offset(monotonic)},
+                )
+                self._samples.clear()
+            self._samples.append((monotonic, offset))
+            self._fit = self._fit_samples(self._samples)
+
+    @staticmethod
+    def _fit_samples(
+        samples: Sequence[Tuple[float, float]],
+    ) -> Tuple[float, float, float]:
+        # Least squares fit of offset against monotonic time, referenced to the
+        # mean time so the fit is well conditioned
+        n = len(samples)
+        mean_time = sum(t for t, _ in samples) / n
+        mean_offset = sum(o for _, o in samples) / n
+        variance = sum((t - mean_time) ** 2 for t, _ in samples)
+        if variance == 0:
+            return mean_time, mean_offset, 0.0
+        covariance = sum((t - mean_time) * (o - mean_offset) for t, o in samples)
+        return mean_time, mean_offset, covariance / variance
+
+    def sync(self) -> Optional[NTPSample]:
+        """
+        Poll the servers once, and add the sample to the fit.
+
+        :return: The sample, or None if no server gave a usable sample.
+        """
+        try:
+            sample = self.measure()
+        except ClockSyncError as e:
+            logger.warning(str(e))
+            return None
+        self.last_sample = sample
+        self.add_sample(sample.offset, sample.monotonic)
+        logger.debug(
+            f"Clock offset {sample.offset * 1000:.3f} ms",
+            extra={
+                "offset": sample.offset,
+                "delay": sample.delay,
+                "stratum": sample.stratum,
+                "drift": self.drift,
+            },
+        )
+        return sample
+
+    def start(self) -> None:
+        """Start polling the servers every interval on a background thread."""
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="clock_sync", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Stop polling."""
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop_event.is_set():
+            self.sync()
+            self._stop_event.wait(self.interval)
+
+
+def source_time_property(clock: ClockSync) -> Tuple[str, str]:
+    """The user property stamping a message with the current corrected time."""
+    return (SOURCE_TIME_PROPERTY, str(clock.time_ns()))
@@ -1,28 +1,34 @@
-from dataclasses import asdict, dataclass
-from logging.config import dictConfig
+from dataclasses import dataclass, field, fields
 from pathlib import Path
-from typing import Dict, List, Mapping, Optional, Union
+from typing import Dict, List, Mapping, Optional, Tuple, Union
 import logging
+import os
+import threading
 from paho.mqtt.packettypes import PacketTypes
 from paho.mqtt.properties import Properties
 from paho.mqtt.subscribeoptions import SubscribeOptions
 from paho.mqtt.client import MQTT_CLEAN_START_FIRST_ONLY
 import ssl
 
-from config_loader import load_configs
+
+# Maximum number of parsed configurations kept by load_config_cached
+CONFIG_CACHE_SIZE = 32
+_config_cache: Dict[Tuple, Dict] = {}
+_config_cache_lock = threading.Lock()
 
 
 class UnpackMixin(Mapping):
     """A mixin class to unpack dataclass attributes as a mapping."""
 
     def __iter__(self):
-        return iter(asdict(self).keys())
+        # Field names only, as asdict would deep copy every nested value
+        return (f.name for f in fields(self))
 
     def __len__(self):
-        return len(asdict(self))
+        return len(fields(self))
 
     def __getitem__(self, key):
-        if key not in asdict(self):
+        if key not in self.__dataclass_fields__:
             raise KeyError(f"Key {key} not found in {self.__class__.__name__}")
         return getattr(self, key)
 
@@ -65,18 +71,24 @@ class MQTTConnectProperties(MQTTPacketProperties):
 
     _packet_type = PacketTypes.CONNECT
 
-    def __init__(self, session_expiry_interval=0):
+    def __init__(self, session_expiry_interval=0, topic_alias_maximum=0):
         self.session_expiry_interval = session_expiry_interval
+        # The number of topic aliases the broker may use when sending to the node
+        self.topic_alias_maximum = topic_alias_maximum
 
     def validate_properties(self):
         if self.session_expiry_interval < 0:
             raise ValueError(
                 "Session expiry interval must be greater than or equal to 0"
             )
+        if not 0 <= self.topic_alias_maximum <= 65535:
+            raise ValueError("Topic alias maximum must be between 0 and 65535")
 
     def build(self):
         properties = self._build_packet()
         properties.SessionExpiryInterval = self.session_expiry_interval
+        if self.topic_alias_maximum:
+            properties.TopicAliasMaximum = self.topic_alias_maximum
 
         return properties
 
@@ -173,8 +185,110 @@ class LatencyMonitoringConfig:
     request_topic: str = "request"
     response_topic: str = "response"
     qos: int = 1  # MQTT Quality of Service level for latency monitoring
-    interval: int = 10  # How often to check latency (in seconds)
+    interval: float = 10  # Seconds between probes, down to 0.01
     log_enabled: bool = False
+    timeout: float = 5.0  # Seconds before an unanswered probe is counted as lost
+    buckets: List[float] = field(
+        default_factory=lambda: [
+            0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0
+        ]
+    )  # Round trip time histogram buckets, in seconds
+    window: int = 1000  # Number of recent round trips quantiles are taken over
+    mesh: bool = False  # Probe peers discovered from announcements, not this node
+    mesh_fanout: int = 3  # Number of peers each node probes
+    announce_topic: str = "latency/nodes"  # Retained announcements of request topics
+    announce_interval: float = 60.0  # Seconds between announcements. 0 never expires peers
+    matrix_topic: str = "latency/rtt"  # Retained rows of the RTT matrix
+    matrix_interval: float = 1.0  # Minimum seconds between RTT rows published
+
+
+@dataclass
+class MetricsBufferConfig:
+    """Configuration for a bounded metrics buffer."""
+
+    maxlen: int = 0  # Maximum number of buffered metrics. 0 is unbounded
+    policy: str = "drop_oldest"  # drop_oldest | drop_newest | block | spill
+    block_timeout: float = 1.0  # Seconds to wait for room with the block policy
+    spill_path: Optional[str] = None  # File to spill to, e.g. x.jsonl to x/<client id>.jsonl
+    high_watermark: float = 0.8  # Fraction of maxlen which triggers the callback
+
+
+@dataclass
+class FlushPipelineConfig:
+    """Configuration for a pipeline flushing buffered metrics to sinks."""
+
+    enabled: bool = False
+    batch_size: int = 1000  # Maximum number of metrics per batch
+    flush_interval: float = 1.0  # Maximum seconds between flushes
+    max_retries: Optional[int] = 5  # Retries before dropping a batch. None is forever
+    retry_backoff: float = 0.5  # Seconds before the first retry, doubling each retry
+    max_backoff: float = 30  # Maximum seconds between retries
+    sinks: List[Dict] = field(default_factory=list)  # Sink configs, see create_sink
+
+
+@dataclass
+class AggregationConfig:
+    """Configuration for windowed aggregation of received metrics before buffering."""
+
+    enabled: bool = False
+    window: float = 0  # Window in seconds of topics not in windows. 0 is unaggregated
+    windows: Dict[str, float] = field(default_factory=dict)  # Topic filter to window
+    statistics: List[str] = field(
+        default_factory=lambda: ["min", "max", "mean", "count", "last"]
+    )
+    grace: float = 0  # Seconds after a window ends to wait for late samples
+    flush_interval: float = 1.0  # Seconds between checks for ended windows
+
+
+@dataclass
+class DuplicateFilterConfig:
+    """Configuration for suppressing duplicate messages redelivered at QoS 1."""
+
+    enabled: bool = False
+    window: float = 60  # Seconds for which a message is remembered
+    max_entries: int = 100_000  # Maximum number of messages remembered
+    key: str = "auto"  # sequence | hash | auto, which uses sequence numbers if sent
+    sequence_property: str = "seq"  # User property holding sequence numbers
+    dup_only: bool = True  # Only suppress hash-keyed messages with the DUP flag set
+
+
+@dataclass
+class MetricsWALConfig:
+    """Configuration for a write-ahead log of received metrics."""
+
+    path: Optional[str] = None  # Directory of node logs. The log is disabled if None
+    segment_size: int = 64 * 1024 * 1024  # Size in bytes at which segments roll over
+    fsync_batch: int = 10_000  # Sync to disk after this many metrics
+    fsync_interval: float = 0.1  # Or after this many seconds
+
+
+@dataclass
+class OutboundSpoolConfig:
+    """Configuration for a durable spool of messages published while disconnected."""
+
+    path: Optional[str] = None  # Directory of node spools. The spool is disabled if None
+    segment_size: int = 16 * 1024 * 1024  # Size in bytes of each segment file
+    max_bytes: int = 256 * 1024 * 1024  # Oldest segments are evicted past this size
+    fsync_batch: int = 100  # Sync to disk after this many messages
+    fsync_interval: float = 1.0  # Or after this many seconds
+    drain_rate: float = 100  # Messages per second of the backlog replayed on reconnect. 0 is unlimited
+    max_in_flight: int = 100  # Replayed messages awaiting acknowledgement at once
+
+
+@dataclass
+class ClockSyncConfig:
+    """Configuration for estimating the local clock's offset from NTP servers."""
+
+    enabled: bool = False
+    servers: List[str] = field(default_factory=lambda: ["pool.ntp.org"])
+    port: int = 123
+    interval: float = 64.0  # Seconds between polls
+    burst: int = 4  # Requests per poll, of which the least delayed is kept
+    window: int = 8  # Number of polls the offset and drift are fitted over
+    max_delay: float = 0.5  # Samples with a longer round trip are discarded
+    step_threshold: float = 0.128  # Offset change in seconds treated as a clock step
+    timeout: float = 1.0  # Seconds to wait for each response
+    timestamp_messages: bool = True  # Stamp published messages with the source time
 
 
 @dataclass
@@ -220,6 +334,10 @@ class MQTTNodeConfig(UnpackMixin):
     packet_properties: Dict[str, MQTTPacketProperties] = None
     will_config: Optional["MQTTWillConfig"] = None
     status_config: Optional["MQTTStatusConfig"] = None
+    topic_alias_policy: Optional[str] = None
+    topic_alias_min_uses: int = 2
+    spool_config: Optional[OutboundSpoolConfig] = None
+    clock_sync_config: Optional[ClockSyncConfig] = None
 
 
 @dataclass
@@ -228,6 +346,17 @@ class MQTTMetricsNodeConfig(UnpackMixin):
 
     topic_structure: str
     datatype: type = Dict
+    topic_cache_size: int = 1024
+    ingest_workers: int = 0
+    ingest_batch_size: int = 100
+    ingest_batch_interval_ms: float = 50
+    ingest_queue_size: int = 0
+    buffer_config: Optional[MetricsBufferConfig] = None
+    json_backend: str = "auto"
+    wal_config: Optional[MetricsWALConfig] = None
+    flush_config: Optional[FlushPipelineConfig] = None
+    aggregation_config: Optional[AggregationConfig] = None
+    dedupe_config: Optional[DuplicateFilterConfig] = None
 
 
 @dataclass
@@ -271,7 +400,11 @@ def initialize_logging(logging_config: Union[Dict, str]) -> logging.Logger:
         A logger instance.
     """
     if isinstance(logging_config, str):
+        from config_loader import load_configs
+
         logging_config = load_configs(logging_config)
+    from logging.config import dictConfig
+
     dictConfig(logging_config)
     return logging.getLogger("mqtt_node_network")
 
@@ -290,6 +423,9 @@ def initialize_config(
     Returns:
         A dictionary containing node configurations.
     """
+    # Deferred, as config_loader pulls in the TOML and YAML parsers
+    from config_loader import load_configs
+
     config = load_configs(config, secrets_filepath=secrets)
     config = get_nested_value(config, "mqtt")
 
@@ -311,6 +447,9 @@ def initialize_config(
             session_expiry_interval=config["packet_properties"].get(
                 "session_expiry_interval", 0
             ),
+            topic_alias_maximum=config["packet_properties"].get(
+                "topic_alias_maximum", 0
+            ),
         ),
         PacketTypes.PUBLISH: MQTTPublishProperties(
             message_expiry_interval=config["packet_properties"].get(
@@ -331,11 +470,30 @@ def initialize_config(
 
     metrics_node_config = MQTTMetricsNodeConfig(
         topic_structure=config["metrics_node"]["topic_structure"],
+        datatype=config["metrics_node"].get("datatype", Dict),
+        topic_cache_size=config["metrics_node"].get("topic_cache_size", 1024),
+        ingest_workers=config["metrics_node"].get("ingest_workers", 0),
+        ingest_batch_size=config["metrics_node"].get("ingest_batch_size", 100),
+        ingest_batch_interval_ms=config["metrics_node"].get(
+            "ingest_batch_interval_ms", 50
+        ),
+        ingest_queue_size=config["metrics_node"].get("ingest_queue_size", 0),
+        buffer_config=MetricsBufferConfig(**config["metrics_node"].get("buffer", {})),
+        json_backend=config["metrics_node"].get("json_backend", "auto"),
+        wal_config=MetricsWALConfig(**config["metrics_node"].get("wal", {})),
+        flush_config=FlushPipelineConfig(**config["metrics_node"].get("flush", {})),
+        aggregation_config=AggregationConfig(
+            **config["metrics_node"].get("aggregation", {})
+        ),
+        dedupe_config=DuplicateFilterConfig(
+            **config["metrics_node"].get("dedupe", {})
+        ),
     )
+    # Latency settings may be set in [latency_node] or its [latency] table
+    latency_settings = dict(config["latency_node"])
+    latency_settings.update(latency_settings.pop("latency", {}))
     latency_node_config = MQTTLatencyNodeConfig(
-        latency_config=LatencyMonitoringConfig(
-            **config["latency_node"].get("latency", {})
-        )
+        latency_config=LatencyMonitoringConfig(**latency_settings)
     )
 
     will_config = MQTTWillConfig(
@@ -364,6 +522,10 @@ def initialize_config(
         subscribe_config=subscribe_config,
         will_config=will_config,
         status_config=status_config,
+        topic_alias_policy=config["node"].get("topic_alias_policy", None),
+        topic_alias_min_uses=config["node"].get("topic_alias_min_uses", 2),
+        spool_config=OutboundSpoolConfig(**config["node"].get("spool", {})),
+        clock_sync_config=ClockSyncConfig(**config["node"].get("clock_sync", {})),
     )
 
     metrics_node_config = {**dict(node_config), **dict(metrics_node_config)}
@@ -374,3 +536,66 @@ def initialize_config(
         "MQTTMetricsNode": metrics_node_config,
         "MQTTLatencyNode": latency_node_config,
     }
+
+
+def _file_version(path: Union[str, Path]) -> Tuple[str, Optional[int], Optional[int]]:
+    # A file's resolved path, modification time and size. Missing files have
+    # no modification time or size
+    path = Path(path)
+    try:
+        stat = path.stat()
+    except OSError:
+        return (str(path.absolute()), None, None)
+    return (str(path.resolve()), stat.st_mtime_ns, stat.st_size)
+
+
+def load_config_cached(
+    config: Union[str, Path, List[Union[str, Path]]],
+    secrets: Optional[Union[str, Path]] = None,
+) -> Dict:
+    """
+    Initialize the configuration with initialize_config, parsing each version of
+    the configuration files only once.
+
+    Parsed configurations are cached by the path, modification time and size of
+    the configuration and secrets files, and by the environment, as environment
+    variables are substituted into them. Editing a file or changing the
+    environment invalidates them. The node configurations are shared between
+    callers and must not be modified.
+
+    Args:
+        config: The configuration file path or list of configuration file paths.
+        secrets: The secrets file path. Will default to ".env" if not provided.
+
+    Returns:
+        A dictionary containing node configurations.
+    """
+    paths = [config] if isinstance(config, (str, Path)) else list(config)
+    key = _config_cache_key(paths, secrets)
+    with _config_cache_lock:
+        configs = _config_cache.get(key)
+    if configs is None:
+        configs = initialize_config(config=config, secrets=secrets)
+        # Loading the secrets file may have set environment variables
+        loaded_key = _config_cache_key(paths, secrets)
+        with _config_cache_lock:
+            if len(_config_cache) >= CONFIG_CACHE_SIZE - 1:
+                _config_cache.clear()
+            _config_cache[key] = _config_cache[loaded_key] = configs
+    return dict(configs)
+
+
+def _config_cache_key(
+    paths: List[Union[str, Path]], secrets: Optional[Union[str, Path]]
+) -> Tuple:
+    return (
+        tuple(_file_version(path) for path in paths),
+        _file_version(secrets if secrets is not None else ".env"),
+        tuple(sorted(os.environ.items())),
+    )
+
+
+def clear_config_cache() -> None:
+    """Forget all configurations parsed by load_config_cached."""
+    with _config_cache_lock:
+        _config_cache.clear()
@@ -0,0 +1,162 @@
+"""Suppression of duplicate messages redelivered at QoS 1"""
+
+from __future__ import annotations
+from collections import OrderedDict
+import threading
+import time
+from typing import Hashable, Optional
+
+from paho.mqtt.properties import Properties
+
+from mqtt_node_network.configuration import DuplicateFilterConfig
+
+# User property holding a publisher-supplied sequence number
+SEQUENCE_PROPERTY = "seq"
+KEY_MODES = ("auto", "sequence", "hash")
+
+
+def get_sequence_number(
+    properties: Optional[Properties], name: str = SEQUENCE_PROPERTY
+) -> Optional[str]:
+    """
+    Get the sequence number a publisher sent with a message.
+
+    :param properties: The MQTT 5 properties of a received message.
+    :param name: The name of the user property holding the sequence number.
+    :return: The sequence number, or None if the message has none.
+    """
+    for key, value in getattr(properties, "UserProperty", None) or ():
+        if key == name:
+            return value
+    return None
+
+
+class DuplicateFilter:
+    """
+    A bounded, time-windowed set of messages already seen, for suppressing
+    messages a broker redelivers at QoS 1 after a reconnect.
+
+    Messages are keyed by their topic and the sequence number their publisher
+    sent in a user property, or by a hash of their topic and payload. A message
+    is a duplicate if its key was seen within the last `window` seconds.
+
+    Identical payloads are common for metrics, e.g. a temperature holding
+    steady, so with `dup_only` messages keyed by hash are only suppressed if
+    the broker set their DUP flag, marking them as redelivered. Messages with
+    sequence numbers are unique, and are always checked.
+
+    Keys are held in insertion order, so expired keys are removed from the
+    front. At most `max_entries` keys are held, the oldest being forgotten
+    first, which bounds memory however many topics are received.
+    """
+
+    @classmethod
+    def from_config(cls, config: DuplicateFilterConfig) -> DuplicateFilter:
+        return cls(
+            window=config.window,
+            max_entries=config.max_entries,
+            key=config.key,
+            sequence_property=config.sequence_property,
+            dup_only=config.dup_only,
+        )
+
+    def __init__(
+        self,
+        window: float = 60,
+        max_entries: int = 100_000,
+        key: str = "auto",
+        sequence_property: str = SEQUENCE_PROPERTY,
+        dup_only: bool = True,
+    ):
+        """
+        :param window: Seconds for which a message's key is remembered.
+        :param max_entries: The maximum number of keys remembered.
+        :param key: "sequence" to key messages by sequence number, "hash" to key
+            them by a hash of topic and payload, or "auto" to use the sequence
+            number if the message has one and the hash otherwise. Messages
+            without a sequence number pass unchecked with "sequence".
+        :param sequence_property: The user property holding sequence numbers.
+        :param dup_only: Only suppress messages keyed by hash if their DUP flag
+            is set.
+        """
+        if key not in KEY_MODES:
+            raise ValueError(f"Unknown key '{key}'. Must be one of {KEY_MODES}")
+        if max_entries <= 0:
+            raise ValueError("max_entries must be positive")
+        self.window = window
+        self.max_entries = max_entries
+        self.key = key
+        self.sequence_property = sequence_property
+        self.dup_only = dup_only
+        # Key to the time it expires
+        self._seen: OrderedDict[Hashable, float] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+    def __repr__(self) -> str:
+        return (
+            f"{self.__class__.__name__}(window={self.window}, "
+            f"max_entries={self.max_entries}, key={self.key!r})"
+        )
+
+    def message_key(
+        self, topic: str, payload: bytes, properties: Optional[Properties] = None
+    ) -> Optional[Hashable]:
+        """
+        Get the key identifying a message, or None if it has none.
+
+        Hash keys are tagged with None, so they never equal a sequence key.
+        """
+        if self.key != "hash":
+            sequence = get_sequence_number(properties, self.sequence_property)
+            if sequence is not None:
+                return (topic, sequence)
+            if self.key == "sequence":
+                return None
+        return (None, hash((topic, payload)))
+
+    def is_duplicate(
+        self,
+        topic: str,
+        payload: bytes,
+        dup: bool = False,
+        properties: Optional[Properties] = None,
+        now: Optional[float] = None,
+    ) -> bool:
+        """
+        Check whether a message is a duplicate, remembering it if it is not.
+
+        :param topic: The topic of the message.
+        :param payload: The raw payload of the message.
+        :param dup: The message's DUP flag.
+        :param properties: The MQTT 5 properties of the message.
+        :param now: The current monotonic time. Defaults to time.monotonic().
+        """
+        key = self.message_key(topic, payload, properties)
+        if key is None:
+            return False
+        if now is None:
+            now = time.monotonic()
+        seen = self._seen
+        with self._lock:
+            # Forget expired keys, oldest first
+            while seen:
+                oldest_key, expiry = next(iter(seen.items()))
+                if expiry > now:
+                    break
+                del seen[oldest_key]
+
+            expiry = seen.get(key)
+            if expiry is not None:
+                return dup or not self.dup_only or key[0] is not None
+
+            seen[key] = now + self.window
+            if len(seen) > self.max_entries:
+                seen.popitem(last=False)
+        return False
+
+    def clear(self) -> None:
+        with self._lock:
+            self._seen.clear()
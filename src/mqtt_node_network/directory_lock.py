@@ -0,0 +1,40 @@
+"""Exclusive locks on the data directories of spools and logs"""
+
+from __future__ import annotations
+from pathlib import Path
+from typing import BinaryIO
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+LOCK_FILE = "lock"
+
+
+def lock_directory(path: Path) -> BinaryIO:
+    """
+    Take an exclusive lock on a directory, held until the returned file is
+    closed.
+
+    The lock is taken on a lock file in the directory, with flock on POSIX
+    systems and msvcrt.locking on Windows. Both conflict between open files,
+    so a directory is locked against other objects in the same process as
+    well as other processes, and the lock is released if the process dies.
+
+    :param path: The directory to lock, which must exist.
+    :return: The open lock file.
+    :raises OSError: If the directory is already locked.
+    """
+    file = open(path / LOCK_FILE, "a+b")
+    try:
+        if fcntl is not None:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            file.seek(0)
+            msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        file.close()
+        raise
+    return file
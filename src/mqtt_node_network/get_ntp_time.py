@@ -1,19 +1,19 @@
-import ntplib
-from time import ctime
+from time import ctime, time
 
-# Note that this module is not currently used in the project
-# It is included here as an example of how to get NTP time
-# It is intended to be used for future development
+from mqtt_node_network.clock_sync import query_ntp
+
+# A one-off query of an NTP server. Nodes estimate their clock offset
+# continuously with mqtt_node_network.clock_sync.ClockSync
 
 
 def get_ntp_time(server="pool.ntp.org"):
     try:
-        client = ntplib.NTPClient()
-        response = client.request(server, version=3)
+        response = query_ntp(server)
+        unix_time = time() + response.offset
         # Return the NTP time with the highest accuracy
         return {
-            "unix_time": response.tx_time,  # Time in seconds since epoch
-            "formatted_time": ctime(response.tx_time),  # Human-readable time
+            "unix_time": unix_time,  # Time in seconds since epoch
+            "formatted_time": ctime(unix_time),  # Human-readable time
             "offset": response.offset,  # Offset between server and local clock
             "stratum": response.stratum,  # Stratum level (indicates the server accuracy)
             "delay": response.delay,  # Round trip delay in seconds
@@ -5,18 +5,26 @@
 # Created Date: 2023-01-23
 # version ='1.0'
 # ---------------------------------------------------------------------------
-"""a_short_module_description"""
+"""A node measuring round trip latency through the MQTT broker"""
 # ---------------------------------------------------------------------------
 from __future__ import annotations
+from bisect import bisect_left, insort
+from collections import OrderedDict, deque
+import heapq
+import itertools
+import json
 import logging
+import math
+import struct
 import threading
-from typing import NoReturn, Optional
+from typing import Deque, Dict, List, Optional, Sequence, Tuple
 import time
 import copy
+import zlib
 
 from paho.mqtt.packettypes import PacketTypes
 from paho.mqtt.properties import Properties
-from prometheus_client import Gauge
+from prometheus_client import Counter, Gauge, Histogram
 
 from mqtt_node_network.configuration import (
     LatencyMonitoringConfig,
@@ -24,16 +32,211 @@ from mqtt_node_network.configuration import (
     SubscribeConfig,
     MQTTPacketProperties,
 )
-from mqtt_node_network.node import MQTTNode, dict_to_user_properties
+from mqtt_node_network.node import MQTTNode
 
 
 # Initialize your logger and adapter
 logger = logging.getLogger(__name__)
 
+# Payload of a latency probe, echoed unchanged in its pong: the sequence number
+# and the originator's monotonic clock in nanoseconds when it was sent
+PROBE_FORMAT = struct.Struct("!QQ")
+DEFAULT_QUANTILES = (0.5, 0.9, 0.99, 0.999)
+# Sequence numbers of lost probes remembered, to recognise their late pongs
+MAX_LOST_PROBES = 1024
+# Number of slots each probe interval is divided into
+PROBE_SLOTS = 1000
+# Announce intervals after which a peer not announced again is dropped
+ANNOUNCE_EXPIRY_INTERVALS = 3
 
-class LatencyNode(MQTTNode):
+
+class RollingQuantiles:
+    """
+    Exact quantiles over a rolling window of the most recent samples.
+
+    Samples are kept both in arrival order, to evict the oldest, and in sorted
+    order, so a quantile is read by indexing. Adding a sample costs O(window),
+    which is negligible at probe rates.
+    """
+
+    def __init__(self, window: int = 1000):
+        """
+        :param window: The number of most recent samples quantiles are taken over.
+        """
+        if window <= 0:
+            raise ValueError("window must be positive")
+        self.window = window
+        self._samples: Deque[float] = deque()
+        self._sorted: List[float] = []
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def add(self, value: float) -> None:
+        with self._lock:
+            self._samples.append(value)
+            insort(self._sorted, value)
+            if len(self._samples) > self.window:
+                oldest = self._samples.popleft()
+                del self._sorted[bisect_left(self._sorted, oldest)]
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        Get a quantile of the window, interpolating between samples.
+
+        :param q: The quantile, from 0 to 1.
+        :return: The quantile, or None if there are no samples.
+        """
+        if not 0 <= q <= 1:
+            raise ValueError("q must be between 0 and 1")
+        with self._lock:
+            if not self._sorted:
+                return None
+            position = q * (len(self._sorted) - 1)
+            lower = int(position)
+            upper = min(lower + 1, len(self._sorted) - 1)
+            fraction = position - lower
+            return (
+                self._sorted[lower]
+                + (self._sorted[upper] - self._sorted[lower]) * fraction
+            )
+
+    def quantiles(
+        self, qs: Sequence[float] = DEFAULT_QUANTILES
+    ) -> Dict[float, Optional[float]]:
+        return {q: self.quantile(q) for q in qs}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._samples.clear()
+            self._sorted.clear()
+
+
+class ProbeScheduler:
+    """
+    Runs the probe rounds of many latency nodes from a single timer thread.
+
+    Each node's round runs once per interval, in one of PROBE_SLOTS slots of
+    the interval chosen by a hash of its node_id, so the rounds of a fleet of
+    nodes in one process are staggered over the interval rather than sent in a
+    burst, and no node needs a thread of its own.
+    """
+
+    _default: Optional[ProbeScheduler] = None
+    _default_lock = threading.Lock()
+
+    @classmethod
+    def default(cls) -> ProbeScheduler:
+        """Get the scheduler shared by all latency nodes in the process."""
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls()
+            return cls._default
+
+    def __init__(self):
+        # Heap of (due time, insertion count, node, interval)
+        self._heap: List[Tuple[float, int, MQTTLatencyNode, float]] = []
+        self._counter = itertools.count()
+        # Nodes scheduled, mapped to the insertion count of their entry
+        self._scheduled: Dict[MQTTLatencyNode, int] = {}
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    def __len__(self) -> int:
+        return len(self._scheduled)
+
+    def __contains__(self, node: object) -> bool:
+        return node in self._scheduled
+
+    @staticmethod
+    def slot_offset(node_id: str, interval: float) -> float:
+        """The offset of a node's slot from the start of each interval."""
+        slot = zlib.crc32(node_id.encode()) % PROBE_SLOTS
+        return interval * slot / PROBE_SLOTS
+
+    def add(self, node: MQTTLatencyNode, interval: float) -> None:
+        """Run a node's probe round every `interval` seconds, in its slot."""
+        now = time.monotonic()
+        due = now - now % interval + self.slot_offset(node.node_id, interval)
+        if due <= now:
+            due += interval
+        with self._condition:
+            count = next(self._counter)
+            self._scheduled[node] = count
+            heapq.heappush(self._heap, (due, count, node, interval))
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="latency_probe_scheduler", daemon=True
+                )
+                self._thread.start()
+            self._condition.notify()
+
+    def remove(self, node: MQTTLatencyNode) -> None:
+        """Stop running a node's probe rounds. Its entry is skipped when due."""
+        with self._condition:
+            self._scheduled.pop(node, None)
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while True:
+                    # Drop entries of removed nodes
+                    while self._heap and (
+                        self._scheduled.get(self._heap[0][2]) != self._heap[0][1]
+                    ):
+                        heapq.heappop(self._heap)
+                    if not self._heap:
+                        self._condition.wait()
+                        continue
+                    delay = self._heap[0][0] - time.monotonic()
+                    if delay <= 0:
+                        break
+                    self._condition.wait(delay)
+                due, count, node, interval = heapq.heappop(self._heap)
+                # Skip rounds missed while the process was busy
+                now = time.monotonic()
+                due += interval * max(1, int((now - due) // interval) + 1)
+                heapq.heappush(self._heap, (due, count, node, interval))
+            try:
+                node.run_probe_round()
+            except Exception as e:
+                node.logger.error(f"Error during latency probe round: {e}")
+
+
+class MQTTLatencyNode(MQTTNode):
     """
     A subclass of MQTTNode that includes latency monitoring functionality.
+
+    The node periodically publishes a probe to its request topic, and answers
+    probes on that topic with a pong on their response topic. A probe is a
+    16 byte payload packing its sequence number and the time it was sent by the
+    originator's monotonic clock, which the pong echoes unchanged, so the round
+    trip is measured on one clock which is not stepped by NTP, and neither side
+    formats or parses strings. Probes are published with properties built once
+    per node. The round trip time of each pong is observed in a Prometheus
+    histogram, and in a rolling window from which quantiles can be read with
+    `latency_quantiles`.
+
+    A probe not answered within `timeout` seconds is counted as lost. If its
+    pong arrives later, it is counted as late rather than observed, so losses
+    that were only delays are lost_total - late_total.
+
+    In mesh mode, the node instead probes other nodes. Each node announces its
+    request topic in a retained message on "<announce_topic>/<node_id>", and
+    discovers its peers from the announcements of others. Nodes announce
+    themselves again every `announce_interval` seconds, and a peer not heard
+    from for ANNOUNCE_EXPIRY_INTERVALS intervals is dropped, as is its retained
+    announcement by the broker, so a node which crashed without withdrawing its
+    announcement is no longer probed. Peers are arranged in a ring ordered by
+    node_id, and each node probes the `mesh_fanout` peers
+    following it, so every node is probed by as many peers as it probes and
+    probe traffic grows as fanout x nodes. After each round the node publishes
+    its row of the RTT matrix, the median round trip to each probed peer in
+    milliseconds, retained on "<matrix_topic>/<node_id>", at most every
+    `matrix_interval` seconds.
+
+    Probe rounds of all nodes in a process are run by one ProbeScheduler.
     """
 
     node_client_to_client_latency = Gauge(
@@ -42,6 +245,28 @@ class LatencyNode(MQTTNode):
         labelnames=("node_id", "node_name", "node_type", "host"),
     )
 
+    node_latency_probes_sent_count = Counter(
+        "node_latency_probes_sent_total",
+        "Total number of latency probes sent by node",
+        labelnames=("node_id", "node_name", "node_type", "host"),
+    )
+
+    node_latency_probes_lost_count = Counter(
+        "node_latency_probes_lost_total",
+        "Total number of latency probes not answered within the timeout",
+        labelnames=("node_id", "node_name", "node_type", "host"),
+    )
+
+    node_latency_pongs_late_count = Counter(
+        "node_latency_pongs_late_total",
+        "Total number of latency pongs received after their probe's timeout",
+        labelnames=("node_id", "node_name", "node_type", "host"),
+    )
+
+    # Created by the first node, as buckets cannot change once registered
+    node_latency_round_trip: Optional[Histogram] = None
+    _histogram_lock = threading.Lock()
+
     def __init__(
         self,
         broker_config: MQTTBrokerConfig,
@@ -49,37 +274,81 @@ class LatencyNode(MQTTNode):
         node_id: Optional[str] = None,
         subscribe_config: SubscribeConfig = None,
         latency_config: LatencyMonitoringConfig = None,
-        properties: dict[str, MQTTPacketProperties] = None,
+        packet_properties: dict[str, MQTTPacketProperties] = None,
+        **kwargs,
     ):
         """
-        Initialize an MQTTNode instance.
+        Initialize an MQTTLatencyNode instance.
 
         :param broker_config: The configuration for the MQTT broker.
         :param name: The name of the node.
         :param node_id: A unique identifier for the node (optional).
         :param subscribe_config: Configuration for subscribed topics.
         :param latency_config: Configuration for latency monitoring.
+        :param packet_properties: MQTT packet properties, see MQTTNode.
+        :param kwargs: Additional keyword arguments passed to MQTTNode.
         """
         super().__init__(
             broker_config=broker_config,
             name=name,
             node_id=node_id,
             subscribe_config=subscribe_config,
-            properties=properties,
+            packet_properties=packet_properties,
+            **kwargs,
         )
         # Set latency metrics
-        self._latency_thread = None
-        self._stop_event = threading.Event()
+        self.probe_scheduler: Optional[ProbeScheduler] = None
         self.latency_config = copy.deepcopy(latency_config) or LatencyMonitoringConfig()
         self.latency_config.response_topic = (
-            f"{self.client_id}/{self.latency_config.response_topic}"
+            f"{self.node_id}/{self.latency_config.response_topic}"
         )
         self.latency_config.request_topic = (
-            f"{self.client_id}/{self.latency_config.request_topic}"
+            f"{self.node_id}/{self.latency_config.request_topic}"
         )
+
+        labels = (self.node_id, self.name, self.node_type, self.hostname)
+        self._latency_gauge = self.node_client_to_client_latency.labels(*labels)
+        self._probes_sent = self.node_latency_probes_sent_count.labels(*labels)
+        self._probes_lost = self.node_latency_probes_lost_count.labels(*labels)
+        self._pongs_late = self.node_latency_pongs_late_count.labels(*labels)
+        self._round_trip = self._round_trip_histogram(
+            self.latency_config.buckets
+        ).labels(*labels)
+        self.round_trip_quantiles = RollingQuantiles(self.latency_config.window)
+
+        # Round trips to each peer, in mesh mode
+        self.peer_round_trips: Dict[str, RollingQuantiles] = {}
+        # Request topics of the peers discovered, by node_id, and the monotonic
+        # time each was last announced
+        self.peers: Dict[str, str] = {}
+        self._peers_announced: Dict[str, float] = {}
+        self._last_announced: Optional[float] = None
+        self.probe_targets: List[str] = []
+        self._peers_lock = threading.Lock()
+
+        # Sequence number of each probe awaiting its pong, mapped to the
+        # monotonic time in nanoseconds it was sent and the node_id it was sent to
+        self._pending_probes: OrderedDict[int, Tuple[int, str]] = OrderedDict()
+        self._lost_probes: OrderedDict[int, None] = OrderedDict()
+        self._probe_sequence = 0
+        self._probe_lock = threading.Lock()
+        self._last_row_published: Optional[float] = None
+
+        # Properties of probes and pongs, built once rather than for every probe
+        self._probe_properties = Properties(PacketTypes.PUBLISH)
+        self._probe_properties.ResponseTopic = self.latency_config.response_topic
+        self._pong_properties = Properties(PacketTypes.PUBLISH)
+        self._announce_properties = Properties(PacketTypes.PUBLISH)
+        if self.latency_config.announce_interval > 0:
+            # The broker discards the retained announcement of a node which
+            # stopped announcing itself
+            self._announce_properties.MessageExpiryInterval = math.ceil(
+                self.latency_config.announce_interval * ANNOUNCE_EXPIRY_INTERVALS
+            )
+
         # Subscribe to latency monitoring topics
-        self.subscriptions.append(self.latency_config.response_topic)
-        self.subscriptions.append(self.latency_config.request_topic)
+        self.add_subscription_topic(self.latency_config.response_topic)
+        self.add_subscription_topic(self.latency_config.request_topic)
 
         # Add callbacks for latency monitoring to take action when these messages are received
         self.client.message_callback_add(
@@ -89,81 +358,344 @@ class LatencyNode(MQTTNode):
             self.latency_config.request_topic, self._send_latency_response
         )
 
-    def start_periodic_latency_check(self):
-        # Periodically send ping and publish latency
-        if self._latency_thread and self._latency_thread.is_alive():
-            self.logger.warning(
-                f"Thread '{self.node_id}-latency_thread' already exists"
+        if self.latency_config.mesh:
+            announcements = f"{self.latency_config.announce_topic}/+"
+            self.add_subscription_topic(announcements)
+            self.client.message_callback_add(announcements, self._update_peer)
+
+    @classmethod
+    def _round_trip_histogram(cls, buckets: Sequence[float]) -> Histogram:
+        with cls._histogram_lock:
+            histogram = MQTTLatencyNode.node_latency_round_trip
+            if histogram is None:
+                histogram = MQTTLatencyNode.node_latency_round_trip = Histogram(
+                    "node_latency_round_trip_seconds",
+                    "Round trip time of latency probes through the MQTT broker",
+                    labelnames=("node_id", "node_name", "node_type", "host"),
+                    buckets=buckets,
+                )
+            elif tuple(float(b) for b in buckets) != tuple(
+                histogram._upper_bounds[:-1]
+            ):
+                logger.warning(
+                    "Latency histogram already registered with other buckets. "
+                    "Ignoring the configured buckets",
+                    extra={"buckets": list(buckets)},
+                )
+            return histogram
+
+    def start_periodic_latency_check(
+        self, scheduler: Optional[ProbeScheduler] = None
+    ) -> None:
+        """
+        Start running a probe round every interval.
+
+        :param scheduler: The scheduler to run the rounds. Defaults to the
+            scheduler shared by all latency nodes in the process.
+        """
+        if self.probe_scheduler is not None:
+            self.logger.warning("Latency monitoring already started")
+            return
+        self.logger.info(
+            "Starting latency monitoring",
+            extra={"interval": self.latency_config.interval},
+        )
+        self.probe_scheduler = scheduler or ProbeScheduler.default()
+        self.probe_scheduler.add(self, self.latency_config.interval)
+
+    def stop_periodic_latency_check(self) -> None:
+        """Stop running probe rounds, and withdraw the node's mesh announcement."""
+        if self.probe_scheduler is None:
+            return
+        self.logger.info("Stopping latency monitoring")
+        self.probe_scheduler.remove(self)
+        self.probe_scheduler = None
+        if self.latency_config.mesh and self.is_connected():
+            self.publish(
+                f"{self.latency_config.announce_topic}/{self.node_id}",
+                payload=None,
+                qos=1,
+                retain=True,
             )
+
+    def run_probe_round(self) -> None:
+        """
+        Count unanswered probes as lost, then probe this node's targets: its
+        peers in mesh mode, or itself. In mesh mode, the node is announced again
+        and peers not announced recently are dropped, every `announce_interval`,
+        and the node's row of the RTT matrix is published first, if
+        `matrix_interval` has passed since it was last published.
+        """
+        self.expire_probes()
+        if not self.latency_config.mesh:
+            self._send_latency_request()
             return
+        now = time.monotonic()
+        announce_interval = self.latency_config.announce_interval
+        if announce_interval > 0 and (
+            self._last_announced is None
+            or now - self._last_announced >= announce_interval
+        ):
+            self.expire_peers(now)
+            if self.is_connected():
+                self.announce()
+        if (
+            self._last_row_published is None
+            or now - self._last_row_published >= self.latency_config.matrix_interval
+        ):
+            self._last_row_published = now
+            self.publish_rtt_row()
+        with self._peers_lock:
+            targets = [(peer, self.peers[peer]) for peer in self.probe_targets]
+        for peer, request_topic in targets:
+            self._send_latency_request(peer, request_topic)
 
-        def periodic_request() -> NoReturn:
-            while not self._stop_event.is_set():
-                try:
-                    self._send_latency_request()
-                except Exception as e:
-                    self.logger.error(f"Error during latency request: {e}")
-                time.sleep(self.latency_config.interval)
+    def rtt_row(self) -> Dict[str, float]:
+        """
+        Get this node's row of the RTT matrix: the median round trip in
+        milliseconds to each peer with round trips in the window.
+        """
+        with self._peers_lock:
+            peer_round_trips = list(self.peer_round_trips.items())
+        row = {}
+        for peer, round_trips in peer_round_trips:
+            median = round_trips.quantile(0.5)
+            if median is not None:
+                row[peer] = round(median * 1000, 3)
+        return row
 
-        # Start a new thread
-        self.logger.info(
-            "Starting latency monitoring thread",
-            extra={
-                "thread_name": f"{self.node_id}-latency_thread",
-            },
+    def publish_rtt_row(self):
+        """Publish this node's row of the RTT matrix, retained."""
+        payload = json.dumps(
+            {"t": round(time.time(), 3), "rtt_ms": self.rtt_row()},
+            separators=(",", ":"),
         )
-        self._stop_event.clear()
-        self._latency_thread = threading.Thread(
-            target=periodic_request,
-            name=f"{self.node_id}-latency_thread",
-            daemon=True,  # Optional: Make thread a daemon so it stops with the main program
+        return self.publish(
+            f"{self.latency_config.matrix_topic}/{self.node_id}",
+            payload=payload,
+            qos=0,
+            retain=True,
         )
-        self._latency_thread.start()
 
-    def stop_periodic_latency_check(self):
-        # Stop the periodic latency check thread
-        if self._latency_thread and self._latency_thread.is_alive():
-            self.logger.info(
-                "Stopping latency monitoring thread",
-                extra={
-                    "thread_name": f"{self.node_id}-latency_thread",
-                },
+    def _select_probe_targets(self) -> None:
+        # Called with the peers lock held. Probe the peers following this node
+        # in a ring ordered by node_id
+        ring = sorted(set(self.peers) | {self.node_id})
+        start = ring.index(self.node_id)
+        fanout = min(self.latency_config.mesh_fanout, len(ring) - 1)
+        self.probe_targets = [
+            ring[(start + offset) % len(ring)] for offset in range(1, fanout + 1)
+        ]
+        for peer in list(self.peer_round_trips):
+            if peer not in self.probe_targets:
+                del self.peer_round_trips[peer]
+
+    def announce(self) -> None:
+        """Announce this node's request topic to its mesh peers, retained."""
+        self._last_announced = time.monotonic()
+        self.publish(
+            f"{self.latency_config.announce_topic}/{self.node_id}",
+            payload=json.dumps({"request_topic": self.latency_config.request_topic}),
+            qos=1,
+            retain=True,
+            properties=self._announce_properties,
+        )
+
+    def expire_peers(self, now: Optional[float] = None) -> int:
+        """
+        Drop peers not announced for ANNOUNCE_EXPIRY_INTERVALS announce intervals.
+
+        :param now: The current monotonic time. Defaults to time.monotonic().
+        :return: The number of peers dropped.
+        """
+        if now is None:
+            now = time.monotonic()
+        expiry = self.latency_config.announce_interval * ANNOUNCE_EXPIRY_INTERVALS
+        with self._peers_lock:
+            expired = [
+                peer
+                for peer, announced in self._peers_announced.items()
+                if now - announced > expiry
+            ]
+            if not expired:
+                return 0
+            for peer in expired:
+                del self.peers[peer]
+                del self._peers_announced[peer]
+            self._select_probe_targets()
+        self.logger.warning(
+            f"Dropped {len(expired)} latency mesh peer(s) not announced "
+            f"for {expiry}s",
+            extra={"peers": expired},
+        )
+        return len(expired)
+
+    def latency_quantiles(
+        self, qs: Sequence[float] = DEFAULT_QUANTILES
+    ) -> Dict[float, Optional[float]]:
+        """
+        Get quantiles of the round trip time over the most recent probes.
+
+        :param qs: The quantiles to get, from 0 to 1.
+        :return: A mapping of each quantile to a round trip time in seconds, or
+            to None if no pong has been received.
+        """
+        return self.round_trip_quantiles.quantiles(qs)
+
+    def expire_probes(self, now: Optional[float] = None) -> int:
+        """
+        Count probes unanswered for longer than the timeout as lost.
+
+        :param now: The current monotonic time. Defaults to time.monotonic().
+        :return: The number of probes counted as lost.
+        """
+        if now is None:
+            now = time.monotonic()
+        deadline = int((now - self.latency_config.timeout) * 1e9)
+        expired = []
+        with self._probe_lock:
+            # Probes are pending in the order they were sent
+            while self._pending_probes:
+                sequence, (sent, _) = next(iter(self._pending_probes.items()))
+                if sent > deadline:
+                    break
+                del self._pending_probes[sequence]
+                self._lost_probes[sequence] = None
+                expired.append(sequence)
+            while len(self._lost_probes) > MAX_LOST_PROBES:
+                self._lost_probes.popitem(last=False)
+        if expired:
+            self._probes_lost.inc(len(expired))
+            self.logger.warning(
+                f"{len(expired)} latency probe(s) unanswered after "
+                f"{self.latency_config.timeout}s",
+                extra={"sequences": expired},
             )
-            self._stop_event.set()
-            self._latency_thread.join()
+        return len(expired)
 
     # Callbacks
     # ***************************************************************************
 
-    def _send_latency_request(self):
-        # Send a ping message and attach the time sent as a user property
-        properties = Properties(PacketTypes.PUBLISH)
-        properties.ResponseTopic = self.latency_config.response_topic
-        properties.UserProperty = dict_to_user_properties(
-            {"node_id": self.node_id, "time_sent": str(time.time())}
-        )
+    def _send_latency_request(
+        self, target: Optional[str] = None, request_topic: Optional[str] = None
+    ) -> int:
+        # Send a probe to a node's request topic, by default this node's,
+        # tracked by its sequence number
+        target = target or self.node_id
+        request_topic = request_topic or self.latency_config.request_topic
+        with self._probe_lock:
+            self._probe_sequence += 1
+            sequence = self._probe_sequence
+            sent = time.monotonic_ns()
+            self._pending_probes[sequence] = (sent, target)
 
         self.publish(
-            self.latency_config.request_topic,
-            payload="ping",
+            request_topic,
+            payload=PROBE_FORMAT.pack(sequence, sent),
             qos=self.latency_config.qos,
-            properties=properties,
+            properties=self._probe_properties,
         )
+        self._probes_sent.inc()
+        return sequence
 
     def _send_latency_response(self, client, userdata, message):
-        # Send a response message with the same properties as the request
-        properties = Properties(PacketTypes.PUBLISH)
-        properties.UserProperty = message.properties.UserProperty
-        # Add the time the message was received
-        properties.UserProperty.append(("time_received", str(time.time())))
+        # Echo the probe's payload to its response topic
+        properties = self._pong_properties
+        user_properties = getattr(message.properties, "UserProperty", None)
+        if user_properties:
+            # Probes of earlier versions are matched by their user properties
+            properties = Properties(PacketTypes.PUBLISH)
+            properties.UserProperty = list(user_properties)
 
         self.publish(
             message.properties.ResponseTopic,
-            payload="pong",
+            payload=message.payload,
             qos=self.latency_config.qos,
             properties=properties,
         )
 
+    def _update_latency_metric(self, client, userdata, message):
+        # Observe the round trip time of a pong, matched to its probe
+        received = time.monotonic_ns()
+        try:
+            sequence, sent = PROBE_FORMAT.unpack(message.payload)
+        except (struct.error, TypeError):
+            self.logger.warning(
+                f"Ignoring invalid latency response on topic '{message.topic}'"
+            )
+            return
+        with self._probe_lock:
+            probe = self._pending_probes.get(sequence)
+            if probe is not None and probe[0] == sent:
+                del self._pending_probes[sequence]
+                late = False
+            else:
+                # A pong to a probe of an earlier session has the same sequence
+                # number, but not the same send time
+                probe = None
+                late = self._lost_probes.pop(sequence, False) is None
+        if probe is None:
+            if late:
+                self._pongs_late.inc()
+            else:
+                self.logger.debug(f"Ignoring unexpected latency response #{sequence}")
+            return
+
+        target = probe[1]
+        round_trip = (received - sent) / 1e9
+        self._round_trip.observe(round_trip)
+        self._latency_gauge.set(round_trip)
+        self.round_trip_quantiles.add(round_trip)
+        if target != self.node_id:
+            with self._peers_lock:
+                if target in self.probe_targets:
+                    peer_round_trips = self.peer_round_trips.get(target)
+                    if peer_round_trips is None:
+                        peer_round_trips = self.peer_round_trips[target] = (
+                            RollingQuantiles(self.latency_config.window)
+                        )
+                    peer_round_trips.add(round_trip)
+        if self.latency_config.log_enabled:
+            self.logger.info(
+                f"Latency probe #{sequence} round trip {round_trip * 1000:.3f} ms",
+                extra={"sequence": sequence, "round_trip": round_trip},
+            )
+
+    def _update_peer(self, client, userdata, message):
+        # Add or remove a peer from its retained announcement
+        peer = message.topic.rsplit("/", 1)[-1]
+        if peer == self.node_id:
+            return
+        request_topic = None
+        if message.payload:
+            try:
+                request_topic = json.loads(message.payload)["request_topic"]
+            except (ValueError, KeyError, TypeError):
+                self.logger.warning(
+                    f"Ignoring invalid latency announcement on topic '{message.topic}'"
+                )
+                return
+        with self._peers_lock:
+            if request_topic is None:
+                self._peers_announced.pop(peer, None)
+                if self.peers.pop(peer, None) is None:
+                    return
+            else:
+                self._peers_announced[peer] = time.monotonic()
+                if self.peers.get(peer) == request_topic:
+                    return
+                self.peers[peer] = request_topic
+            self._select_probe_targets()
+            targets = list(self.probe_targets)
+        self.logger.debug(
+            f"Latency mesh has {len(self.peers)} peer(s)", extra={"targets": targets}
+        )
+
+    def on_connect(self, client, userdata, flags, reason_code, properties):
+        super().on_connect(client, userdata, flags, reason_code, properties)
+        if reason_code == 0 and self.latency_config.mesh:
+            self.announce()
+
     def __del__(self):
         try:
             self.stop_periodic_latency_check()
@@ -171,3 +703,7 @@ class LatencyNode(MQTTNode):
             # Nothing to disconnect
             pass
         super().__del__()
+
+
+# Previous name of MQTTLatencyNode
+LatencyNode = MQTTLatencyNode
@@ -0,0 +1,158 @@
+"""Conversion of metrics to InfluxDB line protocol"""
+
+from __future__ import annotations
+from types import MappingProxyType
+from typing import Dict, Iterable, List, Mapping, Union
+
+# Multipliers from seconds to each timestamp precision
+PRECISIONS = {"s": 1, "ms": 1_000, "us": 1_000_000, "ns": 1_000_000_000}
+
+_MEASUREMENT_ESCAPES = str.maketrans({",": r"\,", " ": r"\ "})
+_KEY_ESCAPES = str.maketrans({",": r"\,", "=": r"\=", " ": r"\ "})
+_STRING_ESCAPES = str.maketrans({'"': r"\"", "\\": r"\\"})
+
+
+def escape_measurement(measurement: str) -> str:
+    return measurement.translate(_MEASUREMENT_ESCAPES)
+
+
+def escape_key(key: str) -> str:
+    """Escape a tag key, tag value or field key."""
+    return key.translate(_KEY_ESCAPES)
+
+
+def format_field_value(value: Union[str, int, float, bool]) -> str:
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, int):
+        return f"{value}i"
+    if isinstance(value, float):
+        return repr(value)
+    return f'"{str(value).translate(_STRING_ESCAPES)}"'
+
+
+def format_metric(metric: Mapping, precision: str = "ns") -> str:
+    """
+    Format a metric as a line of InfluxDB line protocol, without a newline.
+
+    :param metric: A metric mapping with measurement, fields, time and tags.
+    :param precision: The timestamp precision: "s", "ms", "us" or "ns".
+    """
+    line = escape_measurement(metric["measurement"])
+    for key, value in sorted(metric["tags"].items()):
+        line += f",{escape_key(key)}={escape_key(str(value))}"
+    fields = ",".join(
+        f"{escape_key(key)}={format_field_value(value)}"
+        for key, value in metric["fields"].items()
+    )
+    timestamp = int(round(metric["time"] * PRECISIONS[precision]))
+    return f"{line} {fields} {timestamp}"
+
+
+def format_metrics(metrics: Iterable[Mapping], precision: str = "ns") -> str:
+    """Format metrics as InfluxDB line protocol, one line per metric."""
+    return "".join(format_metric(metric, precision) + "\n" for metric in metrics)
+
+
+class LineProtocolSerializer:
+    """
+    Serializes whole batches of metrics to InfluxDB line protocol.
+
+    The escaped measurement and tag set of each series, along with the field key
+    for single-field metrics, are formatted once and cached, so repeated series
+    only cost formatting their value and timestamp. Tags shared between metrics,
+    such as the read-only mappings MetricRecord shares per topic, are cached by
+    identity, and other tags by value. Lines are collected in a single reusable
+    buffer, so a serializer should be used by one thread at a time.
+
+    Metrics are dictionaries, or objects with measurement, fields, time and tags
+    attributes such as Metric and MetricRecord. The output is the same as
+    format_metrics.
+    """
+
+    def __init__(self, precision: str = "ns", cache_size: int = 65536):
+        """
+        :param precision: The timestamp precision: "s", "ms", "us" or "ns".
+        :param cache_size: The maximum number of cached series prefixes. The
+            cache is cleared when it is full.
+        """
+        if precision not in PRECISIONS:
+            raise ValueError(
+                f"Unknown precision '{precision}'. Must be one of {tuple(PRECISIONS)}"
+            )
+        self.precision = precision
+        self.cache_size = cache_size
+        self._multiplier = PRECISIONS[precision]
+        self._prefixes: Dict[tuple, str] = {}
+        # Keeps tags cached by identity alive, so their ids are not reused
+        self._pinned: Dict[int, Mapping] = {}
+        self._buffer: List[str] = []
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(precision={self.precision!r})"
+
+    def _prefix(self, key: tuple, measurement: str, tags: Mapping, field_key) -> str:
+        if len(self._prefixes) >= self.cache_size:
+            self._prefixes.clear()
+            self._pinned.clear()
+        prefix = escape_measurement(measurement)
+        for tag_key, tag_value in sorted(tags.items()):
+            prefix += f",{escape_key(tag_key)}={escape_key(str(tag_value))}"
+        prefix += " "
+        if field_key is not None:
+            prefix += f"{escape_key(field_key)}="
+        if type(tags) is MappingProxyType:
+            self._pinned[id(tags)] = tags
+        self._prefixes[key] = prefix
+        return prefix
+
+    def serialize(self, metrics: Iterable[Mapping]) -> bytes:
+        """Serialize metrics to UTF-8 line protocol, one line per metric."""
+        buffer = self._buffer
+        buffer.clear()
+        append = buffer.append
+        prefixes = self._prefixes
+        multiplier = self._multiplier
+        for metric in metrics:
+            if type(metric) is dict:
+                measurement = metric["measurement"]
+                tags = metric["tags"]
+                fields = metric["fields"]
+                metric_time = metric["time"]
+            else:
+                # Metric and MetricRecord attributes skip their __getitem__
+                measurement = metric.measurement
+                tags = metric.tags
+                fields = metric.fields
+                metric_time = metric.time
+            tags_key = (
+                id(tags) if type(tags) is MappingProxyType else tuple(tags.items())
+            )
+            timestamp = round(metric_time * multiplier)
+
+            if len(fields) == 1:
+                ((field_key, value),) = fields.items()
+                key = (measurement, tags_key, field_key)
+                prefix = prefixes.get(key)
+                if prefix is None:
+                    prefix = self._prefix(key, measurement, tags, field_key)
+                value_type = type(value)
+                if value_type is float:
+                    append(f"{prefix}{value!r} {timestamp}\n")
+                elif value_type is int:
+                    append(f"{prefix}{value}i {timestamp}\n")
+                else:
+                    append(f"{prefix}{format_field_value(value)} {timestamp}\n")
+            else:
+                key = (measurement, tags_key, None)
+                prefix = prefixes.get(key)
+                if prefix is None:
+                    prefix = self._prefix(key, measurement, tags, None)
+                field_set = ",".join(
+                    f"{escape_key(field_key)}={format_field_value(value)}"
+                    for field_key, value in fields.items()
+                )
+                append(f"{prefix}{field_set} {timestamp}\n")
+        data = "".join(buffer).encode("utf-8")
+        buffer.clear()
+        return data
@@ -1,25 +1,61 @@
 from __future__ import annotations
 from collections import deque
-from dataclasses import asdict, dataclass, field
-import json
-from typing import Dict, List, Optional, Union, Type, Deque
+from dataclasses import dataclass, field
+from pathlib import Path
+from types import MappingProxyType
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Mapping,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+    Type,
+    Deque,
+)
 from collections.abc import MutableMapping
+import queue
+import threading
 import time
 import logging
-from prometheus_client import Counter
-
-from mqtt_node_network.node import MQTTNode
+from prometheus_client import Counter, Gauge, Histogram
+
+from paho.mqtt.properties import Properties
+
+from mqtt_node_network.node import MQTTNode, get_snapshot_fields, node_data_path
+from mqtt_node_network.clock_sync import get_source_time
+from mqtt_node_network.topic_structure import TopicStructure, parse_topic
+from mqtt_node_network.aggregation import WindowedAggregator
+from mqtt_node_network.dedupe import DuplicateFilter
+from mqtt_node_network.buffer import BoundedMetricsBuffer
+from mqtt_node_network.decoders import PayloadDecoder
+from mqtt_node_network.sinks import MetricsFlushPipeline, MetricsSink
+from mqtt_node_network.wal import MetricsWAL
 from mqtt_node_network.configuration import (
+    AggregationConfig,
+    ClockSyncConfig,
+    DuplicateFilterConfig,
+    FlushPipelineConfig,
+    MetricsBufferConfig,
+    MetricsWALConfig,
     MQTTBrokerConfig,
     MQTTStatusConfig,
     MQTTWillConfig,
     SubscribeConfig,
     MQTTPacketProperties,
+    OutboundSpoolConfig,
 )
 
 logger = logging.getLogger(__name__)
 
 
+METRIC_KEYS = ("measurement", "fields", "time", "tags")
+_METRIC_KEY_SET = frozenset(METRIC_KEYS)
+
+
 @dataclass
 class Metric(MutableMapping):
     measurement: str
@@ -28,7 +64,9 @@ class Metric(MutableMapping):
     tags: Dict[str, str] = field(default_factory=dict)
 
     def __getitem__(self, key: str) -> Union[str, int, float, dict]:
-        return asdict(self)[key]
+        if key not in _METRIC_KEY_SET:
+            raise KeyError(key)
+        return getattr(self, key)
 
     def __setitem__(self, key: str, value: Union[str, int, float, dict]) -> None:
         setattr(self, key, value)
@@ -42,85 +80,140 @@ class Metric(MutableMapping):
             raise KeyError(f"{key} is not a valid attribute of Metric")
 
     def __iter__(self) -> iter:
-        return iter(asdict(self))
+        return iter(METRIC_KEYS)
 
     def __len__(self) -> int:
-        return len(asdict(self))
+        return len(METRIC_KEYS)
 
 
-def parse_topic(
-    topic: str, structure: str, field_separator: str = "-"
-) -> Dict[str, str]:
+class MetricRecord(Mapping):
     """
-    Parse a topic string into a dictionary based on a given structure.
+    A compact, immutable metric.
 
-    Args:
-        topic: The topic string to parse.
-        structure: The structure template to match against the topic.
-        field_separator: Separator for multi-part fields. Defaults to "-".
-
-    Returns:
-        A dictionary mapping structure fields to topic parts.
+    Offers the same read-only mapping interface as Metric, but stores its values
+    in __slots__ instead of an instance dictionary. Records parsed from the same
+    topic share a single read-only tags mapping.
     """
-    topic_parts = topic.rstrip("/").split("/")
-    structure_parts = structure.rstrip("/").split("/")
-    len_diff = len(topic_parts) - len(structure_parts)
-    if structure_parts[-1].endswith("*"):
-        len_field = len_diff + 1
-        structure_parts[-1] = structure_parts[-1][:-1]
-    else:
-        if len_diff <= 0:
-            len_field = 1
-        else:
-            message = f"Metric not processed. Topic is too long for the given structure"
-            extra = {"topic": topic, "structure": structure}
-            logger.error(message, extra=extra)
-            raise ValueError(f"{message}; {extra}")
 
-    if len_field <= 0 or len_diff < 0:
-        message = f"Metric not processed. Topic is too short for the given structure"
-        extra = {"topic": topic, "structure": structure}
-        logger.error(message, extra=extra)
-        raise ValueError(f"{message}; {extra}")
+    __slots__ = METRIC_KEYS
 
-    other_parts = topic_parts[:-len_field]
-    field_parts = topic_parts[-len_field:]
+    def __init__(
+        self,
+        measurement: str,
+        fields: Dict[str, Union[int, float, str]],
+        time: Union[float, int],
+        tags: Optional[Mapping[str, str]] = None,
+    ):
+        setattr_ = object.__setattr__
+        setattr_(self, "measurement", measurement)
+        setattr_(self, "fields", fields)
+        setattr_(self, "time", time)
+        setattr_(self, "tags", MappingProxyType({}) if tags is None else tags)
 
-    parsed_dict = dict(zip(structure_parts, other_parts))
-    parsed_dict[structure_parts[-1]] = field_separator.join(field_parts)
+    def __getitem__(self, key: str) -> Union[str, int, float, Mapping]:
+        if key not in _METRIC_KEY_SET:
+            raise KeyError(key)
+        return getattr(self, key)
 
-    return parsed_dict
+    def __iter__(self) -> iter:
+        return iter(METRIC_KEYS)
+
+    def __len__(self) -> int:
+        return len(METRIC_KEYS)
+
+    def __setattr__(self, key, value):
+        raise AttributeError(f"{self.__class__.__name__} is immutable")
+
+    def __delattr__(self, key):
+        raise AttributeError(f"{self.__class__.__name__} is immutable")
+
+    def __reduce__(self):
+        return (
+            self.__class__,
+            (self.measurement, self.fields, self.time, dict(self.tags)),
+        )
+
+    def __repr__(self) -> str:
+        return (
+            f"{self.__class__.__name__}(measurement={self.measurement!r}, "
+            f"fields={self.fields!r}, time={self.time!r}, tags={dict(self.tags)!r})"
+        )
+
+    def to_dict(self) -> Dict:
+        """Return the metric as a plain dictionary."""
+        return {
+            "measurement": self.measurement,
+            "fields": self.fields,
+            "time": self.time,
+            "tags": dict(self.tags),
+        }
 
 
 def parse_payload_to_metric(
-    value: Union[int, float, str], topic: str, structure: str
-) -> Union[Metric, Dict, None]:
+    value: Union[int, float, str],
+    topic: str,
+    structure: Union[str, TopicStructure],
+    metric_time: Optional[float] = None,
+    datatype: Type = dict,
+) -> Union[Metric, MetricRecord, Dict, None]:
     """
-    Convert a payload and topic into a Metric object or dictionary.
+    Convert a payload and topic into a metric of the requested type.
 
     Args:
         value: The payload value (e.g., int, float, or string).
         topic: The topic string associated with the value.
-        structure: The expected structure of the topic.
+        structure: The expected structure of the topic, as a string or a
+            compiled TopicStructure.
+        metric_time: The time to stamp the metric with. Defaults to now.
+        datatype: The type of metric to return. A plain dictionary, MetricRecord,
+            or any type accepting the metric keys as keyword arguments. Defaults to dict.
 
     Returns:
-        A Metric object or dictionary, or None if parsing fails.
+        A metric of type `datatype`, or None if parsing fails.
     """
     try:
-        parsed_topic = parse_topic(topic, structure)
+        if isinstance(structure, TopicStructure):
+            parsed_topic, tags = structure.parse_with_tags(topic)
+        else:
+            parsed_topic = parse_topic(topic, structure)
+            tags = None
     except ValueError as e:
         logger.error(
             f"Failed to parse topic: {e}",
             extra={"topic": topic, "structure": structure},
         )
         return None
-    measurement = parsed_topic.pop("measurement")
-    fields = {parsed_topic.pop("field"): value}
-    metric_time = time.time()
-    tags = parsed_topic
-    return asdict(
-        Metric(measurement=measurement, fields=fields, time=metric_time, tags=tags)
-    )
+    measurement = parsed_topic["measurement"]
+    fields = {parsed_topic["field"]: value}
+    if metric_time is None:
+        metric_time = time.time()
+    if tags is None:
+        tags = {
+            key: value
+            for key, value in parsed_topic.items()
+            if key != "measurement" and key != "field"
+        }
+
+    if datatype is MetricRecord:
+        return MetricRecord(measurement, fields, metric_time, tags)
+
+    metric = {
+        "measurement": measurement,
+        "fields": fields,
+        "time": metric_time,
+        "tags": dict(tags),
+    }
+    if datatype is dict or datatype is Dict:
+        return metric
+    return datatype(**metric)
+
+
+# Metric types which can be selected by name with the `datatype` option
+METRIC_DATATYPES = {
+    "dict": dict,
+    "metric": Metric,
+    "record": MetricRecord,
+}
 
 
 class MQTTMetricsNode(MQTTNode):
@@ -151,6 +244,33 @@ class MQTTMetricsNode(MQTTNode):
         labelnames=("measurement", "field"),
     )
 
+    metric_ingest_queue_depth = Gauge(
+        "metric_ingest_queue_depth",
+        "Number of received messages waiting to be parsed by a metric node",
+        labelnames=("node_id", "node_name", "node_type", "host"),
+    )
+
+    metric_ingest_batch_latency = Histogram(
+        "metric_ingest_batch_latency_seconds",
+        "Time taken to parse and buffer a batch of received messages",
+        labelnames=("node_id", "node_name", "node_type", "host"),
+    )
+
+    metric_duplicates_suppressed_count = Counter(
+        "metric_duplicates_suppressed_total",
+        "Total number of duplicate messages suppressed by a metric node",
+        labelnames=("node_id", "node_name", "node_type", "host"),
+    )
+
+    metric_one_way_latency = Histogram(
+        "metric_one_way_latency_seconds",
+        "Time from a message's source timestamp to its receipt by a metric node",
+        labelnames=("node_id", "node_name", "node_type", "host"),
+        buckets=(
+            0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+        ),
+    )
+
     def __init__(
         self,
         name: str,
@@ -163,6 +283,24 @@ class MQTTMetricsNode(MQTTNode):
         status_config: Optional[MQTTStatusConfig] = None,
         datatype: Optional[Type] = dict,
         packet_properties: dict[str, MQTTPacketProperties] = None,
+        topic_cache_size: int = 1024,
+        ingest_workers: int = 0,
+        ingest_batch_size: int = 100,
+        ingest_batch_interval_ms: float = 50,
+        ingest_queue_size: int = 0,
+        buffer_config: Optional[MetricsBufferConfig] = None,
+        on_high_watermark: Optional[Callable[[BoundedMetricsBuffer], Any]] = None,
+        decoder: Optional[PayloadDecoder] = None,
+        json_backend: str = "auto",
+        topic_alias_policy: Optional[str] = None,
+        topic_alias_min_uses: int = 2,
+        spool_config: Optional[OutboundSpoolConfig] = None,
+        wal_config: Optional[MetricsWALConfig] = None,
+        flush_config: Optional[FlushPipelineConfig] = None,
+        sinks: Optional[List[MetricsSink]] = None,
+        aggregation_config: Optional[AggregationConfig] = None,
+        dedupe_config: Optional[DuplicateFilterConfig] = None,
+        clock_sync_config: Optional[ClockSyncConfig] = None,
     ):
         """
         Initialize the MQTTMetricsNode.
@@ -175,7 +313,50 @@ class MQTTMetricsNode(MQTTNode):
             buffer: An optional buffer for storing parsed metrics (e.g., a list or deque).
             subscribe_config: Configuration for subscription topics.
             latency_config: Configuration for latency monitoring.
-            datatype: The expected type for parsed metrics. Defaults to dict.
+            datatype: The type of parsed metrics, or its name in METRIC_DATATYPES.
+                Defaults to dict. MetricRecord uses the least memory per metric.
+            topic_cache_size: Maximum number of parsed topics to cache. Defaults to 1024.
+            ingest_workers: Number of threads parsing messages off the network
+                thread. Defaults to 0, which parses messages inline in on_message.
+            ingest_batch_size: Maximum number of messages parsed per batch.
+            ingest_batch_interval_ms: Maximum time to wait for a batch to fill, in milliseconds.
+            ingest_queue_size: Maximum number of queued messages. 0 is unbounded.
+            buffer_config: Configuration for a bounded buffer, used when no buffer
+                is given. Each node spills to its own file, named after its
+                client id in a directory named after the spill path. Defaults
+                to an unbounded deque.
+            on_high_watermark: Called with the buffer when a bounded buffer fills
+                past its high watermark, so the application can throttle.
+            decoder: The decoder used to convert raw payloads into values.
+                Defaults to a PayloadDecoder using `json_backend`.
+            json_backend: The JSON backend for the default decoder: "json",
+                "orjson", or "auto" to use the fastest installed.
+            topic_alias_policy: "lru" or "lfu" to use MQTT 5 topic aliases when
+                publishing. See MQTTNode.
+            topic_alias_min_uses: Publishes before a topic is given an alias.
+            spool_config: Configuration for a durable spool of messages published
+                while disconnected. See MQTTNode.
+            wal_config: Configuration for a write-ahead log of received metrics.
+                Metrics are logged before they are buffered, and any not yet
+                committed with `commit_metrics` are replayed into the buffer on
+                startup. Each node logs to a subdirectory of the path named
+                after its client id. Defaults to no log.
+            flush_config: Configuration for a pipeline flushing the buffer to
+                sinks in batches on a background thread. The pipeline is started
+                if the config is enabled, or if `sinks` are given.
+            sinks: Sinks for the flush pipeline, overriding those in flush_config.
+            aggregation_config: Configuration for aggregating metrics over
+                tumbling windows per topic before they are buffered, so one
+                metric per series per window is buffered instead of every
+                sample. See WindowedAggregator. Defaults to no aggregation.
+            dedupe_config: Configuration for suppressing duplicate messages, such
+                as those redelivered at QoS 1 after a reconnect. See
+                DuplicateFilter. Defaults to no suppression.
+            clock_sync_config: Configuration for estimating the local clock's
+                offset from NTP servers. See MQTTNode. Metrics of messages
+                carrying a source time are stamped with it, whether or not the
+                node's clock is synchronised, and the time between the source
+                time and the corrected receive time is observed as one-way latency.
         """
         super().__init__(
             broker_config,
@@ -185,56 +366,457 @@ class MQTTMetricsNode(MQTTNode):
             packet_properties=packet_properties,
             will_config=will_config,
             status_config=status_config,
+            topic_alias_policy=topic_alias_policy,
+            topic_alias_min_uses=topic_alias_min_uses,
+            spool_config=spool_config,
+            clock_sync_config=clock_sync_config,
         )
 
-        self.buffer = buffer if buffer else deque()
-        self.datatype = datatype
+        # Nodes built from one configuration keep their files apart by client id
+        client_id = self.name or self.node_id
+        if buffer is not None:
+            self.buffer = buffer
+        elif buffer_config is not None and buffer_config.maxlen > 0:
+            spill_path = None
+            if buffer_config.spill_path:
+                # e.g. data/metrics-spill/<client id>.jsonl
+                spill_path = Path(buffer_config.spill_path)
+                spill_path = node_data_path(
+                    spill_path.with_suffix(""), client_id
+                ).with_suffix(spill_path.suffix)
+            self.buffer = BoundedMetricsBuffer.from_config(
+                buffer_config,
+                name=self.node_id,
+                on_high_watermark=on_high_watermark,
+                factory=self.make_metric,
+                spill_path=spill_path,
+            )
+        else:
+            self.buffer = deque()
+        self.datatype = (
+            METRIC_DATATYPES[datatype] if isinstance(datatype, str) else datatype
+        )
         self.topic_structure = topic_structure
+        self.topic_parser = TopicStructure(
+            topic_structure, cache_size=topic_cache_size
+        )
+
+        self.decoder = decoder or PayloadDecoder(
+            json_backend=json_backend, max_learned_topics=topic_cache_size
+        )
+
+        self._one_way_latency = self.metric_one_way_latency.labels(
+            self.node_id, self.name, self.node_type, self.hostname
+        )
+        self.dedupe: Optional[DuplicateFilter] = None
+        if dedupe_config is not None and dedupe_config.enabled:
+            self.dedupe = DuplicateFilter.from_config(dedupe_config)
+
+        self.wal: Optional[MetricsWAL] = None
+        # Keeps the log and the buffer in the same order
+        self._wal_lock = threading.Lock()
+        # LSNs of logged metrics not yet committed, with the id of each metric,
+        # in the order they were added to the buffer
+        self._wal_lsns: Deque[Tuple[int, int]] = deque()
+        # LSNs of buffered metrics by metric id, to find those the buffer drops
+        self._wal_buffered: Dict[int, int] = {}
+        # LSNs of metrics dropped by the buffer, and those not yet committed
+        self._wal_dropped: Set[int] = set()
+        self._wal_drops: List[int] = []
+        if wal_config is not None and wal_config.path:
+            self.wal = MetricsWAL.from_config(
+                wal_config, path=node_data_path(wal_config.path, client_id)
+            )
+            if isinstance(self.buffer, BoundedMetricsBuffer):
+                self.buffer.on_drop = self._drop_logged_metric
+            self.replay_wal()
+
+        self.flush_pipeline: Optional[MetricsFlushPipeline] = None
+        if sinks or (flush_config is not None and flush_config.enabled):
+            self.start_flush_pipeline(flush_config, sinks)
+
+        self.aggregator: Optional[WindowedAggregator] = None
+        self._aggregation_thread: Optional[threading.Thread] = None
+        self._aggregation_stop_event = threading.Event()
+        if aggregation_config is not None and aggregation_config.enabled:
+            self.aggregator = WindowedAggregator.from_config(
+                aggregation_config,
+                factory=self.make_metric,
+                name=self.node_id,
+            )
+            self.start_aggregation(aggregation_config.flush_interval)
+
+        self.ingest_workers = ingest_workers
+        self.ingest_batch_size = ingest_batch_size
+        self.ingest_batch_interval = ingest_batch_interval_ms / 1000
+        self.ingest_queue_size = ingest_queue_size
+        self._ingest_queue: Optional[queue.Queue] = None
+        # Held while queueing a message, so none is queued once the workers stop
+        self._ingest_lock = threading.Lock()
+        self._ingest_threads: List[threading.Thread] = []
+        self._ingest_stop_event = threading.Event()
+        if self.ingest_workers > 0:
+            self.start_ingest_workers()
 
     def on_message(self, metric, userdata, message):
         """
         Handle incoming MQTT messages, parse them into metrics, and store in the buffer.
 
+        Duplicate messages are dropped before they are counted or parsed, if the
+        node has a duplicate filter.
+
+        If ingestion workers are running, the raw message is only queued here and
+        is parsed later off the network thread. Payloads are decoded with the codec
+        named by the message's Content Type property, if it has one.
+
         Args:
             metric: The metric to process.
             userdata: User-specific data passed during message receipt.
             message: The MQTT message object.
         """
+        if self.dedupe is not None and self.dedupe.is_duplicate(
+            message.topic, message.payload, message.dup, message.properties
+        ):
+            self.metric_duplicates_suppressed_count.labels(
+                self.node_id, self.name, self.node_type, self.hostname
+            ).inc()
+            self.logger.debug(
+                f"Suppressed duplicate message on topic '{message.topic}'",
+                extra={"topic": message.topic, "dup": message.dup},
+            )
+            return
+
         super().on_message(metric, userdata, message)
 
-        data = message.payload.decode()
-        if message.payload is None:
-            logger.debug(
-                f"Null message ignored. Received None on topic '{message.topic}'"
-            )
+        with self._ingest_lock:
+            ingest_queue = self._ingest_queue
+            if ingest_queue is not None:
+                ingest_queue.put(
+                    (
+                        message.topic,
+                        message.payload,
+                        message.qos,
+                        time.time(),
+                        message.properties,
+                    )
+                )
+                return
+
+        metrics = self.process_message(
+            message.topic, message.payload, properties=message.properties
+        )
+        if metrics:
+            self.store_metrics(metrics)
+
+    def store_metrics(self, metrics: List[Union[Metric, MetricRecord, Dict]]) -> None:
+        """
+        Add parsed metrics to the buffer, logging them to the write-ahead log first
+        if the node has one.
+        """
+        if self.wal is None:
+            self.buffer.extend(metrics)
+        else:
+            with self._wal_lock:
+                self._buffer_logged(self.wal.append(metrics), metrics)
+        if self.flush_pipeline is not None:
+            self.flush_pipeline.notify()
+
+    def replay_wal(self) -> int:
+        """
+        Add metrics left uncommitted in the write-ahead log to the buffer.
+
+        Returns:
+            The number of metrics replayed.
+        """
+        entries = self.wal.replay_entries()
+        metrics = [metric for _, metric in entries]
+        if self.datatype is not dict and self.datatype is not Dict:
+            metrics = [
+                self.make_metric(m["measurement"], m["fields"], m["time"], m["tags"])
+                for m in metrics
+            ]
+        with self._wal_lock:
+            for (lsn, _), metric in zip(entries, metrics):
+                self._buffer_logged(lsn, [metric])
+        if metrics:
+            self.logger.info(f"Replayed {len(metrics)} metrics from the write-ahead log")
+        return len(metrics)
+
+    def make_metric(
+        self,
+        measurement: str,
+        fields: Dict[str, Union[int, float, str]],
+        metric_time: float,
+        tags: Mapping[str, str],
+    ) -> Union[Metric, MetricRecord, Dict]:
+        """Create a metric of the node's datatype."""
+        if self.datatype is MetricRecord:
+            if type(tags) is not MappingProxyType:
+                tags = MappingProxyType(dict(tags))
+            return MetricRecord(measurement, fields, metric_time, tags)
+        metric = {
+            "measurement": measurement,
+            "fields": fields,
+            "time": metric_time,
+            "tags": dict(tags),
+        }
+        if self.datatype is dict or self.datatype is Dict:
+            return metric
+        return self.datatype(**metric)
+
+    def start_aggregation(self, flush_interval: float = 1.0) -> None:
+        """
+        Start a thread buffering the aggregation windows which have ended, every
+        `flush_interval` seconds, so series which stop reporting are still emitted.
+        """
+        if self._aggregation_thread is not None:
+            self.logger.warning("Aggregation already running")
             return
+        self._aggregation_stop_event.clear()
 
-        elif isinstance(message.payload, bytes):
-            data = message.payload.decode()
+        def run():
+            while not self._aggregation_stop_event.wait(flush_interval):
+                try:
+                    self.flush_aggregates()
+                except Exception as e:
+                    self.logger.error(f"Failed to flush aggregation windows: {e}")
 
-        if data == "nan":
-            logger.debug(
-                f"Null message ignored. Received 'nan' on topic '{message.topic}'"
-            )
+        self._aggregation_thread = threading.Thread(
+            target=run, name=f"{self.node_id}-aggregation_thread", daemon=True
+        )
+        self._aggregation_thread.start()
+        self.logger.info(
+            "Started windowed aggregation", extra={"aggregator": repr(self.aggregator)}
+        )
+
+    def stop_aggregation(self, timeout: Optional[float] = None) -> None:
+        """Stop the aggregation thread and buffer every open window."""
+        if self._aggregation_thread is not None:
+            self._aggregation_stop_event.set()
+            self._aggregation_thread.join(timeout=timeout)
+            self._aggregation_thread = None
+        if self.aggregator is not None:
+            self.flush_aggregates(force=True)
+
+    def flush_aggregates(self, force: bool = False) -> int:
+        """
+        Buffer the aggregation windows which have ended.
+
+        Args:
+            force: Buffer every open window, whether or not it has ended.
+
+        Returns:
+            The number of metrics buffered.
+        """
+        if self.aggregator is None:
+            return 0
+        metrics = self.aggregator.flush() if force else self.aggregator.collect()
+        if metrics:
+            self.store_metrics(metrics)
+        return len(metrics)
+
+    def start_flush_pipeline(
+        self,
+        flush_config: Optional[FlushPipelineConfig] = None,
+        sinks: Optional[List[MetricsSink]] = None,
+    ) -> MetricsFlushPipeline:
+        """
+        Start flushing the buffer to sinks in batches on a background thread.
+        Batches written by every sink are committed in the write-ahead log, if
+        the node has one, and batches a sink dropped are left to be replayed.
+
+        Args:
+            flush_config: The batching and retry configuration, and the sinks to
+                create if none are given. Defaults to FlushPipelineConfig().
+            sinks: The sinks to flush to.
+        """
+        if self.flush_pipeline is not None and self.flush_pipeline.is_running():
+            self.logger.warning("Flush pipeline already running")
+            return self.flush_pipeline
+        self.flush_pipeline = MetricsFlushPipeline.from_config(
+            self.buffer,
+            flush_config or FlushPipelineConfig(),
+            sinks=sinks,
+            on_flushed=self.commit_metrics,
+            on_dropped=self.abandon_metrics,
+            name=f"{self.node_id}-flush",
+        ).start()
+        self.logger.info(
+            f"Started flush pipeline to {len(self.flush_pipeline.sinks)} sink(s)",
+            extra={"sinks": [sink.name for sink in self.flush_pipeline.sinks]},
+        )
+        return self.flush_pipeline
+
+    def stop_flush_pipeline(self, timeout: Optional[float] = None) -> None:
+        """Stop the flush pipeline, flushing the metrics still buffered."""
+        if self.flush_pipeline is not None:
+            self.flush_pipeline.stop(timeout=timeout)
+            self.flush_pipeline = None
+
+    def _buffer_logged(self, first_lsn: int, metrics: List) -> None:
+        # Called with the WAL lock held. Buffer metrics logged from first_lsn,
+        # tracking the LSN of each until it is committed
+        for lsn, metric in enumerate(metrics, first_lsn):
+            self._wal_lsns.append((lsn, id(metric)))
+            self._wal_buffered[id(metric)] = lsn
+        self.buffer.extend(metrics)
+        if len(self._wal_drops) >= self.wal.fsync_batch:
+            self._commit_drops()
+
+    def _commit_drops(self) -> None:
+        # Called with the WAL lock held. Metrics the buffer discarded will never
+        # be flushed. As each commit syncs the commit file, they are committed
+        # with the next flushed metrics, or once fsync_batch have been dropped
+        drops, self._wal_drops = self._wal_drops, []
+        self.wal.commit_lsns(drops)
+
+    def _drop_logged_metric(self, metric) -> None:
+        # Called by the buffer with each metric its overflow policy discards
+        lsn = self._wal_buffered.pop(id(metric), None)
+        if lsn is not None:
+            self._wal_dropped.add(lsn)
+            self._wal_drops.append(lsn)
+
+    def _take_logged(self, count: int) -> List[int]:
+        # Called with the WAL lock held. The LSNs of the next `count` metrics
+        # taken from the buffer
+        lsns = []
+        while len(lsns) < count and self._wal_lsns:
+            lsn, key = self._wal_lsns.popleft()
+            if lsn in self._wal_dropped:
+                self._wal_dropped.discard(lsn)
+                continue
+            if self._wal_buffered.get(key) == lsn:
+                del self._wal_buffered[key]
+            lsns.append(lsn)
+        return lsns
+
+    def commit_metrics(self, count: int) -> None:
+        """
+        Commit metrics in the write-ahead log once a consumer has flushed them.
+
+        Metrics are committed in the order they were added to the buffer,
+        skipping those the buffer dropped, so a consumer taking `count` metrics
+        from the front of the buffer commits `count` after flushing them. The
+        metrics the buffer dropped since the last commit are committed with
+        them. Metrics not committed are replayed into the buffer when the node
+        restarts. Does nothing if the node has no log.
+        """
+        if self.wal is None:
             return
+        with self._wal_lock:
+            lsns = self._take_logged(count) + self._wal_drops
+            self._wal_drops = []
+        self.wal.commit_lsns(lsns)
 
-        if isinstance(data, str):
-            try:
-                data = json.loads(data)
-            except json.JSONDecodeError:
-                logger.debug("Message is not JSON. Attempting to parse as a string")
-                pass
+    def abandon_metrics(self, count: int) -> None:
+        """
+        Skip metrics a consumer took from the buffer but failed to flush.
+
+        They are left uncommitted in the write-ahead log, so they are replayed
+        into the buffer when the node restarts, while the metrics following
+        them can still be committed. Does nothing if the node has no log.
+        """
+        if self.wal is not None:
+            with self._wal_lock:
+                self._take_logged(count)
 
-        if not isinstance(data, (str, int, float)):
+    def process_message(
+        self,
+        topic: str,
+        payload: Optional[bytes],
+        receive_time: Optional[float] = None,
+        properties: Optional[Properties] = None,
+    ) -> List[Union[Metric, MetricRecord, Dict]]:
+        """
+        Decode a raw MQTT payload and parse it into metrics.
+
+        A payload holding a single value produces one metric. A snapshot payload,
+        holding an object of field values (see MQTTNode.publish_snapshot), is
+        expanded into one metric per field, as if each value had been published
+        on the topic "<topic>/<field>".
+
+        Args:
+            topic: The topic the message was received on.
+            payload: The raw message payload.
+            receive_time: The time the message was received. Defaults to now.
+            properties: The MQTT 5 properties of the message. The Content Type
+                property names the codec to decode the payload with. Metrics
+                are stamped with the message's source time, if it carries one.
+
+        Returns:
+            A list of metrics of type `datatype`, empty if the message is ignored.
+            If the node aggregates metrics, these are the aggregation windows
+            closed by the message's metrics, along with any metrics on topics
+            which are not aggregated.
+        """
+        if payload is None:
+            logger.debug(f"Null message ignored. Received None on topic '{topic}'")
+            return []
+
+        if payload == b"nan" or payload == "nan":
+            logger.debug(f"Null message ignored. Received 'nan' on topic '{topic}'")
+            return []
+
+        metric_time = receive_time
+        if self.clock is not None:
+            if metric_time is None:
+                metric_time = time.time()
+            metric_time += self.clock.offset()
+        source_time = get_source_time(properties)
+        if source_time is not None:
+            received = time.time() if metric_time is None else metric_time
+            # A negative latency is clock error rather than latency
+            if received >= source_time:
+                self._one_way_latency.observe(received - source_time)
+            metric_time = source_time
+
+        if isinstance(payload, str):
+            payload = payload.encode()
+        content_type = getattr(properties, "ContentType", None)
+        try:
+            data = self.decoder.decode(topic, payload, content_type)
+        except ValueError as e:
             logger.error(
-                f"Message is not a valid type. Received '{type(data)}' on topic '{message.topic}'"
+                f"Failed to decode message on topic '{topic}': {e}",
+                extra={"topic": topic, "content_type": content_type},
             )
-            return
+            return []
+
+        if isinstance(data, (str, int, float)):
+            values = ((topic, data),)
+        else:
+            if isinstance(data, list):
+                # Binary snapshots carry their field names in a user property
+                field_names = get_snapshot_fields(properties)
+                if field_names is not None and len(field_names) == len(data):
+                    data = dict(zip(field_names, data))
+            if not isinstance(data, dict):
+                logger.error(
+                    f"Message is not a valid type. Received '{type(data)}' on topic '{topic}'"
+                )
+                return []
+            values = [(f"{topic}/{key}", value) for key, value in data.items()]
+
+        metrics = []
+        payload_bytes = len(payload) / len(values) if values else 0
+        for metric_topic, value in values:
+            if not isinstance(value, (str, int, float)):
+                logger.error(
+                    f"Message is not a valid type. Received '{type(value)}' on topic '{metric_topic}'"
+                )
+                continue
+
+            metric = parse_payload_to_metric(
+                value=value,
+                topic=metric_topic,
+                structure=self.topic_parser,
+                metric_time=metric_time,
+                datatype=self.datatype,
+            )
+            if not metric:
+                continue
 
-        metric = parse_payload_to_metric(
-            value=data, topic=message.topic, structure=self.topic_structure
-        )
-        if metric:
             for metric_field in metric["fields"].keys():
                 self.metric_messages_received_count.labels(
                     measurement=metric["measurement"],
@@ -243,8 +825,129 @@ class MQTTMetricsNode(MQTTNode):
                 self.metric_bytes_received_count.labels(
                     measurement=metric["measurement"],
                     field=metric_field,
-                ).inc(len(message.payload))
+                ).inc(payload_bytes)
+            if self.aggregator is None:
+                metrics.append(metric)
+            else:
+                metrics.extend(self.aggregator.add(metric_topic, metric))
+
+        return metrics
+
+    def process_batch(
+        self, messages: List[Tuple[str, bytes, int, float, Optional[Properties]]]
+    ) -> int:
+        """
+        Parse a batch of queued messages and append the results to the buffer.
 
-            if not isinstance(metric, self.datatype):
-                metric = self.datatype(**metric)
-            self.buffer.append(metric)
+        Args:
+            messages: A list of (topic, payload, qos, receive_time, properties) tuples.
+
+        Returns:
+            The number of metrics added to the buffer.
+        """
+        metrics = []
+        for topic, payload, _qos, receive_time, properties in messages:
+            metrics.extend(
+                self.process_message(topic, payload, receive_time, properties)
+            )
+        if metrics:
+            self.store_metrics(metrics)
+        return len(metrics)
+
+    def start_ingest_workers(self) -> None:
+        """Start the worker threads which drain the ingest queue in batches."""
+        if self._ingest_threads:
+            self.logger.warning("Ingest workers already running")
+            return
+
+        if self._ingest_queue is None:
+            self._ingest_queue = queue.Queue(maxsize=self.ingest_queue_size)
+        self._ingest_stop_event.clear()
+        # Read when scraped, so the depth is current however busy the workers are
+        self.metric_ingest_queue_depth.labels(
+            self.node_id, self.name, self.node_type, self.hostname
+        ).set_function(self._ingest_queue_depth)
+
+        for i in range(self.ingest_workers):
+            thread = threading.Thread(
+                target=self._ingest_worker,
+                name=f"{self.node_id}-ingest_thread-{i}",
+                daemon=True,
+            )
+            self._ingest_threads.append(thread)
+            thread.start()
+
+        self.logger.info(
+            f"Started {self.ingest_workers} ingest worker(s)",
+            extra={
+                "batch_size": self.ingest_batch_size,
+                "batch_interval": self.ingest_batch_interval,
+            },
+        )
+
+    def stop_ingest_workers(self, timeout: Optional[float] = None) -> None:
+        """Stop the ingest workers, processing any messages still queued."""
+        if not self._ingest_threads:
+            return
+        # New messages are parsed inline from here on
+        with self._ingest_lock:
+            ingest_queue, self._ingest_queue = self._ingest_queue, None
+        self._ingest_stop_event.set()
+        for thread in self._ingest_threads:
+            thread.join(timeout=timeout)
+        self._ingest_threads = []
+
+        remaining = []
+        while True:
+            try:
+                remaining.append(ingest_queue.get_nowait())
+            except queue.Empty:
+                break
+        if remaining:
+            self.process_batch(remaining)
+        self.logger.info("Stopped ingest workers")
+
+    def _ingest_queue_depth(self) -> int:
+        ingest_queue = self._ingest_queue
+        return ingest_queue.qsize() if ingest_queue is not None else 0
+
+    def _ingest_worker(self) -> None:
+        labels = (self.node_id, self.name, self.node_type, self.hostname)
+        batch_latency = self.metric_ingest_batch_latency.labels(*labels)
+        ingest_queue = self._ingest_queue
+
+        while not self._ingest_stop_event.is_set():
+            try:
+                batch = [ingest_queue.get(timeout=self.ingest_batch_interval)]
+            except queue.Empty:
+                continue
+
+            # Collect messages until the batch is full or the interval elapses
+            deadline = time.monotonic() + self.ingest_batch_interval
+            while len(batch) < self.ingest_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(ingest_queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            start = time.perf_counter()
+            try:
+                self.process_batch(batch)
+            except Exception as e:
+                self.logger.error(f"Failed to process ingest batch: {e}")
+            batch_latency.observe(time.perf_counter() - start)
+
+    def close(self):
+        self.stop_ingest_workers()
+        self.stop_aggregation()
+        self.stop_flush_pipeline()
+        if self.wal is not None:
+            with self._wal_lock:
+                self._commit_drops()
+            self.wal.close()
+        if isinstance(self.buffer, BoundedMetricsBuffer):
+            self.buffer.close()
+        super().close()
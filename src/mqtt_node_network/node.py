@@ -8,36 +8,65 @@
 """a_short_module_description"""
 # ---------------------------------------------------------------------------
 from __future__ import annotations
+from collections import deque
+from collections.abc import MutableMapping
+from contextlib import contextmanager
 import logging
 from pathlib import Path
+import re
 import socket
+import struct
 import threading
-from typing import Dict, List, NoReturn, Optional, Tuple, Union
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Iterator,
+    List,
+    Mapping,
+    NoReturn,
+    Optional,
+    Tuple,
+    Union,
+)
 import time
-import asyncio
+import copy
+import json
 
 import paho.mqtt.client as mqtt
 from paho.mqtt.enums import MQTTErrorCode
 from paho.mqtt.packettypes import PacketTypes
 from paho.mqtt.properties import Properties
+from paho.mqtt.reasoncodes import ReasonCode
 from paho.mqtt.subscribeoptions import SubscribeOptions
 from prometheus_client import Counter
 
+from mqtt_node_network.payload_codecs import PayloadCodec, StructCodec, get_codec
+from mqtt_node_network.topic_aliases import TOPIC_ALIAS_PROPERTY_SIZE, TopicAliasTable
+from mqtt_node_network.clock_sync import ClockSync, source_time_property
 from mqtt_node_network.configuration import (
+    ClockSyncConfig,
     MQTTConnectProperties,
     TLSConfig,
-    initialize_config,
+    load_config_cached,
     MQTTBrokerConfig,
     SubscribeConfig,
     MQTTPacketProperties,
     MQTTWillConfig,
     MQTTStatusConfig,
+    OutboundSpoolConfig,
 )
+from mqtt_node_network.spool import OutboundSpool
+from mqtt_node_network.publish_scheduler import PublishScheduler, ScheduledPublication
 
 
 # Initialize your logger and adapter
 logger = logging.getLogger(__name__)
 
+# User property carrying the field names of a binary snapshot
+SNAPSHOT_FIELDS_PROPERTY = "fields"
+
 import logging
 
 
@@ -49,6 +78,11 @@ def shorten_data(data: str, max_length: int = 75) -> str:
     return data[:max_length] + "..." if len(data) > max_length else data
 
 
+def node_data_path(path: Union[str, Path], client_id: str) -> Path:
+    """The subdirectory of a data directory belonging to the node with a client id."""
+    return Path(path) / re.sub(r"[^\w-]", "_", client_id)
+
+
 def convert_bytes_to_human_readable(num: float) -> str:
     """Convert bytes to a human-readable format."""
     for unit in ["B", "KB", "MB", "GB", "TB", "PB"]:
@@ -109,6 +143,8 @@ def parse_topic(
     """
     options = options or SubscribeOptions()
     if qos is not None and options.QoS != qos:
+        # Leave the caller's options, often the node's defaults, untouched
+        options = copy.copy(options)
         options.QoS = qos
         logger.warning(
             f"Overriding QoS value in options with value {qos}",
@@ -123,6 +159,84 @@ def parse_topic(
         raise ValueError("Topic must be a string, tuple or list")
 
 
+# The largest packet MQTT allows, used when the broker sets no MaximumPacketSize
+MQTT_MAXIMUM_PACKET_SIZE = 268_435_460
+
+
+def _varint_length(value: int) -> int:
+    length = 1
+    while value > 127:
+        value >>= 7
+        length += 1
+    return length
+
+
+def batch_subscriptions(
+    subscriptions: Union[
+        Mapping[str, mqtt.SubscribeOptions], List[Tuple[str, mqtt.SubscribeOptions]]
+    ],
+    maximum_packet_size: Optional[int] = None,
+) -> List[List[Tuple[str, mqtt.SubscribeOptions]]]:
+    """
+    Pack topic filters into as few SUBSCRIBE packets as fit the broker's maximum
+    packet size.
+
+    :param subscriptions: A mapping of topic filters to subscribe options, or a
+        list of (filter, options) tuples.
+    :param maximum_packet_size: The broker's MaximumPacketSize from CONNACK.
+        Optional - if not set, the MQTT limit is used.
+    :return: A list of batches, each a list of (filter, options) tuples to send
+        in one SUBSCRIBE packet. A filter too large for any packet is put in a
+        batch of its own.
+    """
+    if isinstance(subscriptions, Mapping):
+        subscriptions = list(subscriptions.items())
+    maximum_packet_size = maximum_packet_size or MQTT_MAXIMUM_PACKET_SIZE
+
+    # Packet identifier and an empty properties length
+    header_length = 3
+    batches = []
+    batch, remaining_length = [], header_length
+    for topic_filter, options in subscriptions:
+        # Filter length prefix, the filter, and the options byte
+        filter_length = 2 + len(topic_filter.encode("utf-8")) + 1
+        length = remaining_length + filter_length
+        if batch and 1 + _varint_length(length) + length > maximum_packet_size:
+            batches.append(batch)
+            batch, length = [], header_length + filter_length
+        batch.append((topic_filter, options))
+        remaining_length = length
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def payload_to_bytes(payload: Union[str, bytes, bytearray, int, float, None]) -> bytes:
+    """Convert a payload to bytes, as paho does when publishing."""
+    if isinstance(payload, (bytes, bytearray)):
+        return bytes(payload)
+    if isinstance(payload, str):
+        return payload.encode("utf-8")
+    if isinstance(payload, (int, float)):
+        return str(payload).encode("ascii")
+    if payload is None:
+        return b""
+    raise TypeError("payload must be a string, bytearray, int, float or None.")
+
+
+def get_snapshot_fields(properties: Optional[Properties]) -> Optional[List[str]]:
+    """
+    Get the field names sent with a binary snapshot, see MQTTNode.publish_snapshot.
+
+    :param properties: The MQTT 5 properties of a received message.
+    :return: The list of field names, or None if the message has none.
+    """
+    for key, value in getattr(properties, "UserProperty", None) or ():
+        if key == SNAPSHOT_FIELDS_PROPERTY:
+            return json.loads(value)
+    return None
+
+
 def dict_to_user_packet_properties(
     packet_properties_dict: Dict[str, str],
 ) -> List[Tuple[str, str]]:
@@ -147,6 +261,157 @@ def user_packet_properties_to_dict(
     return dict(user_packet_properties)
 
 
+class _TopicTrieNode:
+    __slots__ = ("children", "topic_filter", "value")
+
+    def __init__(self):
+        self.children: Dict[str, _TopicTrieNode] = {}
+        # Set when a filter ends at this node
+        self.topic_filter: Optional[str] = None
+        self.value: Any = None
+
+
+class TopicRouter(MutableMapping):
+    """
+    A mapping of MQTT topic filters to values, which finds the values of all
+    filters matching a topic.
+
+    Filters are held in a trie with one level per topic level, so matching a
+    topic costs time proportional to its depth, however many filters there are.
+    `+` matches a single level and a trailing `#` matches any number of levels,
+    including none. Following the MQTT spec, topics starting with `$` are not
+    matched by a wildcard in the first level.
+
+    Looking up, adding and removing a single filter are O(1) in the number of
+    filters, and iteration is in insertion order.
+    """
+
+    def __init__(self, filters: Optional[Union[Mapping[str, Any], List[str]]] = None):
+        """
+        Initialize a TopicRouter.
+
+        :param filters: A mapping of filters to values, or a list of filters
+            mapped to None.
+        """
+        self._root = _TopicTrieNode()
+        self._filters: Dict[str, _TopicTrieNode] = {}
+        if isinstance(filters, Mapping):
+            self.update(filters)
+        elif filters:
+            for topic_filter in filters:
+                self[topic_filter] = None
+
+    @staticmethod
+    def _levels(topic_filter: str) -> List[str]:
+        if not isinstance(topic_filter, str) or not topic_filter:
+            raise ValueError(f"Invalid topic filter: {topic_filter!r}")
+        levels = topic_filter.split("/")
+        for index, level in enumerate(levels):
+            if ("#" in level or "+" in level) and len(level) > 1:
+                raise ValueError(f"Invalid topic filter: {topic_filter!r}")
+            if level == "#" and index != len(levels) - 1:
+                raise ValueError(f"Invalid topic filter: {topic_filter!r}")
+        return levels
+
+    def __setitem__(self, topic_filter: str, value: Any) -> None:
+        node = self._filters.get(topic_filter)
+        if node is None:
+            node = self._root
+            for level in self._levels(topic_filter):
+                child = node.children.get(level)
+                if child is None:
+                    child = node.children[level] = _TopicTrieNode()
+                node = child
+            node.topic_filter = topic_filter
+            self._filters[topic_filter] = node
+        node.value = value
+
+    def __getitem__(self, topic_filter: str) -> Any:
+        return self._filters[topic_filter].value
+
+    def __delitem__(self, topic_filter: str) -> None:
+        node = self._filters.pop(topic_filter)
+        node.topic_filter = None
+        node.value = None
+        # Prune branches left without filters
+        path = [self._root]
+        levels = topic_filter.split("/")
+        for level in levels:
+            path.append(path[-1].children[level])
+        for level, parent, child in zip(
+            reversed(levels), reversed(path[:-1]), reversed(path[1:])
+        ):
+            if child.children or child.topic_filter is not None:
+                break
+            del parent.children[level]
+
+    def __contains__(self, topic_filter: object) -> bool:
+        return topic_filter in self._filters
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._filters)
+
+    def __len__(self) -> int:
+        return len(self._filters)
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({list(self._filters)!r})"
+
+    def copy(self) -> TopicRouter:
+        return self.__class__({f: node.value for f, node in self._filters.items()})
+
+    def _match_nodes(self, topic: str) -> List[_TopicTrieNode]:
+        matched = []
+        nodes = [self._root]
+        # Wildcards in the first level do not match topics such as $SYS/...
+        wildcards = not topic.startswith("$")
+        for level in topic.split("/"):
+            next_nodes = []
+            for node in nodes:
+                children = node.children
+                if not children:
+                    continue
+                if wildcards:
+                    multi = children.get("#")
+                    if multi is not None:
+                        matched.append(multi)
+                    single = children.get("+")
+                    if single is not None:
+                        next_nodes.append(single)
+                child = children.get(level)
+                if child is not None:
+                    next_nodes.append(child)
+            if not next_nodes:
+                return matched
+            nodes = next_nodes
+            wildcards = True
+        for node in nodes:
+            if node.topic_filter is not None:
+                matched.append(node)
+            # "a/#" also matches "a"
+            multi = node.children.get("#")
+            if multi is not None:
+                matched.append(multi)
+        return matched
+
+    def match(self, topic: str) -> List[Any]:
+        """
+        Get the values of all filters matching a topic.
+
+        :param topic: A topic name, without wildcards.
+        :return: A list of values, one per matching filter.
+        """
+        return [node.value for node in self._match_nodes(topic)]
+
+    def match_filters(self, topic: str) -> List[str]:
+        """Get all filters matching a topic."""
+        return [node.topic_filter for node in self._match_nodes(topic)]
+
+    def matches(self, topic: str) -> bool:
+        """Whether any filter matches a topic."""
+        return bool(self._match_nodes(topic))
+
+
 class CustomLoggerAdapter(logging.LoggerAdapter):
     """
     A custom logger adapter that adds support for the merge_extra argument
@@ -177,6 +442,121 @@ class CustomLoggerAdapter(logging.LoggerAdapter):
         return msg, kwargs
 
 
+class NodeClient(mqtt.Client):
+    """
+    A paho Client which resolves inbound MQTT 5 topic aliases, and dispatches
+    messages to topic callbacks with a TopicRouter.
+
+    paho passes messages published with a topic alias to callbacks with an empty
+    topic. This client restores the full topic before the message is dispatched,
+    so topic filters and callbacks see it as normal. Aliases are bound and
+    resolved in the order PUBLISH packets arrive, although QoS 2 messages are
+    only dispatched once released.
+
+    The node's outbound TopicAliasTable, if set, is disabled whenever a new
+    connection is started, until the node sets the broker's maximum in
+    on_connect, so no message is sent with an alias the connection never bound.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.inbound_topic_aliases: Dict[int, bytes] = {}
+        self.callback_router = TopicRouter()
+        # The node's outbound aliases, and the lock keeping alias bindings and
+        # the messages using them in order. Reentrant, so a batch of messages
+        # can be published under one hold of it
+        self.outbound_topic_aliases: Optional[TopicAliasTable] = None
+        self.outbound_topic_aliases_lock = threading.RLock()
+
+    def message_callback_add(self, sub: str, callback) -> None:
+        if callback is None or sub is None:
+            raise ValueError("sub and callback must both be defined.")
+        with self._callback_mutex:
+            self.callback_router[sub] = callback
+
+    def message_callback_remove(self, sub: str) -> None:
+        if sub is None:
+            raise ValueError("sub must defined.")
+        with self._callback_mutex:
+            self.callback_router.pop(sub, None)
+
+    def _reset_outbound_topic_aliases(self) -> None:
+        if self.outbound_topic_aliases is not None:
+            with self.outbound_topic_aliases_lock:
+                self.outbound_topic_aliases.reset(0)
+
+    def reconnect(self) -> MQTTErrorCode:
+        # Aliases only last as long as a connection
+        self._reset_outbound_topic_aliases()
+        return super().reconnect()
+
+    def _handle_connack(self):
+        # Aliases only last as long as a connection. paho marks the client
+        # connected before on_connect sets the broker's alias maximum
+        self.inbound_topic_aliases.clear()
+        self._reset_outbound_topic_aliases()
+        return super()._handle_connack()
+
+    def _handle_publish(self) -> MQTTErrorCode:
+        rc = super()._handle_publish()
+        if (self._in_packet["command"] & 0x06) >> 1 == 2:
+            # A QoS 2 message is held until it is released, but binds, or uses,
+            # its topic alias as it stood when the PUBLISH arrived
+            packet = self._in_packet["packet"]
+            (topic_length,) = struct.unpack_from("!H", packet)
+            (mid,) = struct.unpack_from("!H", packet, 2 + topic_length)
+            with self._in_message_mutex:
+                message = self._in_messages.get(mid)
+            if message is not None:
+                self._resolve_topic_alias(message)
+        return rc
+
+    def _resolve_topic_alias(self, message: mqtt.MQTTMessage) -> None:
+        alias = getattr(message.properties, "TopicAlias", None)
+        if alias is None:
+            return
+        if message._topic:
+            self.inbound_topic_aliases[alias] = message._topic
+        elif alias in self.inbound_topic_aliases:
+            message.topic = self.inbound_topic_aliases[alias]
+        else:
+            logger.error(f"Received message with unknown topic alias {alias}")
+
+    def _handle_on_message(self, message: mqtt.MQTTMessage) -> None:
+        if message.qos < 2:
+            # QoS 2 messages are resolved when their PUBLISH arrives
+            self._resolve_topic_alias(message)
+
+        try:
+            topic = message.topic
+        except UnicodeDecodeError:
+            topic = None
+
+        callbacks = []
+        with self._callback_mutex:
+            if topic is not None and self.callback_router:
+                callbacks = self.callback_router.match(topic)
+            if not callbacks:
+                callbacks = [self.on_message] if self.on_message else []
+                is_on_message = True
+            else:
+                is_on_message = False
+
+        for callback in callbacks:
+            with self._in_callback_mutex:
+                try:
+                    callback(self, self._userdata, message)
+                except Exception as err:
+                    self._easy_log(
+                        mqtt.MQTT_LOG_ERR,
+                        "Caught exception in %s: %s",
+                        "on_message" if is_on_message else callback.__name__,
+                        err,
+                    )
+                    if not self.suppress_exceptions:
+                        raise
+
+
 class NodeError(Exception):
     """
     Exception raised for errors in the MQTTNode.
@@ -217,6 +597,12 @@ class MQTTNode:
         labelnames=("node_id", "node_name", "node_type", "host"),
     )
 
+    node_topic_alias_bytes_saved_count = Counter(
+        "node_topic_alias_bytes_saved_total",
+        "Total number of topic bytes not sent by node thanks to topic aliases",
+        labelnames=("node_id", "node_name", "node_type", "host"),
+    )
+
     @classmethod
     def from_config_file(
         cls,
@@ -227,21 +613,68 @@ class MQTTNode:
         """
         Instantiate an MQTTNode from a configuration file.
 
+        Parsed configuration files are cached until they are modified, see
+        load_config_cached.
+
         :param config_file: Path to the configuration file.
         :param secrets_file: Path to the secrets file (optional).
         :param kwargs: Additional keyword arguments. See MQTTNode.__init__ for details. These will override the config file.
         :return: An initialized MQTTNode instance.
         """
-        configs = initialize_config(config=config_file, secrets=secrets_file)
+        config = cls._node_config(config_file, secrets_file)
+        # Combine the configuration from the file with any additional keyword arguments
+        # The keyword arguments will override the configuration file
+        combined_args = {**config, **kwargs}
+        return cls(**combined_args)
+
+    @classmethod
+    def from_config_file_many(
+        cls,
+        num_nodes: int,
+        config_file: Union[str, Path],
+        secrets_file: Optional[Union[str, Path]] = None,
+        name_template: Optional[str] = None,
+        **kwargs,
+    ) -> List[MQTTNode]:
+        """
+        Instantiate many MQTTNodes from one parse of a configuration file.
+
+        :param num_nodes: The number of nodes to create.
+        :param config_file: Path to the configuration file.
+        :param secrets_file: Path to the secrets file (optional).
+        :param name_template: A format string for the node names, given the
+            node's index, e.g. "device-{}". Names are used as MQTT client ids,
+            so must be unique. Optional - if not set, the name from kwargs or
+            the config file is kept. A node_id set in the config file is
+            suffixed with each node's index.
+        :param kwargs: Additional keyword arguments passed to each node. These
+            will override the config file.
+        :return: A list of initialized nodes.
+        """
+        config = {**cls._node_config(config_file, secrets_file), **kwargs}
+        node_id = config.get("node_id")
+        nodes = []
+        for index in range(num_nodes):
+            if name_template:
+                config["name"] = name_template.format(index)
+            if node_id and "node_id" not in kwargs:
+                config["node_id"] = f"{node_id}-{index}"
+            nodes.append(cls(**config))
+        return nodes
+
+    @classmethod
+    def _node_config(
+        cls,
+        config_file: Union[str, Path],
+        secrets_file: Optional[Union[str, Path]] = None,
+    ) -> Mapping[str, Any]:
+        configs = load_config_cached(config=config_file, secrets=secrets_file)
         config = configs.get(cls.__name__, configs.get("MQTTNode", None))
         if config is None:
             raise NodeError(
                 f"Configuration for class {cls.__name__} not found in config file. Please check that the configuration exists"
             )
-        # Combine the configuration from the file with any additional keyword arguments
-        # The keyword arguments will override the configuration file
-        combined_args = {**config, **kwargs}
-        return cls(**combined_args)
+        return config
 
     def __init__(
         self,
@@ -253,6 +686,10 @@ class MQTTNode:
         transport_config: Optional[TLSConfig] = None,
         will_config: Optional[MQTTWillConfig] = None,
         status_config: Optional[MQTTStatusConfig] = None,
+        topic_alias_policy: Optional[str] = None,
+        topic_alias_min_uses: int = 2,
+        spool_config: Optional[OutboundSpoolConfig] = None,
+        clock_sync_config: Optional[ClockSyncConfig] = None,
     ):
         """
         Initialize an MQTTNode instance.
@@ -261,14 +698,33 @@ class MQTTNode:
         :param name: The name of the node.
         :param node_id: A unique identifier for the node (optional).
         :param subscribe_config: Configuration for subscribed topics.
+        :param topic_alias_policy: "lru" or "lfu" to give frequently published
+            QoS 0 topics an MQTT 5 topic alias, up to the broker's
+            TopicAliasMaximum. Optional - if not set, topic aliases are not used.
+        :param topic_alias_min_uses: Publishes before a topic is given an alias.
+        :param spool_config: Configuration for a durable on-disk spool, holding
+            messages published while disconnected until they are replayed after
+            reconnecting. Each node spools to a subdirectory of the path named
+            after its client id. Optional - if no path is set, messages are not
+            spooled.
+        :param clock_sync_config: Configuration for estimating the local clock's
+            offset from NTP servers, shared by all nodes in the process with the
+            same configuration. If `timestamp_messages` is set, published messages
+            carry their corrected source time in a user property. Optional - if
+            not enabled, the local clock is used uncorrected.
         """
         self.name = name
         self.node_type = self.__class__.__name__
         self.node_id = node_id if node_id else self._get_id()
-        self.subscriptions = subscribe_config.topics if subscribe_config else []
         self.subscribe_options = (
             subscribe_config.options if subscribe_config else SubscribeOptions()
         )
+        # Subscribed topic filters, mapped to their subscribe options
+        self.subscriptions = TopicRouter(
+            {topic: self.subscribe_options for topic in subscribe_config.topics}
+            if subscribe_config
+            else None
+        )
         self.will_config = will_config
         self.status_config = status_config
 
@@ -293,7 +749,7 @@ class MQTTNode:
 
         # Initialize paho client
         client_id = self.name or self.node_id
-        self.client = mqtt.Client(
+        self.client = NodeClient(
             mqtt.CallbackAPIVersion.VERSION2,
             client_id=client_id,
             protocol=mqtt.MQTTv5,
@@ -323,18 +779,60 @@ class MQTTNode:
 
         self._connect_event = threading.Event()
 
+        self.topic_alias_policy = topic_alias_policy
+        self.topic_aliases = TopicAliasTable(
+            policy=topic_alias_policy or "lru", min_uses=topic_alias_min_uses
+        )
+        self.client.outbound_topic_aliases = self.topic_aliases
+        self._publish_lock = self.client.outbound_topic_aliases_lock
+
+        # Set from the broker's CONNACK, bounds the size of resubscribe batches
+        self.broker_maximum_packet_size: Optional[int] = None
+        # Filters awaiting a SUBACK after restore_subscriptions, by packet mid
+        self._pending_resubscribes: Dict[int, List[str]] = {}
+        self._resubscribe_lock = threading.Lock()
+        # Filters the broker refused on the last restore_subscriptions
+        self.failed_subscriptions: Dict[str, ReasonCode] = {}
+
+        # A NodeReactor driving the client in place of paho's network thread
+        self.reactor = None
+
+        self.spool: Optional[OutboundSpool] = None
+        self.spool_drain_rate: float = 0
+        self.spool_max_in_flight: int = 100
+        self._spool_drain_thread: Optional[threading.Thread] = None
+        self._spool_drain_lock = threading.Lock()
+        self._spool_draining = False
+        if spool_config is not None and spool_config.path:
+            self.spool = OutboundSpool.from_config(
+                spool_config,
+                name=client_id,
+                path=node_data_path(spool_config.path, client_id),
+            )
+            self.spool_drain_rate = spool_config.drain_rate
+            self.spool_max_in_flight = spool_config.max_in_flight
+
+        # Periodic publications registered with schedule_publish
+        self.scheduled_publications: List[ScheduledPublication] = []
+
+        self.clock: Optional[ClockSync] = None
+        self.timestamp_messages = False
+        if clock_sync_config is not None and clock_sync_config.enabled:
+            self.clock = ClockSync.shared(clock_sync_config)
+            self.timestamp_messages = clock_sync_config.timestamp_messages
+
         # Set client callbacks
         self.client.on_connect = self.on_connect
         self.client.on_connect_fail = self.on_connect_fail
         self.client.on_message = self.on_message
         self.client.on_disconnect = self.on_disconnect
         self.client.on_publish = self.on_publish
+        self.client.on_subscribe = self.on_subscribe
         self.is_connected = self.client.is_connected
 
         # Not currently used
         # ***************************************************************************
         # self.client.on_pre_connect = self.on_pre_connect
-        # self.client.on_subscribe = self.on_subscribe
         # self.client.on_unsubscribe = self.on_unsubscribe
         # self.client.on_log = self.on_log
         # self.loop_forever = self.client.loop_forever
@@ -412,7 +910,7 @@ class MQTTNode:
         Subscribe to a topic
         :topic: str | tuple | list
         :qos: quality of service, 0 | 1 | 2
-
+        :return: The (result, mid) tuple returned by paho's subscribe
         """
         if options is None:
             options = self.subscribe_options
@@ -441,6 +939,7 @@ class MQTTNode:
 
         # Add the topic to the list of subscriptions
         self.add_subscription_topic(topic)
+        return result
 
     def unsubscribe(
         self, topic: Union[str, list[str]], packet_properties=None
@@ -454,38 +953,65 @@ class MQTTNode:
         # remove from self.subscriptions
         if isinstance(topic, list):
             for t in topic:
-                self.subscriptions.remove(t)
+                self.subscriptions.pop(t, None)
         elif isinstance(topic, str):
-            self.subscriptions.remove(topic)
+            self.subscriptions.pop(topic, None)
         err_code, _ = self.client.unsubscribe(topic, properties=packet_properties)
         return err_code
 
     def add_subscription_topic(self, topic: Union[str, list, tuple]):
 
-        def append_topic(topic):
+        def append_topic(topic, options=None):
             assert isinstance(topic, str)
-            if topic not in self.subscriptions:
-                self.subscriptions.append(topic)
+            self.subscriptions[topic] = options or self.subscribe_options
 
         if isinstance(topic, list):
             for t in topic:
                 if isinstance(t, tuple):
-                    append_topic(t[0])
+                    append_topic(*t)
                 else:
                     append_topic(t)
 
         elif isinstance(topic, tuple):
-            append_topic(topic[0])
+            append_topic(*topic)
         elif isinstance(topic, str):
             append_topic(topic)
 
-    def restore_subscriptions(self):
-        for topic in self.subscriptions:
-            self.subscribe(topic)
+    def restore_subscriptions(self) -> List[int]:
+        """
+        Resubscribe to all subscribed topic filters, packed into as few SUBSCRIBE
+        packets as the broker's maximum packet size allows. Filters the broker
+        refuses are logged by on_subscribe and kept in failed_subscriptions.
+
+        :return: The mids of the SUBSCRIBE packets sent.
+        """
+        batches = batch_subscriptions(
+            list(self.subscriptions.items()), self.broker_maximum_packet_size
+        )
+        mids = []
+        with self._resubscribe_lock:
+            self._pending_resubscribes.clear()
+            self.failed_subscriptions.clear()
+            for batch in batches:
+                result, mid = self.client.subscribe(batch)
+                if result != 0:
+                    error_string = mqtt.error_string(result)
+                    self.logger.error(
+                        f"{error_string}, failed to resubscribe to {len(batch)} topics",
+                        extra={"error_code": error_string},
+                    )
+                    continue
+                self._pending_resubscribes[mid] = [topic for topic, _ in batch]
+                mids.append(mid)
+        if batches:
+            self.logger.info(
+                f"Resubscribing to {len(self.subscriptions)} topics in {len(batches)} packets",
+            )
+        return mids
 
     def unsubscribe_all(self) -> List[int]:
         error_codes = []
-        for topic in self.subscriptions.copy():
+        for topic in list(self.subscriptions):
             err_code = self.unsubscribe(topic)
             if err_code != 0:
                 self.logger.error(
@@ -510,19 +1036,137 @@ class MQTTNode:
         retain=False,
         properties=None,
         ensure_published=False,
+        codec: Union[str, PayloadCodec, None] = None,
     ) -> mqtt.MQTTMessageInfo:
+        """
+        Publish a message.
+
+        :param codec: A codec name, content type or PayloadCodec used to encode
+            the payload. Its content type is sent in the Content Type property
+            so the receiver can decode it. Optional - if not set, the payload is
+            sent as given.
+
+        If the node has a spool, messages published while disconnected, or while
+        the spool is still being replayed, are appended to the spool instead, and
+        replayed in order once connected. The returned MQTTMessageInfo then has
+        mid 0, and ensure_published is ignored.
+
+        If the node timestamps messages, see `clock_sync_config`, the message
+        carries the corrected time it was published in a user property.
+        """
         # self.ensure_connection()
-        if properties:
+        if isinstance(properties, Properties) and (
+            codec is not None or self.topic_aliases.maximum or self.timestamp_messages
+        ):
+            # Leave the caller's properties untouched
+            properties = copy.copy(properties)
+        elif properties:
             properties = parse_packet_properties_dict(properties)
         else:
             properties = self.packet_properties[PacketTypes.PUBLISH].build()
-        message_info = self.client.publish(
-            topic, payload, qos, retain, properties=properties
-        )
+        if codec is not None:
+            codec = get_codec(codec)
+            payload = codec.encode(payload)
+            properties.ContentType = codec.content_type
+        if self.timestamp_messages:
+            properties.UserProperty = source_time_property(self.clock)
+
+        if self.spool is not None and (self.spool or not self.is_connected()):
+            # Queue behind any messages still being replayed, to keep them in order
+            self.spool.append(
+                topic, payload_to_bytes(payload), qos, retain, properties=properties
+            )
+            if self.is_connected():
+                # In case the drain finished after the spool was checked
+                self.start_spool_drain()
+            return mqtt.MQTTMessageInfo(0)
+
+        if self.topic_aliases.maximum and qos == 0:
+            # QoS 0 messages are never retransmitted, so cannot outlive the
+            # connection their alias belongs to. The lock keeps alias bindings
+            # and the messages using them in order
+            with self._publish_lock:
+                send_topic, alias = self.topic_aliases.assign(topic)
+                if alias is not None:
+                    properties.TopicAlias = alias
+                message_info = self.client.publish(
+                    send_topic, payload, qos, retain, properties=properties
+                )
+            if not send_topic:
+                self.node_topic_alias_bytes_saved_count.labels(
+                    self.node_id, self.name, self.node_type, self.hostname
+                ).inc(len(topic.encode()) - TOPIC_ALIAS_PROPERTY_SIZE)
+        else:
+            message_info = self.client.publish(
+                topic, payload, qos, retain, properties=properties
+            )
         if ensure_published:
             message_info.wait_for_publish(timeout=self.timeout)
         return message_info
 
+    @contextmanager
+    def publish_batch(self) -> Iterator[MQTTNode]:
+        """
+        Publish a batch of messages together.
+
+        The node's publish lock is held while the batch is published, so the
+        messages are queued back to back, with no other thread's messages
+        between them, for the network loop to write together.
+
+            with node.publish_batch():
+                for topic, payload in messages:
+                    node.publish(topic, payload)
+        """
+        with self._publish_lock:
+            yield self
+
+    def publish_snapshot(
+        self,
+        topic: str,
+        values: Mapping[str, Union[str, int, float]],
+        qos=0,
+        retain=False,
+        properties=None,
+        ensure_published=False,
+        codec: Union[str, PayloadCodec] = "json",
+    ) -> mqtt.MQTTMessageInfo:
+        """
+        Publish many field values in a single message.
+
+        An MQTTMetricsNode receiving the snapshot expands it into one metric per
+        field, as if each value had been published on the topic "<topic>/<field>".
+
+        :param topic: The topic to publish to, without the field level.
+        :param values: A mapping of field name to value.
+        :param codec: The codec to encode the snapshot with. Mapping codecs such
+            as "json", "msgpack" or "cbor" send an object of field values. Struct
+            codecs such as "float64" send a packed frame of values, with the
+            field names in a "fields" user property.
+        """
+        codec = get_codec(codec)
+        if isinstance(codec, StructCodec):
+            if properties:
+                # The fields property is added to a copy, not the caller's
+                properties = copy.copy(parse_packet_properties_dict(properties))
+            else:
+                properties = self.packet_properties[PacketTypes.PUBLISH].build()
+            properties.UserProperty = (
+                SNAPSHOT_FIELDS_PROPERTY,
+                json.dumps(list(values)),
+            )
+            payload = list(values.values())
+        else:
+            payload = dict(values)
+        return self.publish(
+            topic,
+            payload,
+            qos,
+            retain,
+            properties=properties,
+            ensure_published=ensure_published,
+            codec=codec,
+        )
+
     def publish_every(
         self,
         topic,
@@ -535,7 +1179,9 @@ class MQTTNode:
         """
         Publish a message every interval seconds.
 
-        This is a blocking function, and will run indefinitely.
+        This is a blocking function, and will run indefinitely. Publications are
+        timed on the monotonic clock, so they do not drift by the time taken to
+        publish. See schedule_publish to publish many topics without a thread each.
         :topic: str - The topic to publish to
         :payload_func: function - A function that returns the payload to publish
         :qos: int - The Quality of Service level
@@ -544,10 +1190,60 @@ class MQTTNode:
         :interval: int - The interval in seconds
         """
 
+        due = time.monotonic()
         while True:
             payload = payload_func()
             self.publish(topic, payload, qos, retain, properties)
-            time.sleep(interval)
+            due += interval
+            delay = due - time.monotonic()
+            if delay < -interval:
+                # Skip periods missed while publishing
+                due += interval * int(-delay // interval)
+                delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+    def schedule_publish(
+        self,
+        topic: str,
+        payload_func: Callable[[], Any],
+        interval: float,
+        jitter: float = 0.0,
+        qos: int = 0,
+        retain: bool = False,
+        properties=None,
+        scheduler: Optional[PublishScheduler] = None,
+    ) -> ScheduledPublication:
+        """
+        Publish a message every interval seconds, from a shared scheduler thread.
+
+        Unlike publish_every, this returns immediately, and any number of topics
+        can be scheduled without a thread each.
+
+        :param topic: The topic to publish to.
+        :param payload_func: A function returning the payload to publish.
+        :param interval: Seconds between publications.
+        :param jitter: The maximum random delay of each publication, in seconds,
+            to spread publications with the same interval.
+        :param qos: The Quality of Service level.
+        :param retain: Whether to retain the message.
+        :param properties: MQTT packet properties, see publish.
+        :param scheduler: The scheduler to publish from. Defaults to the
+            scheduler shared by all nodes in the process.
+        :return: The publication, which can be cancelled.
+        """
+        scheduler = scheduler or PublishScheduler.default()
+        publication = scheduler.schedule(
+            self, topic, payload_func, interval, jitter, qos, retain, properties
+        )
+        self.scheduled_publications.append(publication)
+        return publication
+
+    def cancel_scheduled_publications(self) -> None:
+        """Cancel all publications scheduled with schedule_publish."""
+        for publication in self.scheduled_publications:
+            publication.cancel()
+        self.scheduled_publications.clear()
 
     async def publish_every_async(
         self,
@@ -558,6 +1254,8 @@ class MQTTNode:
         packet_properties=None,
         interval=1,
     ) -> NoReturn:
+        import asyncio
+
         while True:
             payload = payload_func()
             self.publish(topic, payload, qos, retain, packet_properties)
@@ -604,7 +1302,101 @@ class MQTTNode:
         finally:
             self.__del__()
 
+    def start_spool_drain(self) -> None:
+        """
+        Replay spooled messages in a background thread, until the spool is empty
+        or the connection is lost. Each message is removed from the spool once
+        the broker acknowledges it, or once it is sent if it is QoS 0.
+
+        The messages spooled when the drain starts are replayed at up to
+        spool_drain_rate messages per second. Those published while it runs are
+        spooled behind them to keep them in order, and replayed as fast as the
+        broker acknowledges them, so the drain catches up with live traffic.
+        """
+        with self._spool_drain_lock:
+            if self._spool_draining:
+                return
+            self._spool_draining = True
+            self._spool_drain_thread = threading.Thread(
+                target=self._drain_spool, name=f"{self.name}-spool-drain", daemon=True
+            )
+            self._spool_drain_thread.start()
+
+    def _drain_spool(self) -> None:
+        # Only the backlog is replayed at the drain rate
+        backlog = len(self.spool)
+        self.logger.info(f"Replaying {backlog} spooled messages")
+        interval = 1 / self.spool_drain_rate if self.spool_drain_rate > 0 else 0
+        next_publish = time.monotonic()
+        replayed = 0
+        # Replayed messages not yet acknowledged by the broker, oldest first.
+        # They stay in the spool until they are, so none is lost on a restart
+        in_flight: Deque[Tuple[int, mqtt.MQTTMessageInfo]] = deque()
+        # Messages replayed before the connection was lost are replayed again
+        self.spool.rewind()
+        draining = True
+        while draining and self.is_connected():
+            while in_flight and in_flight[0][1].is_published():
+                self.spool.acknowledge(in_flight.popleft()[0])
+            entry = None
+            if len(in_flight) < self.spool_max_in_flight:
+                entry = self.spool.replay_next()
+            if entry is None:
+                if in_flight:
+                    # Wait for the broker to acknowledge the oldest
+                    in_flight[0][1].wait_for_publish(timeout=0.1)
+                    continue
+                with self._spool_drain_lock:
+                    # Publishers only restart the drain once it has stopped, so
+                    # check for messages spooled since under the lock
+                    draining = self.spool.unreplayed() > 0
+                    self._spool_draining = draining
+                continue
+            index, message = entry
+            message_info = self.client.publish(
+                message.topic,
+                message.payload,
+                message.qos,
+                message.retain,
+                properties=message.properties,
+            )
+            if message_info.rc != mqtt.MQTT_ERR_SUCCESS:
+                self.logger.warning(
+                    f"Stopped replaying spool: {mqtt.error_string(message_info.rc)}",
+                )
+                break
+            in_flight.append((index, message_info))
+            replayed += 1
+            if interval and replayed < backlog:
+                next_publish += interval
+                time.sleep(max(0, next_publish - time.monotonic()))
+        if draining:
+            # Stopped by a failed publish, or the connection being lost. The
+            # drain is restarted by the next message spooled while connected,
+            # or on reconnecting
+            with self._spool_drain_lock:
+                self._spool_draining = False
+        self.spool.flush()
+        self.logger.info(
+            f"Replayed {replayed} spooled messages, {len(self.spool)} remaining",
+        )
+
+    def attach_reactor(self, reactor) -> MQTTNode:
+        """
+        Drive the node's network traffic from a shared NodeReactor, rather than
+        starting a paho network thread for it on connect.
+
+        :param reactor: A mqtt_node_network.swarm.NodeReactor.
+        """
+        if self.check_loop_running():
+            raise NodeError("Cannot attach a reactor while the network loop is running")
+        self.reactor = reactor
+        return self
+
     def loop_start(self) -> MQTTNode:
+        if self.reactor is not None:
+            self.reactor.add(self)
+            return self
 
         error_code = self.client.loop_start()
 
@@ -616,6 +1408,9 @@ class MQTTNode:
         return self
 
     def loop_stop(self) -> MQTTNode:
+        if self.reactor is not None:
+            self.reactor.remove(self)
+            return self
         error_code = self.client.loop_stop()
         if error_code != 0:
             self.logger.error(
@@ -655,12 +1450,24 @@ class MQTTNode:
             self.logger.info(
                 f"Connected to broker at {client.host}:{client.port}",
             )
+            # Topic aliases only last as long as a connection
+            with self._publish_lock:
+                self.topic_aliases.reset(
+                    getattr(properties, "TopicAliasMaximum", 0)
+                    if self.topic_alias_policy
+                    else 0
+                )
+            self.broker_maximum_packet_size = getattr(
+                properties, "MaximumPacketSize", None
+            )
             self._connect_event.set()
             if not flags.session_present:
                 logger.debug(
                     "No session present. Restoring subscriptions ...",
                 )
                 self.restore_subscriptions()
+            if self.spool:
+                self.start_spool_drain()
         else:
             logger.error(f"Connection failed with code {reason_code}")
 
@@ -686,13 +1493,14 @@ class MQTTNode:
             self.node_id, self.name, self.node_type, self.hostname
         ).inc(len(message.payload))
 
-        self.logger.debug(
-            f"Received message on topic '{message.topic}': {shorten_data(message.payload.decode())}",
-            extra={
-                "topic": message.topic,
-                "qos": message.qos,
-            },
-        )
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(
+                f"Received message on topic '{message.topic}': {shorten_data(message.payload.decode())}",
+                extra={
+                    "topic": message.topic,
+                    "qos": message.qos,
+                },
+            )
 
     def on_publish(self, client, userdata, mid, reason_code, properties):
         self.node_messages_sent_count.labels(
@@ -700,8 +1508,27 @@ class MQTTNode:
         ).inc()
         self.logger.debug(f"Published message #{mid}")
 
-    # def on_subscribe(self, client, userdata, mid, reason_code_list, packet_properties):
-    #  self.logger.info("Subscribed to topic")
+    def on_subscribe(self, client, userdata, mid, reason_code_list, properties):
+        with self._resubscribe_lock:
+            topics = self._pending_resubscribes.pop(mid, None)
+            if topics is None:
+                return
+            failed = {
+                topic: reason_code
+                for topic, reason_code in zip(topics, reason_code_list)
+                if reason_code.is_failure
+            }
+            self.failed_subscriptions.update(failed)
+            pending = len(self._pending_resubscribes)
+        for topic, reason_code in failed.items():
+            self.logger.error(
+                f"Resubscription to topic {topic} failed: {reason_code}",
+                extra={"topic": topic, "reason_code": str(reason_code)},
+            )
+        if not pending:
+            self.logger.info(
+                f"Restored subscriptions, {len(self.failed_subscriptions)} failed",
+            )
 
     # def on_unsubscribe(self, client, userdata, mid, packet_properties, reason_codes):
     #  self.logger.info("Unsubscribed from topic")
@@ -779,3 +1606,5 @@ class MQTTNode:
     def close(self):
         self.__del__()
         self.loop_stop()
+        if self.spool is not None:
+            self.spool.close()
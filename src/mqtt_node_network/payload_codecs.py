@@ -0,0 +1,201 @@
+"""Payload codecs, identified on the wire by the MQTT 5 Content Type property"""
+
+from __future__ import annotations
+import json
+import logging
+import struct
+from typing import Any, Callable, Dict, List, Optional, Sequence, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+logger = logging.getLogger(__name__)
+
+
+def _json_loads_stdlib(payload: bytes) -> Any:
+    # Decoding first avoids json's slower detection of the bytes encoding
+    return json.loads(payload.decode())
+
+
+JSON_BACKENDS: Dict[str, Callable[[bytes], Any]] = {"json": _json_loads_stdlib}
+if orjson is not None:
+    JSON_BACKENDS["orjson"] = orjson.loads
+
+
+def get_json_backend(name: str = "auto") -> Callable[[bytes], Any]:
+    """
+    Get a function which parses JSON from bytes.
+
+    :param name: "json", "orjson", or "auto" to use the fastest installed backend.
+    :return: A function taking bytes and returning the parsed value. It raises
+        ValueError if the payload is not valid JSON.
+    """
+    if name == "auto":
+        return JSON_BACKENDS.get("orjson", _json_loads_stdlib)
+    try:
+        return JSON_BACKENDS[name]
+    except KeyError:
+        raise ValueError(
+            f"JSON backend '{name}' is not available. Choose from {list(JSON_BACKENDS)}"
+        ) from None
+
+
+class CodecError(ValueError):
+    """
+    Exception raised for errors encoding or decoding a payload.
+    """
+
+    def __init__(self, message: str):
+        self.message = message
+        logger.error(self.message)
+        super().__init__(self.message)
+
+
+class PayloadCodec:
+    """
+    Base class for payload codecs.
+
+    A codec encodes values to bytes for publishing, and decodes them on receipt.
+    Its content_type is stamped into the MQTT 5 Content Type property of each
+    message it encodes, so the receiver can select the same codec.
+    """
+
+    name: str = None
+    content_type: str = None
+
+    def encode(self, value: Any) -> bytes:
+        raise NotImplementedError("encode must be implemented in child class")
+
+    def decode(self, payload: bytes) -> Any:
+        raise NotImplementedError("decode must be implemented in child class")
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self.content_type!r})"
+
+
+class JSONCodec(PayloadCodec):
+    """Encodes values as UTF-8 JSON."""
+
+    name = "json"
+    content_type = "application/json"
+
+    def __init__(self, json_backend: str = "auto"):
+        self._loads = get_json_backend(json_backend)
+
+    def encode(self, value: Any) -> bytes:
+        return json.dumps(value, separators=(",", ":")).encode()
+
+    def decode(self, payload: bytes) -> Any:
+        return self._loads(payload)
+
+
+class StructCodec(PayloadCodec):
+    """
+    Packs a number, or a sequence of numbers, as little-endian floats.
+
+    A single value decodes to a float, and several values decode to a list.
+    """
+
+    def __init__(self, name: str = "float64", format_char: str = "d"):
+        self.name = name
+        self.content_type = f"application/x-{name}"
+        self.format_char = format_char
+        self.item_size = struct.calcsize(f"<{format_char}")
+        # Pre-compiled Struct objects, keyed by the number of values
+        self._structs: Dict[int, struct.Struct] = {}
+
+    def _struct(self, count: int) -> struct.Struct:
+        packer = self._structs.get(count)
+        if packer is None:
+            packer = self._structs[count] = struct.Struct(f"<{count}{self.format_char}")
+        return packer
+
+    def encode(self, value: Union[int, float, Sequence[float]]) -> bytes:
+        if isinstance(value, (int, float)):
+            return self._struct(1).pack(value)
+        return self._struct(len(value)).pack(*value)
+
+    def decode(self, payload: bytes) -> Union[float, List[float]]:
+        count, remainder = divmod(len(payload), self.item_size)
+        if remainder or not count:
+            raise CodecError(
+                f"Payload of {len(payload)} bytes is not a whole number of {self.name} values"
+            )
+        values = self._struct(count).unpack(payload)
+        return values[0] if count == 1 else list(values)
+
+
+class MsgpackCodec(PayloadCodec):
+    """Encodes values with MessagePack. Requires the msgpack package."""
+
+    name = "msgpack"
+    content_type = "application/msgpack"
+
+    def encode(self, value: Any) -> bytes:
+        return msgpack.packb(value)
+
+    def decode(self, payload: bytes) -> Any:
+        return msgpack.unpackb(payload)
+
+
+class CBORCodec(PayloadCodec):
+    """Encodes values with CBOR. Requires the cbor2 package."""
+
+    name = "cbor"
+    content_type = "application/cbor"
+
+    def encode(self, value: Any) -> bytes:
+        return cbor2.dumps(value)
+
+    def decode(self, payload: bytes) -> Any:
+        return cbor2.loads(payload)
+
+
+# Registered codecs, keyed by both name and content type
+CODECS: Dict[str, PayloadCodec] = {}
+
+
+def register_codec(codec: PayloadCodec) -> PayloadCodec:
+    """Register a codec so it can be found by its name or content type."""
+    CODECS[codec.name] = codec
+    CODECS[codec.content_type] = codec
+    return codec
+
+
+def get_codec(codec: Union[str, PayloadCodec, None]) -> Optional[PayloadCodec]:
+    """
+    Look up a codec by name or content type.
+
+    :param codec: A codec name, content type, or PayloadCodec instance.
+    :return: The codec, or None if codec is None.
+    :raises CodecError: If no such codec is registered.
+    """
+    if codec is None or isinstance(codec, PayloadCodec):
+        return codec
+    try:
+        return CODECS[codec]
+    except KeyError:
+        raise CodecError(
+            f"Codec '{codec}' is not registered. Available codecs: {sorted(CODECS)}"
+        ) from None
+
+
+register_codec(JSONCodec())
+register_codec(StructCodec("float64", "d"))
+register_codec(StructCodec("float32", "f"))
+if msgpack is not None:
+    register_codec(MsgpackCodec())
+if cbor2 is not None:
+    register_codec(CBORCodec())
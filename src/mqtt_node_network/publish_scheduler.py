@@ -0,0 +1,306 @@
+"""A timer wheel scheduling periodic publications of many nodes"""
+
+from __future__ import annotations
+import logging
+import math
+import random
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional
+
+from prometheus_client import Histogram
+
+if TYPE_CHECKING:
+    from mqtt_node_network.node import MQTTNode
+
+logger = logging.getLogger(__name__)
+
+
+class ScheduledPublication:
+    """
+    A periodic publication registered with a PublishScheduler. Its payload is
+    taken from `payload_func` each time it is published.
+    """
+
+    __slots__ = (
+        "node",
+        "topic",
+        "payload_func",
+        "interval",
+        "jitter",
+        "qos",
+        "retain",
+        "properties",
+        "nominal",
+        "due",
+        "due_tick",
+        "published",
+        "cancelled",
+        "_lag",
+    )
+
+    def __init__(
+        self,
+        node: MQTTNode,
+        topic: str,
+        payload_func: Callable[[], Any],
+        interval: float,
+        jitter: float = 0.0,
+        qos: int = 0,
+        retain: bool = False,
+        properties=None,
+    ):
+        self.node = node
+        self.topic = topic
+        self.payload_func = payload_func
+        self.interval = interval
+        self.jitter = jitter
+        self.qos = qos
+        self.retain = retain
+        self.properties = properties
+        # The time of the current period on the schedule, and the time the
+        # publication is due within it, after jitter
+        self.nominal = 0.0
+        self.due = 0.0
+        self.due_tick = 0
+        self.published = 0
+        self.cancelled = False
+        self._lag = None
+
+    def cancel(self) -> None:
+        """Stop publishing. The publication leaves the wheel when next reached."""
+        self.cancelled = True
+
+    def __repr__(self) -> str:
+        return (
+            f"{self.__class__.__name__}(topic={self.topic!r}, "
+            f"interval={self.interval}, jitter={self.jitter})"
+        )
+
+
+class PublishScheduler:
+    """
+    Publishes periodic messages of many nodes from a single thread, on a hashed
+    timer wheel.
+
+    The wheel is a ring of `slots` lists, one per tick of `tick` seconds. A
+    publication due at tick t is held in slot t % slots, so adding, firing and
+    cancelling cost O(1) whatever the number of publications, and each tick
+    only scans the publications hashed to its slot. Publications due more than
+    a revolution ahead stay in their slot until their tick comes round.
+
+    Ticks are timed from the start of the scheduler on the monotonic clock, and
+    each publication is rescheduled a whole interval after its previous period
+    rather than after it was published, so publications do not drift however
+    long payload functions and publishing take. Periods missed while the
+    process was busy are skipped. `jitter` delays each period's publication by
+    up to that many seconds, without moving the schedule, to spread
+    publications which would otherwise be due together.
+
+    The thread sleeps until the next tick with publications in its slot, so it
+    only wakes when there may be something to publish. Publications due in the
+    same tick are grouped by node, and each node's group is published as one
+    batch, see MQTTNode.publish_batch. The delay from each publication's due time to its publishing is observed in
+    a Prometheus histogram.
+    """
+
+    publish_schedule_lag = Histogram(
+        "node_publish_schedule_lag_seconds",
+        "Delay from a scheduled publication's due time to its publishing",
+        labelnames=("node_id", "node_name", "node_type", "host"),
+        buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+    )
+
+    _default: Optional[PublishScheduler] = None
+    _default_lock = threading.Lock()
+
+    @classmethod
+    def default(cls) -> PublishScheduler:
+        """Get the scheduler shared by all nodes in the process."""
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls()
+            return cls._default
+
+    def __init__(self, tick: float = 0.01, slots: int = 1024):
+        """
+        :param tick: The resolution of the wheel, in seconds.
+        :param slots: The number of ticks in a revolution of the wheel.
+        """
+        if tick <= 0 or slots <= 0:
+            raise ValueError("tick and slots must be positive")
+        self.tick = tick
+        self.slots = slots
+        self._wheel: List[List[ScheduledPublication]] = [[] for _ in range(slots)]
+        self._start = time.monotonic()
+        # The next tick to be processed
+        self._current_tick = 0
+        self._count = 0
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    def __len__(self) -> int:
+        return self._count
+
+    def schedule(
+        self,
+        node: MQTTNode,
+        topic: str,
+        payload_func: Callable[[], Any],
+        interval: float,
+        jitter: float = 0.0,
+        qos: int = 0,
+        retain: bool = False,
+        properties=None,
+    ) -> ScheduledPublication:
+        """
+        Publish a message from a node every interval.
+
+        :param node: The node publishing the message.
+        :param topic: The topic to publish to.
+        :param payload_func: A function returning the payload to publish.
+        :param interval: Seconds between publications. The first is published
+            one interval after scheduling.
+        :param jitter: The maximum random delay of each publication, in seconds.
+        :param qos: The Quality of Service level.
+        :param retain: Whether to retain the message.
+        :param properties: MQTT packet properties, see MQTTNode.publish.
+        :return: The publication, which can be cancelled.
+        """
+        if interval <= 0:
+            raise ValueError("interval must be positive")
+        if not 0 <= jitter <= interval:
+            raise ValueError("jitter must be between 0 and the interval")
+        publication = ScheduledPublication(
+            node, topic, payload_func, interval, jitter, qos, retain, properties
+        )
+        publication._lag = self.publish_schedule_lag.labels(
+            node.node_id, node.name, node.node_type, node.hostname
+        )
+        publication.nominal = time.monotonic() + interval
+        with self._condition:
+            self._insert(publication)
+            self._count += 1
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="publish_scheduler", daemon=True
+                )
+                self._thread.start()
+            self._condition.notify()
+        return publication
+
+    def _insert(self, publication: ScheduledPublication) -> None:
+        # Called with the condition held
+        publication.due = publication.nominal
+        if publication.jitter:
+            publication.due += random.uniform(0, publication.jitter)
+        # Round up, so no publication is published before it is due
+        due_tick = math.ceil((publication.due - self._start) / self.tick)
+        publication.due_tick = max(due_tick, self._current_tick)
+        self._wheel[publication.due_tick % self.slots].append(publication)
+
+    def _advance(self, now: float) -> List[ScheduledPublication]:
+        # Process the ticks up to now, returning the publications due. Called
+        # with the condition held
+        now_tick = int((now - self._start) / self.tick)
+        # After a full revolution every slot has been scanned
+        last_tick = min(now_tick, self._current_tick + self.slots - 1)
+        due = []
+        for tick in range(self._current_tick, last_tick + 1):
+            index = tick % self.slots
+            slot = self._wheel[index]
+            if not slot:
+                continue
+            remaining = []
+            for publication in slot:
+                if publication.cancelled:
+                    self._count -= 1
+                elif publication.due_tick <= now_tick:
+                    due.append(publication)
+                else:
+                    remaining.append(publication)
+            self._wheel[index] = remaining
+        self._current_tick = now_tick + 1
+        return due
+
+    def _reschedule(self, publications: List[ScheduledPublication], now: float) -> None:
+        with self._condition:
+            for publication in publications:
+                if publication.cancelled:
+                    self._count -= 1
+                    continue
+                interval = publication.interval
+                publication.nominal += interval
+                if publication.nominal <= now:
+                    # Skip periods missed while the process was busy
+                    missed = int((now - publication.nominal) // interval) + 1
+                    publication.nominal += interval * missed
+                self._insert(publication)
+
+    def _next_busy_tick(self) -> int:
+        # The next tick whose slot holds publications. Called with the
+        # condition held, while any are scheduled
+        for tick in range(self._current_tick, self._current_tick + self.slots):
+            if self._wheel[tick % self.slots]:
+                return tick
+        return self._current_tick + self.slots
+
+    def _publish(self, publications: List[ScheduledPublication]) -> None:
+        by_node: Dict[int, List[ScheduledPublication]] = {}
+        for publication in publications:
+            by_node.setdefault(id(publication.node), []).append(publication)
+        for batch in by_node.values():
+            node = batch[0].node
+            # Payloads are taken before the batch, so slow payload functions
+            # do not hold up the node's other publishers
+            payloads = []
+            for publication in batch:
+                if publication.cancelled:
+                    continue
+                try:
+                    payloads.append((publication, publication.payload_func()))
+                except Exception as e:
+                    node.logger.error(
+                        f"Error getting payload of scheduled publication to "
+                        f"'{publication.topic}': {e}"
+                    )
+            if not payloads:
+                continue
+            with node.publish_batch():
+                for publication, payload in payloads:
+                    publication._lag.observe(
+                        max(0.0, time.monotonic() - publication.due)
+                    )
+                    try:
+                        node.publish(
+                            publication.topic,
+                            payload,
+                            publication.qos,
+                            publication.retain,
+                            publication.properties,
+                        )
+                    except Exception as e:
+                        node.logger.error(
+                            f"Error during scheduled publication to "
+                            f"'{publication.topic}': {e}"
+                        )
+                        continue
+                    publication.published += 1
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._count:
+                    self._condition.wait()
+                # Sleep until the next tick with publications, or until an
+                # earlier one is scheduled
+                next_tick = self._next_busy_tick()
+                delay = self._start + next_tick * self.tick - time.monotonic()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                now = time.monotonic()
+                due = self._advance(now)
+            if due:
+                self._publish(due)
+                self._reschedule(due, now)
@@ -0,0 +1,416 @@
+"""Sinks, and a background pipeline flushing buffered metrics to them"""
+
+from __future__ import annotations
+import csv
+import json
+import logging
+from pathlib import Path
+import threading
+import time
+from typing import Any, Callable, List, Mapping, Optional, Sequence, Union
+from urllib.parse import urlencode
+
+from prometheus_client import Counter, Histogram
+
+from mqtt_node_network.configuration import FlushPipelineConfig
+from mqtt_node_network.line_protocol import PRECISIONS, LineProtocolSerializer
+
+logger = logging.getLogger(__name__)
+
+
+class SinkError(Exception):
+    """
+    Exception raised for errors in a metrics sink.
+    """
+
+    def __init__(self, message: str):
+        self.message = message
+        logger.error(self.message)
+        super().__init__(self.message)
+
+
+class MetricsSink:
+    """
+    A destination for batches of metrics. Subclasses implement write, which
+    should raise an exception if the batch could not be written, so it is retried.
+    """
+
+    name = "sink"
+
+    def write(self, metrics: List[Mapping]) -> None:
+        raise NotImplementedError("write must be implemented in child class")
+
+    def close(self) -> None:
+        pass
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(name={self.name!r})"
+
+
+class CallableSink(MetricsSink):
+    """A sink passing each batch of metrics to a function."""
+
+    def __init__(self, func: Callable[[List[Mapping]], Any], name: str = "callable"):
+        self.func = func
+        self.name = name
+
+    def write(self, metrics: List[Mapping]) -> None:
+        self.func(metrics)
+
+
+class _FileSink(MetricsSink):
+    def __init__(self, path: Union[str, Path], name: Optional[str] = None):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.name = name or self.path.name
+
+    def write(self, metrics: List[Mapping]) -> None:
+        with open(self.path, "a", newline="") as file:
+            self._write(file, metrics)
+
+    def _write(self, file, metrics: List[Mapping]) -> None:
+        raise NotImplementedError
+
+
+class JSONLinesFileSink(_FileSink):
+    """A sink appending metrics to a JSON lines file, one object per metric."""
+
+    def _write(self, file, metrics: List[Mapping]) -> None:
+        # Read-only mappings such as MetricRecord tags are written as objects
+        file.write(
+            "".join(json.dumps(dict(metric), default=dict) + "\n" for metric in metrics)
+        )
+
+
+class CSVFileSink(_FileSink):
+    """
+    A sink appending metrics to a CSV file, with one row per field:
+    time, measurement, tags, field, value. Tags are written as "key=value"
+    pairs separated by semicolons.
+    """
+
+    COLUMNS = ("time", "measurement", "tags", "field", "value")
+
+    def _write(self, file, metrics: List[Mapping]) -> None:
+        writer = csv.writer(file)
+        if file.tell() == 0:
+            writer.writerow(self.COLUMNS)
+        for metric in metrics:
+            tags = ";".join(f"{key}={value}" for key, value in metric["tags"].items())
+            for field, value in metric["fields"].items():
+                writer.writerow(
+                    (metric["time"], metric["measurement"], tags, field, value)
+                )
+
+
+class LineProtocolFileSink(_FileSink):
+    """A sink appending metrics to a file in InfluxDB line protocol."""
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        precision: str = "ns",
+        name: Optional[str] = None,
+    ):
+        if precision not in PRECISIONS:
+            raise SinkError(f"Unknown precision '{precision}'")
+        super().__init__(path, name)
+        self.precision = precision
+        self.serializer = LineProtocolSerializer(precision)
+
+    def write(self, metrics: List[Mapping]) -> None:
+        data = self.serializer.serialize(metrics)
+        with open(self.path, "ab") as file:
+            file.write(data)
+
+
+class InfluxDBHTTPSink(MetricsSink):
+    """A sink writing metrics to the InfluxDB v2 HTTP write API in line protocol."""
+
+    def __init__(
+        self,
+        url: str,
+        bucket: str,
+        org: str = "",
+        token: str = "",
+        precision: str = "ns",
+        timeout: float = 10,
+        name: str = "influxdb",
+    ):
+        if precision not in PRECISIONS:
+            raise SinkError(f"Unknown precision '{precision}'")
+        query = urlencode({"org": org, "bucket": bucket, "precision": precision})
+        self.write_url = f"{url.rstrip('/')}/api/v2/write?{query}"
+        self.token = token
+        self.precision = precision
+        self.serializer = LineProtocolSerializer(precision)
+        self.timeout = timeout
+        self.name = name
+
+    def write(self, metrics: List[Mapping]) -> None:
+        headers = {"Content-Type": "text/plain; charset=utf-8"}
+        if self.token:
+            headers["Authorization"] = f"Token {self.token}"
+        # Deferred, as urllib.request pulls in http.client and email
+        from urllib.request import Request, urlopen
+
+        request = Request(
+            self.write_url,
+            data=self.serializer.serialize(metrics),
+            headers=headers,
+            method="POST",
+        )
+        # Raises HTTPError for error responses
+        with urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+
+# Sinks which can be created from a config file
+SINK_TYPES = {
+    "jsonl": JSONLinesFileSink,
+    "csv": CSVFileSink,
+    "line_protocol": LineProtocolFileSink,
+    "influxdb": InfluxDBHTTPSink,
+}
+
+
+def create_sink(config: Mapping[str, Any]) -> MetricsSink:
+    """
+    Create a sink from a configuration mapping, such as an entry of
+    [[mqtt.metrics_node.flush.sinks]] in the config file.
+
+    :param config: The sink "type", one of SINK_TYPES, and its arguments.
+    """
+    config = dict(config)
+    sink_type = config.pop("type", None)
+    if sink_type not in SINK_TYPES:
+        raise SinkError(
+            f"Unknown sink type '{sink_type}'. Must be one of {tuple(SINK_TYPES)}"
+        )
+    return SINK_TYPES[sink_type](**config)
+
+
+def take_metrics(buffer, max_items: int) -> List:
+    """Remove and return up to max_items of the oldest metrics from a buffer."""
+    if hasattr(buffer, "drain"):
+        return buffer.drain(max_items)
+    metrics = []
+    if hasattr(buffer, "popleft"):
+        try:
+            while len(metrics) < max_items:
+                metrics.append(buffer.popleft())
+        except IndexError:
+            pass
+    else:
+        metrics = buffer[:max_items]
+        del buffer[: len(metrics)]
+    return metrics
+
+
+class MetricsFlushPipeline:
+    """
+    Drains a metrics buffer in batches on a background thread, and writes each
+    batch to one or more sinks.
+
+    A batch is flushed once `batch_size` metrics are buffered, or `flush_interval`
+    seconds after the last flush, whichever comes first. A sink failing to write
+    a batch is retried with exponential backoff, up to `max_retries` times, after
+    which the batch is dropped for that sink. Once every sink has written a
+    batch, `on_flushed` is called with the number of metrics in it. If any sink
+    dropped it, `on_dropped` is called instead.
+    """
+
+    sink_flush_latency = Histogram(
+        "metric_sink_flush_latency_seconds",
+        "Time taken by a sink to write a batch of metrics, including retries",
+        labelnames=("sink",),
+    )
+
+    sink_batch_size = Histogram(
+        "metric_sink_batch_size",
+        "Number of metrics in each batch flushed to a sink",
+        labelnames=("sink",),
+        buckets=(1, 10, 100, 500, 1000, 5000, 10000, 50000),
+    )
+
+    sink_failures_count = Counter(
+        "metric_sink_failures_total",
+        "Total number of failed attempts by a sink to write a batch of metrics",
+        labelnames=("sink",),
+    )
+
+    sink_dropped_count = Counter(
+        "metric_sink_dropped_total",
+        "Total number of metrics dropped by a sink after exhausting its retries",
+        labelnames=("sink",),
+    )
+
+    @classmethod
+    def from_config(
+        cls,
+        buffer,
+        config: FlushPipelineConfig,
+        sinks: Optional[Sequence[MetricsSink]] = None,
+        on_flushed: Optional[Callable[[int], Any]] = None,
+        on_dropped: Optional[Callable[[int], Any]] = None,
+        name: str = "flush",
+    ) -> MetricsFlushPipeline:
+        return cls(
+            buffer,
+            sinks if sinks is not None else [create_sink(s) for s in config.sinks],
+            batch_size=config.batch_size,
+            flush_interval=config.flush_interval,
+            max_retries=config.max_retries,
+            retry_backoff=config.retry_backoff,
+            max_backoff=config.max_backoff,
+            on_flushed=on_flushed,
+            on_dropped=on_dropped,
+            name=name,
+        )
+
+    def __init__(
+        self,
+        buffer,
+        sinks: Sequence[MetricsSink],
+        batch_size: int = 1000,
+        flush_interval: float = 1.0,
+        max_retries: Optional[int] = 5,
+        retry_backoff: float = 0.5,
+        max_backoff: float = 30,
+        on_flushed: Optional[Callable[[int], Any]] = None,
+        on_dropped: Optional[Callable[[int], Any]] = None,
+        name: str = "flush",
+    ):
+        """
+        Initialize a MetricsFlushPipeline.
+
+        :param buffer: The buffer to drain. A BoundedMetricsBuffer, deque or list.
+        :param sinks: The sinks to write each batch to.
+        :param batch_size: The maximum number of metrics per batch.
+        :param flush_interval: The maximum time in seconds between flushes.
+        :param max_retries: The number of times a failed write is retried before
+            the batch is dropped. None retries until the write succeeds.
+        :param retry_backoff: The delay in seconds before the first retry, which
+            doubles with each retry.
+        :param max_backoff: The maximum delay in seconds between retries.
+        :param on_flushed: Called with the number of metrics in each batch once
+            every sink has written it, e.g. to commit them in a write-ahead log.
+        :param on_dropped: Called with the number of metrics in each batch a
+            sink dropped after exhausting its retries.
+        :param name: A name for the pipeline, used to name its thread.
+        """
+        if not sinks:
+            raise SinkError("A flush pipeline needs at least one sink")
+        if batch_size <= 0:
+            raise SinkError("Flush batch_size must be greater than 0")
+        self.buffer = buffer
+        self.sinks = list(sinks)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.max_backoff = max_backoff
+        self.on_flushed = on_flushed
+        self.on_dropped = on_dropped
+        self.name = name
+
+        self._thread: Optional[threading.Thread] = None
+        self._stop_event = threading.Event()
+        self._wake_event = threading.Event()
+
+    def __repr__(self) -> str:
+        return (
+            f"{self.__class__.__name__}(name={self.name!r}, sinks={self.sinks!r}, "
+            f"batch_size={self.batch_size}, flush_interval={self.flush_interval})"
+        )
+
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> MetricsFlushPipeline:
+        """Start flushing on a background thread."""
+        if self.is_running():
+            return self
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Stop the background thread, flushing the metrics still buffered."""
+        if self.is_running():
+            self._stop_event.set()
+            self._wake_event.set()
+            self._thread.join(timeout=timeout)
+        self._thread = None
+        while self.flush():
+            pass
+        for sink in self.sinks:
+            sink.close()
+
+    def notify(self) -> None:
+        """Wake the pipeline if a full batch is buffered."""
+        if len(self.buffer) >= self.batch_size:
+            self._wake_event.set()
+
+    def _run(self) -> None:
+        while not self._stop_event.is_set():
+            self._wake_event.wait(self.flush_interval)
+            self._wake_event.clear()
+            while not self._stop_event.is_set() and self.flush() == self.batch_size:
+                # Keep going while full batches are buffered
+                pass
+
+    def flush(self) -> int:
+        """
+        Flush one batch of metrics from the buffer to every sink.
+
+        :return: The number of metrics in the batch.
+        """
+        metrics = take_metrics(self.buffer, self.batch_size)
+        if not metrics:
+            return 0
+        # Every sink is written to, even once one has dropped the batch
+        written = [self._write(sink, metrics) for sink in self.sinks]
+        callback = self.on_flushed if all(written) else self.on_dropped
+        if callback is not None:
+            try:
+                callback(len(metrics))
+            except Exception as e:
+                logger.error(f"Flush callback failed: {e}")
+        return len(metrics)
+
+    def _write(self, sink: MetricsSink, metrics: List) -> bool:
+        start = time.perf_counter()
+        backoff = self.retry_backoff
+        attempt = 0
+        while True:
+            try:
+                sink.write(metrics)
+                break
+            except Exception as e:
+                self.sink_failures_count.labels(sink.name).inc()
+                attempt += 1
+                # When stopping, unlimited retries would never let the pipeline stop
+                max_retries = self.max_retries
+                if max_retries is None and self._stop_event.is_set():
+                    max_retries = 0
+                if max_retries is not None and attempt > max_retries:
+                    logger.error(
+                        f"Sink {sink.name} failed to write {len(metrics)} metrics: {e}. "
+                        "Dropping batch",
+                        extra={"sink": sink.name, "batch_size": len(metrics)},
+                    )
+                    self.sink_dropped_count.labels(sink.name).inc(len(metrics))
+                    return False
+                logger.warning(
+                    f"Sink {sink.name} failed to write {len(metrics)} metrics: {e}. "
+                    f"Retrying in {backoff}s",
+                    extra={"sink": sink.name, "attempt": attempt},
+                )
+                # Stopping cuts the wait short, but the batch is still retried
+                self._stop_event.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+        self.sink_flush_latency.labels(sink.name).observe(time.perf_counter() - start)
+        self.sink_batch_size.labels(sink.name).observe(len(metrics))
+        return True
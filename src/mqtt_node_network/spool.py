@@ -0,0 +1,530 @@
+"""A durable on-disk spool for messages published while disconnected"""
+
+from __future__ import annotations
+from collections import deque
+import logging
+import mmap
+from pathlib import Path
+import struct
+import threading
+import time
+from typing import Deque, NamedTuple, Optional, Tuple, Union
+import zlib
+
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+from prometheus_client import Counter, Gauge
+
+from mqtt_node_network.configuration import OutboundSpoolConfig
+from mqtt_node_network.directory_lock import lock_directory
+
+logger = logging.getLogger(__name__)
+
+# Record length, CRC32 of the rest of the record, timestamp, QoS, retain,
+# topic length and properties length
+RECORD_HEADER = struct.Struct("<IIdBBHI")
+# Segment sequence number and offset of the next record to replay
+CURSOR = struct.Struct("<QQ")
+SEGMENT_SUFFIX = ".seg"
+CURSOR_FILE = "cursor"
+
+
+class SpoolError(Exception):
+    """
+    Exception raised for errors in an outbound spool.
+    """
+
+    def __init__(self, message: str):
+        self.message = message
+        logger.error(self.message)
+        super().__init__(self.message)
+
+
+class SpooledMessage(NamedTuple):
+    """A message read back from the spool."""
+
+    topic: str
+    payload: bytes
+    qos: int
+    retain: bool
+    properties: Optional[Properties]
+    timestamp: float
+
+
+class _Segment:
+    __slots__ = ("seq", "path", "file", "map", "write_offset", "count")
+
+    def __init__(self, seq: int, path: Path, capacity: Optional[int] = None):
+        self.seq = seq
+        self.path = path
+        if capacity is not None:
+            # New segments are preallocated, and zero filled, to their capacity
+            with open(path, "wb") as file:
+                file.truncate(capacity)
+        self.file = open(path, "r+b")
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        self.write_offset = 0
+        # Records not yet replayed
+        self.count = 0
+
+    @property
+    def capacity(self) -> int:
+        return len(self.map)
+
+    def close(self) -> None:
+        self.map.close()
+        self.file.close()
+
+
+class OutboundSpool:
+    """
+    A durable FIFO of outbound MQTT messages, stored as an append-only log of
+    memory-mapped segment files in a directory.
+
+    Messages are appended to the newest segment, and a new segment is started
+    when it is full. Messages are read for replay with `replay_next`, and only
+    removed once acknowledged, so a cursor file records the oldest message not
+    yet acknowledged and a restarted process resumes from there. Messages are
+    replayed at least once: those acknowledged after the last flush may be
+    replayed again after a crash.
+
+    Writes are synced to disk in batches, every `fsync_batch` messages or
+    `fsync_interval` seconds, whichever comes first, and `fsync_interval`
+    seconds after the last write. When the spool grows past `max_bytes`, whole
+    segments are evicted, oldest first.
+
+    A spool holds an exclusive lock on its directory while it is open, so a
+    directory is only ever written by one spool.
+    """
+
+    node_spool_depth = Gauge(
+        "node_spool_depth",
+        "Number of messages waiting in a node's outbound spool",
+        labelnames=("spool",),
+    )
+
+    node_spool_age_seconds = Gauge(
+        "node_spool_age_seconds",
+        "Age of the oldest message waiting in a node's outbound spool",
+        labelnames=("spool",),
+    )
+
+    node_spool_evicted_count = Counter(
+        "node_spool_evicted_total",
+        "Total number of messages evicted from a full outbound spool",
+        labelnames=("spool",),
+    )
+
+    @classmethod
+    def from_config(
+        cls,
+        config: OutboundSpoolConfig,
+        name: str = "spool",
+        path: Optional[Union[str, Path]] = None,
+    ):
+        return cls(
+            path=path if path is not None else config.path,
+            segment_size=config.segment_size,
+            max_bytes=config.max_bytes,
+            fsync_batch=config.fsync_batch,
+            fsync_interval=config.fsync_interval,
+            name=name,
+        )
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        segment_size: int = 16 * 1024 * 1024,
+        max_bytes: int = 256 * 1024 * 1024,
+        fsync_batch: int = 100,
+        fsync_interval: float = 1.0,
+        name: str = "spool",
+    ):
+        """
+        Initialize an OutboundSpool, recovering any messages left in the directory.
+
+        :param path: The directory holding the spool's segment files.
+        :param segment_size: The size in bytes of each segment file. Larger
+            messages are given a segment of their own.
+        :param max_bytes: The total size of segments kept before the oldest are
+            evicted.
+        :param fsync_batch: Sync to disk after this many appended messages.
+        :param fsync_interval: Sync to disk when this many seconds have passed
+            since the last sync.
+        :param name: A name for the spool, used to label Prometheus metrics.
+        :raises SpoolError: If the directory is locked by another open spool.
+        """
+        if segment_size <= RECORD_HEADER.size:
+            raise SpoolError("Spool segment_size is too small")
+        if max_bytes < segment_size:
+            raise SpoolError("Spool max_bytes must be at least segment_size")
+
+        self.path = Path(path)
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self.fsync_batch = fsync_batch
+        self.fsync_interval = fsync_interval
+        self.name = name
+
+        self._lock = threading.Lock()
+        self._segments: Deque[_Segment] = deque()
+        self._read_offset = 0
+        self._count = 0
+        # The index of the oldest message, counting messages removed since the
+        # spool was opened, the number replayed but not yet acknowledged, and
+        # the segment and offset of the next to replay
+        self._first_index = 0
+        self._replayed = 0
+        self._replay_seq = 0
+        self._replay_offset = 0
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._sync_timer: Optional[threading.Timer] = None
+
+        self.path.mkdir(parents=True, exist_ok=True)
+        try:
+            self._lock_file = lock_directory(self.path)
+        except OSError as e:
+            raise SpoolError(f"Spool directory {self.path} is already in use: {e}")
+        self._cursor_file, self._cursor = self._open_cursor()
+        self._recover()
+
+        self._evicted = self.node_spool_evicted_count.labels(name)
+        self.node_spool_depth.labels(name).set_function(lambda: len(self))
+        self.node_spool_age_seconds.labels(name).set_function(self.oldest_age)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __bool__(self) -> bool:
+        return self._count > 0
+
+    def __repr__(self) -> str:
+        return (
+            f"{self.__class__.__name__}(path={str(self.path)!r}, len={len(self)}, "
+            f"segments={len(self._segments)})"
+        )
+
+    @property
+    def size_bytes(self) -> int:
+        """The total size of the spool's segment files."""
+        return sum(segment.capacity for segment in self._segments)
+
+    # Recovery
+    # ***************************************************************************
+
+    def _open_cursor(self):
+        cursor_path = self.path / CURSOR_FILE
+        if not cursor_path.exists() or cursor_path.stat().st_size != CURSOR.size:
+            cursor_path.write_bytes(CURSOR.pack(0, 0))
+        file = open(cursor_path, "r+b")
+        return file, mmap.mmap(file.fileno(), CURSOR.size)
+
+    def _recover(self) -> None:
+        cursor_seq, cursor_offset = CURSOR.unpack_from(self._cursor)
+        paths = sorted(self.path.glob(f"*{SEGMENT_SUFFIX}"))
+        for path in paths:
+            seq = int(path.stem)
+            if seq < cursor_seq:
+                # Fully replayed before the process stopped
+                path.unlink()
+                continue
+            segment = _Segment(seq, path)
+            start = cursor_offset if seq == cursor_seq else 0
+            segment.write_offset, segment.count = self._scan(segment, start)
+            if not self._segments:
+                self._read_offset = start
+            self._segments.append(segment)
+            self._count += segment.count
+        if self._segments:
+            self._set_cursor(self._segments[0].seq, self._read_offset)
+        self._prune()
+        self._rewind()
+        if self._count:
+            logger.info(
+                f"Recovered {self._count} messages from spool at {self.path}",
+            )
+
+    def _scan(self, segment: _Segment, start: int):
+        # Find the end of the valid records in a segment, counting those after start
+        offset, count = 0, 0
+        data = segment.map
+        while offset + RECORD_HEADER.size <= len(data):
+            length, crc = struct.unpack_from("<II", data, offset)
+            if length < RECORD_HEADER.size or offset + length > len(data):
+                break
+            if zlib.crc32(data[offset + 8 : offset + length]) != crc:
+                # A record torn by a crash ends the segment
+                logger.warning(
+                    f"Discarding corrupt record at offset {offset} of {segment.path}",
+                )
+                break
+            if offset >= start:
+                count += 1
+            offset += length
+        return offset, count
+
+    # Writing
+    # ***************************************************************************
+
+    def append(
+        self,
+        topic: str,
+        payload: bytes,
+        qos: int = 0,
+        retain: bool = False,
+        properties: Optional[Properties] = None,
+    ) -> None:
+        """
+        Append a message to the spool.
+
+        :param payload: The encoded payload.
+        :param properties: The message's PUBLISH properties (optional).
+        """
+        topic_bytes = topic.encode("utf-8")
+        properties_bytes = properties.pack() if properties is not None else b""
+        length = (
+            RECORD_HEADER.size + len(topic_bytes) + len(properties_bytes) + len(payload)
+        )
+        record = bytearray(length)
+        RECORD_HEADER.pack_into(
+            record,
+            0,
+            length,
+            0,
+            time.time(),
+            qos,
+            retain,
+            len(topic_bytes),
+            len(properties_bytes),
+        )
+        offset = RECORD_HEADER.size
+        for part in (topic_bytes, properties_bytes, payload):
+            record[offset : offset + len(part)] = part
+            offset += len(part)
+        struct.pack_into("<I", record, 4, zlib.crc32(memoryview(record)[8:]))
+
+        with self._lock:
+            segment = self._segments[-1] if self._segments else None
+            if segment is None or segment.write_offset + length > segment.capacity:
+                segment = self._new_segment(length)
+            segment.map[segment.write_offset : segment.write_offset + length] = record
+            segment.write_offset += length
+            segment.count += 1
+            self._count += 1
+            self._unsynced += 1
+            self._evict()
+            if (
+                self._unsynced >= self.fsync_batch
+                or time.monotonic() - self._last_sync >= self.fsync_interval
+            ):
+                self._sync()
+            elif self._sync_timer is None:
+                # Sync the tail of a burst of writes once they stop
+                self._sync_timer = threading.Timer(
+                    self.fsync_interval, self._sync_later
+                )
+                self._sync_timer.daemon = True
+                self._sync_timer.start()
+
+    def _new_segment(self, length: int) -> _Segment:
+        # Called with the lock held
+        seq = self._segments[-1].seq + 1 if self._segments else self._cursor_seq()
+        if self._segments:
+            # Make sure the finished segment is on disk before moving on
+            self._segments[-1].map.flush()
+        segment = _Segment(
+            seq,
+            self.path / f"{seq:016d}{SEGMENT_SUFFIX}",
+            capacity=max(self.segment_size, length),
+        )
+        if not self._segments:
+            self._read_offset = 0
+            self._set_cursor(seq, 0)
+            self._replay_seq, self._replay_offset = seq, 0
+        self._segments.append(segment)
+        self._prune()
+        return segment
+
+    def _evict(self) -> None:
+        # Called with the lock held. The newest segment is never evicted
+        while len(self._segments) > 1 and self.size_bytes > self.max_bytes:
+            segment = self._segments[0]
+            self._count -= segment.count
+            self._first_index += segment.count
+            self._replayed = max(0, self._replayed - segment.count)
+            self._evicted.inc(segment.count)
+            logger.warning(
+                f"Spool full. Evicted {segment.count} of the oldest messages",
+            )
+            self._remove_oldest_segment()
+
+    def _prune(self) -> None:
+        # Called with the lock held. Remove replayed segments ahead of the newest
+        while len(self._segments) > 1 and self._segments[0].count == 0:
+            self._remove_oldest_segment()
+
+    def _remove_oldest_segment(self) -> None:
+        # Called with the lock held, while a newer segment remains
+        segment = self._segments.popleft()
+        segment.close()
+        segment.path.unlink()
+        self._read_offset = 0
+        self._set_cursor(self._segments[0].seq, 0)
+        if self._replay_seq < self._segments[0].seq:
+            self._replay_seq, self._replay_offset = self._segments[0].seq, 0
+
+    def _cursor_seq(self) -> int:
+        return CURSOR.unpack_from(self._cursor)[0]
+
+    def _set_cursor(self, seq: int, offset: int) -> None:
+        CURSOR.pack_into(self._cursor, 0, seq, offset)
+
+    def _sync(self) -> None:
+        # Called with the lock held
+        if self._sync_timer is not None:
+            self._sync_timer.cancel()
+            self._sync_timer = None
+        if self._segments:
+            self._segments[-1].map.flush()
+        self._cursor.flush()
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def _sync_later(self) -> None:
+        with self._lock:
+            # Unless the spool was synced, or closed, since the timer was started
+            if self._sync_timer is threading.current_thread():
+                self._sync()
+
+    def flush(self) -> None:
+        """Sync appended messages and the replay cursor to disk."""
+        with self._lock:
+            self._sync()
+
+    # Reading
+    # ***************************************************************************
+
+    def _read(self, segment: _Segment, offset: int) -> SpooledMessage:
+        (
+            length,
+            _,
+            timestamp,
+            qos,
+            retain,
+            topic_length,
+            properties_length,
+        ) = RECORD_HEADER.unpack_from(segment.map, offset)
+        start = offset + RECORD_HEADER.size
+        topic = segment.map[start : start + topic_length].decode("utf-8")
+        start += topic_length
+        properties = None
+        if properties_length:
+            properties = Properties(PacketTypes.PUBLISH)
+            properties.unpack(segment.map[start : start + properties_length])
+        start += properties_length
+        payload = segment.map[start : offset + length]
+        return SpooledMessage(topic, payload, qos, bool(retain), properties, timestamp)
+
+    def peek(self) -> Optional[SpooledMessage]:
+        """Get the oldest message without removing it, or None if empty."""
+        with self._lock:
+            if not self._count:
+                return None
+            return self._read(self._segments[0], self._read_offset)
+
+    def replay_next(self) -> Optional[Tuple[int, SpooledMessage]]:
+        """
+        Get the next message to replay, following those already replayed but
+        not yet acknowledged.
+
+        :return: The message's index, to acknowledge it with, and the message,
+            or None once every message has been replayed.
+        """
+        with self._lock:
+            if self._replayed >= self._count:
+                return None
+            for segment in self._segments:
+                if segment.seq < self._replay_seq:
+                    continue
+                if segment.seq > self._replay_seq:
+                    self._replay_seq, self._replay_offset = segment.seq, 0
+                if self._replay_offset < segment.write_offset:
+                    break
+            message = self._read(segment, self._replay_offset)
+            self._replay_offset += struct.unpack_from(
+                "<I", segment.map, self._replay_offset
+            )[0]
+            index = self._first_index + self._replayed
+            self._replayed += 1
+            return index, message
+
+    def unreplayed(self) -> int:
+        """The number of messages not yet replayed."""
+        with self._lock:
+            return self._count - self._replayed
+
+    def acknowledge(self, index: int) -> None:
+        """Remove the messages up to and including a replayed message's index."""
+        with self._lock:
+            for _ in range(index + 1 - self._first_index):
+                if not self._remove_oldest():
+                    break
+
+    def rewind(self) -> None:
+        """Replay again from the oldest message not yet acknowledged."""
+        with self._lock:
+            self._rewind()
+
+    def _rewind(self) -> None:
+        # Called with the lock held
+        self._replayed = 0
+        if self._segments:
+            self._replay_seq = self._segments[0].seq
+            self._replay_offset = self._read_offset
+
+    def advance(self) -> None:
+        """Remove the oldest message, once it has been replayed."""
+        with self._lock:
+            self._remove_oldest()
+
+    def _remove_oldest(self) -> bool:
+        # Called with the lock held
+        if not self._count:
+            return False
+        segment = self._segments[0]
+        length = struct.unpack_from("<I", segment.map, self._read_offset)[0]
+        self._read_offset += length
+        segment.count -= 1
+        self._count -= 1
+        self._first_index += 1
+        self._set_cursor(segment.seq, self._read_offset)
+        if self._replayed:
+            self._replayed -= 1
+        else:
+            self._replay_seq, self._replay_offset = segment.seq, self._read_offset
+        self._prune()
+        return True
+
+    def oldest_age(self) -> float:
+        """The age in seconds of the oldest message, or 0 if empty."""
+        with self._lock:
+            if not self._count:
+                return 0.0
+            segment = self._segments[0]
+            timestamp = struct.unpack_from("<d", segment.map, self._read_offset + 8)[0]
+        return max(0.0, time.time() - timestamp)
+
+    def close(self) -> None:
+        """Sync to disk and close the segment files."""
+        with self._lock:
+            self._sync()
+            for segment in self._segments:
+                segment.close()
+            self._segments.clear()
+            self._count = 0
+            self._cursor.close()
+            self._cursor_file.close()
+            self._lock_file.close()
+        self.node_spool_depth.remove(self.name)
+        self.node_spool_age_seconds.remove(self.name)
@@ -0,0 +1,422 @@
+"""Host many MQTTNodes on a single network thread"""
+
+from __future__ import annotations
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import logging
+from pathlib import Path
+import selectors
+import socket
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Type, Union
+
+import paho.mqtt.client as mqtt
+from paho.mqtt.enums import _ConnectionState
+
+from mqtt_node_network.node import MQTTNode, NodeError
+
+logger = logging.getLogger(__name__)
+
+# Connection states in which a node has been asked to disconnect, and must not
+# be reconnected
+_DISCONNECT_STATES = (
+    _ConnectionState.MQTT_CS_DISCONNECTING,
+    _ConnectionState.MQTT_CS_DISCONNECTED,
+)
+
+
+class _NodeState:
+    # Book-keeping for a node hosted by a NodeReactor
+    __slots__ = ("node", "fd", "events", "reconnect_delay", "next_reconnect")
+
+    def __init__(self, node: MQTTNode):
+        self.node = node
+        self.fd: Optional[int] = None
+        self.events = 0
+        self.reconnect_delay = 1.0
+        self.next_reconnect = 0.0
+
+
+class NodeReactor:
+    """
+    Drives the network traffic of many MQTTNodes from one thread.
+
+    Each paho client normally runs its own network thread. A NodeReactor
+    instead watches the sockets of all its nodes with a single selector, and
+    calls loop_misc on each node to send keepalives and detect lost connections.
+    The blocking TCP (and TLS) connects are run on a small, fixed pool of
+    threads, and lost connections are reconnected with exponential backoff.
+
+    Nodes are attached with `MQTTNode.attach_reactor` (or `NodeSwarm.add`),
+    after which `MQTTNode.connect` hands the node to the reactor instead of
+    starting a paho thread.
+    """
+
+    def __init__(
+        self,
+        connect_workers: int = 4,
+        misc_interval: float = 1.0,
+        max_reconnect_delay: float = 30.0,
+    ):
+        """
+        Initialize a NodeReactor.
+
+        :param connect_workers: The number of threads used for connecting.
+        :param misc_interval: Seconds between keepalive checks of each node.
+        :param max_reconnect_delay: The maximum backoff between reconnects, in seconds.
+        """
+        self.misc_interval = misc_interval
+        self.max_reconnect_delay = max_reconnect_delay
+        self._selector = selectors.DefaultSelector()
+        self._executor = ThreadPoolExecutor(
+            max_workers=connect_workers, thread_name_prefix="NodeReactor-connect"
+        )
+        # Keyed by paho client, as that is what the socket callbacks receive
+        self._states: Dict[mqtt.Client, _NodeState] = {}
+        # Selector changes requested by other threads, applied by the reactor thread
+        self._changes: deque = deque()
+        self._lock = threading.Lock()
+        self._waker_r, self._waker_w = socket.socketpair()
+        self._waker_r.setblocking(False)
+        self._waker_w.setblocking(False)
+        self._woken = False
+        self._selector.register(self._waker_r, selectors.EVENT_READ, None)
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    def __enter__(self) -> NodeReactor:
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.stop()
+
+    def start(self) -> NodeReactor:
+        """Start the reactor thread."""
+        if self._thread is None or not self._thread.is_alive():
+            self._running = True
+            self._thread = threading.Thread(
+                target=self.run, name="NodeReactor", daemon=True
+            )
+            self._thread.start()
+        return self
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """Disconnect all nodes, and stop the reactor thread."""
+        for state in list(self._states.values()):
+            if state.node.is_connected():
+                state.node.disconnect()
+        # Give the DISCONNECT packets a chance to be written
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and any(
+            client.want_write() for client in self._states
+        ):
+            time.sleep(0.01)
+        self._running = False
+        self._wake()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+        self._executor.shutdown(wait=False)
+        for state in list(self._states.values()):
+            self.remove(state.node)
+
+    def add(self, node: MQTTNode) -> None:
+        """
+        Start driving a node, connecting it in the background.
+
+        The node must already have been given its connection parameters, as
+        MQTTNode.connect does with connect_async.
+        """
+        client = node.client
+        state = _NodeState(node)
+        # The first connect is submitted below, so hold off reconnecting
+        state.next_reconnect = float("inf")
+        with self._lock:
+            if client in self._states:
+                return
+            self._states[client] = state
+        client.on_socket_open = self._on_socket_open
+        client.on_socket_close = self._on_socket_close
+        client.on_socket_register_write = self._on_socket_register_write
+        client.on_socket_unregister_write = self._on_socket_unregister_write
+        self._executor.submit(self._connect, node)
+
+    def remove(self, node: MQTTNode) -> None:
+        """Stop driving a node. The node is not disconnected."""
+        with self._lock:
+            state = self._states.pop(node.client, None)
+        if state is None:
+            return
+        client = node.client
+        client.on_socket_open = None
+        client.on_socket_close = None
+        client.on_socket_register_write = None
+        client.on_socket_unregister_write = None
+        if state.fd is not None:
+            self._request(self._unregister, state.fd)
+
+    # Selector changes
+    # ***************************************************************************
+    # paho calls the socket callbacks from whichever thread is connecting or
+    # publishing, but only the reactor thread may touch the selector
+
+    def _request(self, change, *args) -> None:
+        self._changes.append((change, args))
+        self._wake()
+
+    def _wake(self) -> None:
+        if threading.current_thread() is self._thread:
+            return
+        with self._lock:
+            if self._woken:
+                return
+            self._woken = True
+        try:
+            self._waker_w.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass
+
+    def _apply_changes(self) -> None:
+        while self._changes:
+            change, args = self._changes.popleft()
+            change(*args)
+
+    def _register(self, state: _NodeState, fd: int) -> None:
+        self._unregister(fd)
+        state.fd = fd
+        state.events = selectors.EVENT_READ
+        if state.node.client.want_write():
+            state.events |= selectors.EVENT_WRITE
+        self._selector.register(fd, state.events, state)
+
+    def _unregister(self, fd: int) -> None:
+        try:
+            self._selector.unregister(fd)
+        except (KeyError, ValueError):
+            pass
+
+    def _set_write(self, state: _NodeState, fd: int, enabled: bool) -> None:
+        if state.fd != fd:
+            return
+        # A publish from another thread may have queued a packet after paho
+        # decided the socket no longer needed writing
+        enabled = enabled or state.node.client.want_write()
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if enabled else 0)
+        if events != state.events:
+            state.events = events
+            try:
+                self._selector.modify(fd, events, state)
+            except (KeyError, ValueError):
+                pass
+
+    def _on_socket_open(self, client, userdata, sock):
+        state = self._states.get(client)
+        if state is not None:
+            self._request(self._register, state, sock.fileno())
+
+    def _on_socket_close(self, client, userdata, sock):
+        state = self._states.get(client)
+        fd = sock.fileno()
+        if state is not None and state.fd == fd:
+            state.fd = None
+        # Unregister straight away when possible, as the fd may be reused
+        if threading.current_thread() is self._thread:
+            self._unregister(fd)
+        else:
+            self._request(self._unregister, fd)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        state = self._states.get(client)
+        if state is not None:
+            self._request(self._set_write, state, sock.fileno(), True)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        state = self._states.get(client)
+        if state is not None:
+            self._request(self._set_write, state, sock.fileno(), False)
+
+    # Connecting
+    # ***************************************************************************
+
+    def _connect(self, node: MQTTNode) -> None:
+        state = self._states.get(node.client)
+        if state is None:
+            return
+        try:
+            node.client.reconnect()
+        except (OSError, mqtt.WebsocketConnectionError) as e:
+            node.logger.error(f"Connection to {node.hostname}:{node.port} failed: {e}")
+            state.next_reconnect = time.monotonic() + state.reconnect_delay
+            state.reconnect_delay = min(
+                state.reconnect_delay * 2, self.max_reconnect_delay
+            )
+        else:
+            state.next_reconnect = time.monotonic()
+
+    # Main loop
+    # ***************************************************************************
+
+    def run(self) -> None:
+        """Run the reactor in the current thread, until stopped."""
+        self._thread = threading.current_thread()
+        self._running = True
+        next_misc = time.monotonic()
+        while self._running:
+            timeout = max(0.0, next_misc - time.monotonic())
+            for key, events in self._selector.select(timeout):
+                state = key.data
+                if state is None:
+                    self._drain_waker()
+                    continue
+                client = state.node.client
+                if events & selectors.EVENT_READ:
+                    client.loop_read()
+                if events & selectors.EVENT_WRITE and state.fd == key.fd:
+                    client.loop_write()
+            self._apply_changes()
+
+            now = time.monotonic()
+            if now >= next_misc:
+                self._loop_misc(now)
+                next_misc = now + self.misc_interval
+
+    def _drain_waker(self) -> None:
+        with self._lock:
+            self._woken = False
+        try:
+            while self._waker_r.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    def _loop_misc(self, now: float) -> None:
+        for client, state in list(self._states.items()):
+            if client.loop_misc() != mqtt.MQTT_ERR_NO_CONN:
+                if state.reconnect_delay > 1.0 and client.is_connected():
+                    state.reconnect_delay = 1.0
+                continue
+            if client._state in _DISCONNECT_STATES or client.socket() is not None:
+                continue
+            if now >= state.next_reconnect:
+                # Hold off further attempts until this one has finished
+                state.next_reconnect = float("inf")
+                state.node.logger.warning("Connection lost. Reconnecting ...")
+                self._executor.submit(self._connect, state.node)
+
+
+class NodeSwarm:
+    """
+    A group of MQTTNodes sharing one NodeReactor, for simulating many devices
+    from a single process.
+
+        with NodeSwarm.from_config_file(1000, "config/config.toml") as swarm:
+            swarm.connect()
+            for node in swarm:
+                node.publish(...)
+    """
+
+    def __init__(
+        self,
+        nodes: Optional[List[MQTTNode]] = None,
+        reactor: Optional[NodeReactor] = None,
+    ):
+        """
+        Initialize a NodeSwarm.
+
+        :param nodes: Nodes to add to the swarm.
+        :param reactor: The reactor to drive the nodes. Optional - if not set,
+            a new reactor is created.
+        """
+        self.reactor = reactor if reactor is not None else NodeReactor()
+        self.nodes: List[MQTTNode] = []
+        for node in nodes or []:
+            self.add(node)
+
+    @classmethod
+    def from_config_file(
+        cls,
+        num_nodes: int,
+        config_file: Union[str, Path],
+        secrets_file: Optional[Union[str, Path]] = None,
+        node_class: Type[MQTTNode] = MQTTNode,
+        name_template: Optional[str] = None,
+        reactor: Optional[NodeReactor] = None,
+        **kwargs,
+    ) -> NodeSwarm:
+        """
+        Create a swarm of nodes from a configuration file.
+
+        :param num_nodes: The number of nodes to create.
+        :param config_file: Path to the configuration file.
+        :param secrets_file: Path to the secrets file (optional).
+        :param node_class: The class of node to create.
+        :param name_template: A format string for the node names, given the
+            node's index, e.g. "device-{}". Names are used as MQTT client ids,
+            so must be unique. Optional - if not set, each node uses its node_id.
+        :param kwargs: Additional keyword arguments passed to each node.
+        """
+        if name_template is None:
+            # Nodes sharing the configured name would share a client id
+            kwargs.setdefault("name", None)
+        nodes = node_class.from_config_file_many(
+            num_nodes,
+            config_file=config_file,
+            secrets_file=secrets_file,
+            name_template=name_template,
+            **kwargs,
+        )
+        return cls(nodes, reactor=reactor)
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def __iter__(self) -> Iterator[MQTTNode]:
+        return iter(self.nodes)
+
+    def __getitem__(self, index: int) -> MQTTNode:
+        return self.nodes[index]
+
+    def __enter__(self) -> NodeSwarm:
+        self.reactor.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.stop()
+
+    def add(self, node: MQTTNode) -> MQTTNode:
+        """Add a node to the swarm. It is driven by the swarm's reactor once connected."""
+        node.attach_reactor(self.reactor)
+        self.nodes.append(node)
+        return node
+
+    def connect(self, ensure_connected: bool = False, timeout: float = 30) -> NodeSwarm:
+        """
+        Connect all nodes in the swarm.
+
+        :param ensure_connected: Wait until every node is connected.
+        :param timeout: The maximum time to wait, in seconds.
+        :raises NodeError: If not all nodes connect within the timeout.
+        """
+        self.reactor.start()
+        for node in self.nodes:
+            node.connect()
+        if ensure_connected:
+            deadline = time.monotonic() + timeout
+            for node in self.nodes:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not node._connect_event.wait(remaining):
+                    raise NodeError(
+                        f"Only {self.connected_count()} of {len(self)} nodes connected within {timeout}s"
+                    )
+        return self
+
+    def connected_count(self) -> int:
+        """The number of nodes currently connected."""
+        return sum(1 for node in self.nodes if node.is_connected())
+
+    def stop(self) -> None:
+        """Disconnect all nodes and stop the reactor."""
+        self.reactor.stop()
@@ -0,0 +1,106 @@
+"""MQTT 5 topic alias tables for shortening frequently published topics"""
+
+from __future__ import annotations
+from collections import OrderedDict
+import logging
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+TOPIC_ALIAS_POLICIES = ("lru", "lfu")
+
+# Bytes added to a PUBLISH packet by the Topic Alias property: an identifier
+# byte and a two byte integer
+TOPIC_ALIAS_PROPERTY_SIZE = 3
+
+
+class TopicAliasTable:
+    """
+    Assigns MQTT 5 topic aliases to outbound topics.
+
+    The broker limits the number of aliases per connection with the
+    TopicAliasMaximum property of its CONNACK. Topics are only given an alias
+    once they have been published `min_uses` times, so one-off topics do not
+    churn the table. When the table is full, the least recently used ("lru")
+    or least frequently used ("lfu") topic gives up its alias.
+
+    Aliases only live as long as a connection, so the table must be reset on
+    every connect.
+    """
+
+    def __init__(self, maximum: int = 0, policy: str = "lru", min_uses: int = 2):
+        """
+        Initialize a TopicAliasTable.
+
+        :param maximum: The maximum number of aliases, from the broker's CONNACK.
+            0 disables aliasing.
+        :param policy: The eviction policy, "lru" or "lfu".
+        :param min_uses: The number of publishes before a topic is given an alias.
+        """
+        if policy not in TOPIC_ALIAS_POLICIES:
+            raise ValueError(
+                f"Unknown topic alias policy '{policy}'. Must be one of {TOPIC_ALIAS_POLICIES}"
+            )
+        self.policy = policy
+        self.min_uses = min_uses
+        self.maximum = 0
+        self._aliases: OrderedDict[str, int] = OrderedDict()
+        self._uses: Dict[str, int] = {}
+        self.reset(maximum)
+
+    def __len__(self) -> int:
+        return len(self._aliases)
+
+    def __contains__(self, topic: str) -> bool:
+        return topic in self._aliases
+
+    def reset(self, maximum: int = 0) -> None:
+        """Forget all aliases, e.g. on reconnect, and set a new maximum."""
+        self.maximum = maximum or 0
+        self._aliases.clear()
+        self._uses.clear()
+
+    def assign(self, topic: str) -> Tuple[str, Optional[int]]:
+        """
+        Get the topic and alias to publish a message with.
+
+        :param topic: The full topic of the message.
+        :return: A tuple of (topic, alias). The topic is "" if the broker already
+            knows the alias. The alias is None if the topic has no alias.
+        """
+        if not self.maximum:
+            return topic, None
+
+        uses = self._uses.get(topic, 0) + 1
+        alias = self._aliases.get(topic)
+        if alias is not None:
+            self._uses[topic] = uses
+            self._aliases.move_to_end(topic)
+            return "", alias
+
+        if uses < self.min_uses:
+            self._count_unaliased_use(topic, uses)
+            return topic, None
+
+        if len(self._aliases) < self.maximum:
+            alias = len(self._aliases) + 1
+        else:
+            alias = self._aliases.pop(self._evict())
+        self._aliases[topic] = alias
+        self._uses[topic] = uses
+        # Sending the full topic with the alias binds the alias at the broker
+        return topic, alias
+
+    def _evict(self) -> str:
+        if self.policy == "lru":
+            topic = next(iter(self._aliases))
+        else:
+            topic = min(self._aliases, key=lambda t: self._uses.get(t, 0))
+        self._uses.pop(topic, None)
+        return topic
+
+    def _count_unaliased_use(self, topic: str, uses: int) -> None:
+        # Bound the use counts kept for topics without an alias
+        if len(self._uses) >= 4 * self.maximum + 1024:
+            self._uses = {t: self._uses.get(t, 0) for t in self._aliases}
+        self._uses[topic] = uses
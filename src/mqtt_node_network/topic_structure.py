@@ -0,0 +1,128 @@
+"""Parsing of metric topics against a topic structure template"""
+
+from __future__ import annotations
+from functools import lru_cache
+import logging
+from types import MappingProxyType
+from typing import Dict, Mapping, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class TopicStructure:
+    """
+    A topic structure template, compiled once and reused to parse many topics.
+
+    Parsed topics are kept in a bounded LRU cache keyed by topic string, so
+    repeated topics are returned without being split again.
+    """
+
+    def __init__(
+        self, structure: str, field_separator: str = "-", cache_size: int = 1024
+    ):
+        """
+        Args:
+            structure: The structure template to match against topics,
+                e.g. "machine/module/measurement/field*".
+            field_separator: Separator for multi-part fields. Defaults to "-".
+            cache_size: Maximum number of parsed topics to cache. Defaults to 1024.
+        """
+        self.structure = structure
+        self.field_separator = field_separator
+        keys = structure.rstrip("/").split("/")
+        # A trailing "*" lets the last key absorb any remaining topic levels
+        self.wildcard = keys[-1].endswith("*")
+        if self.wildcard:
+            keys[-1] = keys[-1][:-1]
+        self.keys = tuple(keys)
+        self._parse_cached = lru_cache(maxsize=cache_size)(self._parse_frozen)
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self.structure!r})"
+
+    def parse_uncached(self, topic: str) -> Dict[str, str]:
+        """
+        Parse a topic string into a new dictionary, bypassing the cache.
+
+        Raises:
+            ValueError: If the topic does not match the structure.
+        """
+        topic_parts = topic.rstrip("/").split("/")
+        len_diff = len(topic_parts) - len(self.keys)
+        if self.wildcard:
+            len_field = len_diff + 1
+        elif len_diff <= 0:
+            len_field = 1
+        else:
+            message = f"Metric not processed. Topic is too long for the given structure"
+            extra = {"topic": topic, "structure": self.structure}
+            logger.error(message, extra=extra)
+            raise ValueError(f"{message}; {extra}")
+
+        if len_field <= 0 or len_diff < 0:
+            message = f"Metric not processed. Topic is too short for the given structure"
+            extra = {"topic": topic, "structure": self.structure}
+            logger.error(message, extra=extra)
+            raise ValueError(f"{message}; {extra}")
+
+        parsed_dict = dict(zip(self.keys, topic_parts[:-len_field]))
+        parsed_dict[self.keys[-1]] = self.field_separator.join(
+            topic_parts[-len_field:]
+        )
+        return parsed_dict
+
+    def _parse_frozen(self, topic: str) -> Tuple[Mapping[str, str], Mapping[str, str]]:
+        parsed = self.parse_uncached(topic)
+        tags = {
+            key: value
+            for key, value in parsed.items()
+            if key != "measurement" and key != "field"
+        }
+        return MappingProxyType(parsed), MappingProxyType(tags)
+
+    def parse(self, topic: str) -> Mapping[str, str]:
+        """
+        Parse a topic string, returning a cached, read-only mapping.
+
+        Raises:
+            ValueError: If the topic does not match the structure.
+        """
+        return self._parse_cached(topic)[0]
+
+    def parse_with_tags(
+        self, topic: str
+    ) -> Tuple[Mapping[str, str], Mapping[str, str]]:
+        """
+        Parse a topic string, returning the cached, read-only parsed mapping along
+        with the mapping of tags, i.e. every key except "measurement" and "field".
+
+        Raises:
+            ValueError: If the topic does not match the structure.
+        """
+        return self._parse_cached(topic)
+
+    def cache_info(self):
+        """Return the hits, misses, maxsize and currsize of the topic cache."""
+        return self._parse_cached.cache_info()
+
+    def cache_clear(self) -> None:
+        self._parse_cached.cache_clear()
+
+
+def parse_topic(
+    topic: str, structure: str, field_separator: str = "-"
+) -> Dict[str, str]:
+    """
+    Parse a topic string into a dictionary based on a given structure.
+
+    Args:
+        topic: The topic string to parse.
+        structure: The structure template to match against the topic.
+        field_separator: Separator for multi-part fields. Defaults to "-".
+
+    Returns:
+        A dictionary mapping structure fields to topic parts.
+    """
+    return TopicStructure(structure, field_separator, cache_size=0).parse_uncached(
+        topic
+    )
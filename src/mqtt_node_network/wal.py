@@ -0,0 +1,477 @@
+"""A write-ahead log of received metrics, for crash-safe ingestion"""
+
+from __future__ import annotations
+import logging
+import os
+from pathlib import Path
+import struct
+import threading
+import time
+from typing import Dict, Iterable, List, Mapping, Optional, Tuple, Union
+import zlib
+
+from mqtt_node_network.configuration import MetricsWALConfig
+from mqtt_node_network.directory_lock import lock_directory
+
+logger = logging.getLogger(__name__)
+
+# Batch length, CRC32 of the rest of the batch, and number of metrics
+BATCH_HEADER = struct.Struct("<III")
+SEGMENT_SUFFIX = ".wal"
+COMMIT_FILE = "commit"
+
+_DOUBLE = struct.Struct("<d")
+_INT64 = struct.Struct("<q")
+_LENGTH = struct.Struct("<I")
+_COMMIT = struct.Struct("<Q")
+_RANGE = struct.Struct("<QQ")
+
+# Field value types
+_FLOAT, _INT, _STR, _BOOL = b"d", b"q", b"s", b"b"
+_INT64_MIN, _INT64_MAX = -(2**63), 2**63 - 1
+
+
+class MetricsWALError(Exception):
+    """
+    Exception raised for errors in a metrics write-ahead log.
+    """
+
+    def __init__(self, message: str):
+        self.message = message
+        logger.error(self.message)
+        super().__init__(self.message)
+
+
+def _put_str(out: bytearray, value: str) -> None:
+    data = value.encode("utf-8")
+    out += _LENGTH.pack(len(data))
+    out += data
+
+
+def encode_metric(metric: Mapping, out: bytearray) -> None:
+    """
+    Append the compact binary encoding of a metric to a bytearray.
+
+    A metric is encoded as its time, measurement, tags and fields. Strings and
+    counts of tags and fields are prefixed with their 32-bit length, and field
+    values are tagged float64, int64, bool or string values.
+    """
+    out += _DOUBLE.pack(metric["time"])
+    _put_str(out, metric["measurement"])
+    tags = metric["tags"]
+    out += _LENGTH.pack(len(tags))
+    for key, value in tags.items():
+        _put_str(out, key)
+        _put_str(out, str(value))
+    fields = metric["fields"]
+    out += _LENGTH.pack(len(fields))
+    for key, value in fields.items():
+        _put_str(out, key)
+        if isinstance(value, bool):
+            out += _BOOL
+            out.append(value)
+        elif isinstance(value, int) and _INT64_MIN <= value <= _INT64_MAX:
+            out += _INT
+            out += _INT64.pack(value)
+        elif isinstance(value, (int, float)):
+            out += _FLOAT
+            out += _DOUBLE.pack(value)
+        else:
+            out += _STR
+            _put_str(out, str(value))
+
+
+def _get_str(data: bytes, offset: int) -> Tuple[str, int]:
+    (length,) = _LENGTH.unpack_from(data, offset)
+    offset += 4
+    return data[offset : offset + length].decode("utf-8"), offset + length
+
+
+def decode_metric(data: bytes, offset: int) -> Tuple[Dict, int]:
+    """
+    Decode a metric encoded with encode_metric.
+
+    :return: The metric as a dictionary, and the offset following it.
+    """
+    (metric_time,) = _DOUBLE.unpack_from(data, offset)
+    measurement, offset = _get_str(data, offset + 8)
+    tags = {}
+    (count,) = _LENGTH.unpack_from(data, offset)
+    offset += 4
+    for _ in range(count):
+        key, offset = _get_str(data, offset)
+        tags[key], offset = _get_str(data, offset)
+    fields = {}
+    (count,) = _LENGTH.unpack_from(data, offset)
+    offset += 4
+    for _ in range(count):
+        key, offset = _get_str(data, offset)
+        kind = data[offset : offset + 1]
+        offset += 1
+        if kind == _FLOAT:
+            (fields[key],) = _DOUBLE.unpack_from(data, offset)
+            offset += 8
+        elif kind == _INT:
+            (fields[key],) = _INT64.unpack_from(data, offset)
+            offset += 8
+        elif kind == _BOOL:
+            fields[key] = bool(data[offset])
+            offset += 1
+        else:
+            fields[key], offset = _get_str(data, offset)
+    metric = {
+        "measurement": measurement,
+        "fields": fields,
+        "time": metric_time,
+        "tags": tags,
+    }
+    return metric, offset
+
+
+class MetricsWAL:
+    """
+    A write-ahead log of metrics, stored as CRC-checked batches of compact
+    binary records in append-only segment files.
+
+    Metrics are appended in batches before they are added to a node's buffer.
+    Once a consumer has flushed metrics taken from the buffer, or the buffer
+    has discarded them, they are committed, and on restart only metrics not yet
+    committed are replayed. Each metric has a log sequence number (LSN),
+    counting from 0, and segments are named after the LSN of their first
+    metric. Metrics may be committed in any order: `committed_lsn` is the LSN of
+    the oldest metric not yet committed, and the ranges of LSNs committed after
+    it are kept in the commit file too. Segments whose metrics are all
+    committed are deleted, so metrics left uncommitted only keep the segments
+    holding them.
+
+    Appends are synced to disk every `fsync_batch` metrics or `fsync_interval`
+    seconds, whichever comes first, and `fsync_interval` seconds after the last
+    append. Set fsync_batch to 1 to sync every batch as it is appended, at the
+    cost of throughput. paho acknowledges a message to the broker once
+    on_message returns, so a message is only synced before it is acknowledged
+    if it is parsed in on_message, i.e. if the node has no ingest workers.
+
+    A log holds an exclusive lock on its directory while it is open.
+    """
+
+    @classmethod
+    def from_config(
+        cls, config: MetricsWALConfig, path: Optional[Union[str, Path]] = None
+    ) -> MetricsWAL:
+        return cls(
+            path=path if path is not None else config.path,
+            segment_size=config.segment_size,
+            fsync_batch=config.fsync_batch,
+            fsync_interval=config.fsync_interval,
+        )
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        segment_size: int = 64 * 1024 * 1024,
+        fsync_batch: int = 10_000,
+        fsync_interval: float = 0.1,
+    ):
+        """
+        Initialize a MetricsWAL, recovering the log left in the directory.
+
+        :param path: The directory holding the log's segment files.
+        :param segment_size: The size in bytes at which a new segment is started.
+        :param fsync_batch: Sync to disk after this many appended metrics.
+        :param fsync_interval: Sync to disk when this many seconds have passed
+            since the last sync.
+        :raises MetricsWALError: If the directory is locked by another open log.
+        """
+        if segment_size <= BATCH_HEADER.size:
+            raise MetricsWALError("WAL segment_size is too small")
+
+        self.path = Path(path)
+        self.segment_size = segment_size
+        self.fsync_batch = fsync_batch
+        self.fsync_interval = fsync_interval
+
+        self._lock = threading.Lock()
+        # First LSN of each segment, oldest first
+        self._segments: List[int] = []
+        self._file = None
+        self._file_size = 0
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._sync_timer: Optional[threading.Timer] = None
+
+        self.path.mkdir(parents=True, exist_ok=True)
+        try:
+            self._lock_file = lock_directory(self.path)
+        except OSError as e:
+            raise MetricsWALError(f"WAL directory {self.path} is already in use: {e}")
+        self._commit_path = self.path / COMMIT_FILE
+        # The LSN of the oldest metric not yet committed, and the sorted,
+        # disjoint [start, end) ranges of LSNs committed beyond it
+        self.committed_lsn, self._committed_ranges = self._read_commit()
+        # The LSN the next appended metric will be given
+        self.next_lsn = self.committed_lsn
+        self._recover()
+
+    def __len__(self) -> int:
+        """The number of metrics appended but not yet committed."""
+        committed = sum(end - start for start, end in self._committed_ranges)
+        return self.next_lsn - self.committed_lsn - committed
+
+    def __repr__(self) -> str:
+        return (
+            f"{self.__class__.__name__}(path={str(self.path)!r}, "
+            f"committed_lsn={self.committed_lsn}, next_lsn={self.next_lsn})"
+        )
+
+    def _segment_path(self, first_lsn: int) -> Path:
+        return self.path / f"{first_lsn:020d}{SEGMENT_SUFFIX}"
+
+    # Recovery
+    # ***************************************************************************
+
+    def _read_commit(self) -> Tuple[int, List[Tuple[int, int]]]:
+        try:
+            data = self._commit_path.read_bytes()
+            (committed_lsn,) = _COMMIT.unpack_from(data)
+        except (FileNotFoundError, struct.error):
+            return 0, []
+        ranges = list(_RANGE.iter_unpack(data[_COMMIT.size :]))
+        return committed_lsn, ranges
+
+    def _recover(self) -> None:
+        for path in sorted(self.path.glob(f"*{SEGMENT_SUFFIX}")):
+            first_lsn = int(path.stem)
+            count, valid_size = self._scan(path)
+            if valid_size < path.stat().st_size:
+                # A batch torn by a crash ends the log
+                logger.warning(
+                    f"Truncating corrupt tail of {path} at offset {valid_size}",
+                )
+                os.truncate(path, valid_size)
+            self._segments.append(first_lsn)
+            self.next_lsn = max(self.next_lsn, first_lsn + count)
+        self._delete_committed_segments()
+
+    def _scan(self, path: Path) -> Tuple[int, int]:
+        # Count the metrics in a segment's valid batches, and their total size
+        data = path.read_bytes()
+        offset, count = 0, 0
+        while offset + BATCH_HEADER.size <= len(data):
+            length, crc, batch_count = BATCH_HEADER.unpack_from(data, offset)
+            if length < BATCH_HEADER.size or offset + length > len(data):
+                break
+            if zlib.crc32(data[offset + 8 : offset + length]) != crc:
+                break
+            count += batch_count
+            offset += length
+        return count, offset
+
+    def _iter_batches(self, first_lsn: int):
+        data = self._segment_path(first_lsn).read_bytes()
+        offset, lsn = 0, first_lsn
+        while offset + BATCH_HEADER.size <= len(data):
+            length, _, count = BATCH_HEADER.unpack_from(data, offset)
+            if length < BATCH_HEADER.size:
+                break
+            yield lsn, count, data, offset + BATCH_HEADER.size
+            offset += length
+            lsn += count
+
+    def replay_entries(self) -> List[Tuple[int, Dict]]:
+        """
+        Read back all metrics not yet committed, oldest first.
+
+        :return: A list of each metric's LSN and dictionary.
+        """
+        entries = []
+        with self._lock:
+            # Committed ranges, the oldest last
+            ranges = self._committed_ranges[::-1]
+            for first_lsn in self._segments:
+                for lsn, count, data, offset in self._iter_batches(first_lsn):
+                    if lsn + count <= self.committed_lsn:
+                        continue
+                    for metric_lsn in range(lsn, lsn + count):
+                        metric, offset = decode_metric(data, offset)
+                        while ranges and ranges[-1][1] <= metric_lsn:
+                            ranges.pop()
+                        if metric_lsn < self.committed_lsn or (
+                            ranges and ranges[-1][0] <= metric_lsn
+                        ):
+                            continue
+                        entries.append((metric_lsn, metric))
+        return entries
+
+    def replay(self) -> List[Dict]:
+        """
+        Read back all metrics not yet committed, oldest first.
+
+        :return: A list of metric dictionaries.
+        """
+        return [metric for _, metric in self.replay_entries()]
+
+    # Writing
+    # ***************************************************************************
+
+    def append(self, metrics: List[Mapping]) -> int:
+        """
+        Append a batch of metrics to the log.
+
+        :return: The LSN of the first metric in the batch.
+        """
+        batch = bytearray(BATCH_HEADER.size)
+        for metric in metrics:
+            encode_metric(metric, batch)
+        BATCH_HEADER.pack_into(batch, 0, len(batch), 0, len(metrics))
+        struct.pack_into("<I", batch, 4, zlib.crc32(memoryview(batch)[8:]))
+
+        with self._lock:
+            if self._file is None or self._file_size >= self.segment_size:
+                self._roll()
+            self._file.write(batch)
+            self._file_size += len(batch)
+            first_lsn = self.next_lsn
+            self.next_lsn += len(metrics)
+            self._unsynced += len(metrics)
+            if (
+                self._unsynced >= self.fsync_batch
+                or time.monotonic() - self._last_sync >= self.fsync_interval
+            ):
+                self._sync()
+            elif self._sync_timer is None:
+                # Sync the tail of a burst of appends once they stop
+                self._sync_timer = threading.Timer(
+                    self.fsync_interval, self._sync_later
+                )
+                self._sync_timer.daemon = True
+                self._sync_timer.start()
+        return first_lsn
+
+    def _roll(self) -> None:
+        # Called with the lock held. Start a new segment, unless the newest
+        # recovered segment still has room
+        if self._file is not None:
+            self._sync()
+            self._file.close()
+        elif self._segments:
+            path = self._segment_path(self._segments[-1])
+            if path.stat().st_size < self.segment_size:
+                self._file = open(path, "ab", buffering=0)
+                self._file_size = path.stat().st_size
+                return
+        self._segments.append(self.next_lsn)
+        self._file = open(self._segment_path(self.next_lsn), "ab", buffering=0)
+        self._file_size = 0
+
+    def _sync(self) -> None:
+        # Called with the lock held
+        if self._sync_timer is not None:
+            self._sync_timer.cancel()
+            self._sync_timer = None
+        if self._file is not None and self._unsynced:
+            os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def _sync_later(self) -> None:
+        with self._lock:
+            # Unless the log was synced, or closed, since the timer was started
+            if self._sync_timer is threading.current_thread():
+                self._sync()
+
+    def flush(self) -> None:
+        """Sync appended metrics to disk."""
+        with self._lock:
+            self._sync()
+
+    # Committing
+    # ***************************************************************************
+
+    def commit(self, count: int) -> int:
+        """
+        Commit the `count` metrics following the committed LSN, in the order
+        they were appended.
+
+        :return: The committed LSN, i.e. the LSN of the next metric to replay.
+        """
+        start = self.committed_lsn
+        return self.commit_lsns(range(start, min(start + count, self.next_lsn)))
+
+    def commit_lsns(self, lsns: Iterable[int]) -> int:
+        """
+        Commit metrics by their LSNs, in any order, once a consumer has flushed
+        them or the buffer has discarded them.
+
+        :return: The committed LSN, i.e. the LSN of the oldest metric not yet
+            committed.
+        """
+        ranges = []
+        for lsn in sorted(lsns):
+            if ranges and ranges[-1][1] == lsn:
+                ranges[-1][1] = lsn + 1
+            else:
+                ranges.append([lsn, lsn + 1])
+        with self._lock:
+            if not ranges:
+                return self.committed_lsn
+            merged: List[Tuple[int, int]] = []
+            for start, end in sorted(
+                self._committed_ranges + [tuple(r) for r in ranges]
+            ):
+                end = min(end, self.next_lsn)
+                if end <= self.committed_lsn or start >= end:
+                    continue
+                if merged and start <= merged[-1][1]:
+                    merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+                else:
+                    merged.append((start, end))
+            if merged and merged[0][0] <= self.committed_lsn:
+                self.committed_lsn = merged.pop(0)[1]
+            self._committed_ranges = merged
+            self._write_commit()
+            self._delete_committed_segments()
+            return self.committed_lsn
+
+    def _write_commit(self) -> None:
+        # Called with the lock held. Replace the commit file atomically
+        data = bytearray(_COMMIT.pack(self.committed_lsn))
+        for committed_range in self._committed_ranges:
+            data += _RANGE.pack(*committed_range)
+        temporary_path = self._commit_path.with_suffix(".tmp")
+        with open(temporary_path, "wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, self._commit_path)
+
+    def _delete_committed_segments(self) -> None:
+        # Delete the segments whose LSNs, up to the first LSN of the next
+        # segment, are all committed. The newest segment is kept for appending
+        if not self._segments:
+            return
+        kept = []
+        for first_lsn, next_lsn in zip(self._segments, self._segments[1:]):
+            if self._is_committed(first_lsn, next_lsn):
+                self._segment_path(first_lsn).unlink()
+            else:
+                kept.append(first_lsn)
+        kept.append(self._segments[-1])
+        self._segments = kept
+
+    def _is_committed(self, start: int, end: int) -> bool:
+        # Whether the LSNs in [start, end) are all committed. The committed
+        # ranges are disjoint and not adjacent, so they are within one range
+        start = max(start, self.committed_lsn)
+        return start >= end or any(
+            range_start <= start and end <= range_end
+            for range_start, range_end in self._committed_ranges
+        )
+
+    def close(self) -> None:
+        """Sync to disk and close the current segment."""
+        with self._lock:
+            self._sync()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            self._lock_file.close()
@@ -0,0 +1,102 @@
+from types import MappingProxyType
+
+import pytest
+
+from mqtt_node_network.aggregation import WindowedAggregator
+from mqtt_node_network.configuration import AggregationConfig
+from mqtt_node_network.metrics_node import MetricRecord, MQTTMetricsNode
+
+
+def make_metric(value, metric_time, field="sensorA", module="box1"):
+    return {
+        "measurement": "temperature",
+        "fields": {field: value},
+        "time": metric_time,
+        "tags": {"module": module},
+    }
+
+
+def test_tumbling_window_statistics():
+    aggregator = WindowedAggregator(window=10)
+    topic = "box1/temperature/sensorA"
+    for i, value in enumerate([3.0, 1.0, 2, 6.0]):
+        assert aggregator.add(topic, make_metric(value, 100 + i)) == []
+
+    # A sample in the next window closes the first
+    (metric,) = aggregator.add(topic, make_metric(7.0, 110.5))
+    assert metric == {
+        "measurement": "temperature",
+        "fields": {
+            "sensorA_min": 1.0,
+            "sensorA_max": 6.0,
+            "sensorA_mean": 3.0,
+            "sensorA_count": 4,
+            "sensorA_last": 6.0,
+        },
+        "time": 100,
+        "tags": {"module": "box1"},
+    }
+    assert len(aggregator) == 1
+
+
+def test_series_are_separate_and_collected_when_ended():
+    aggregator = WindowedAggregator(window=5, statistics=["count", "last"], grace=1)
+    aggregator.add("box1/temperature/sensorA", make_metric(1.0, 0))
+    aggregator.add("box2/temperature/sensorA", make_metric(2.0, 1, module="box2"))
+    aggregator.add("box1/temperature/sensorB", make_metric("on", 2, field="sensorB"))
+    assert len(aggregator) == 3
+
+    assert aggregator.collect(now=5.5) == []
+    emitted = aggregator.collect(now=6)
+    assert [(m["tags"]["module"], m["fields"]) for m in emitted] == [
+        ("box1", {"sensorA_count": 1, "sensorA_last": 1.0}),
+        ("box2", {"sensorA_count": 1, "sensorA_last": 2.0}),
+        ("box1", {"sensorB_count": 1, "sensorB_last": "on"}),
+    ]
+    assert len(aggregator) == 0
+
+
+def test_windows_per_topic_filter():
+    aggregator = WindowedAggregator(
+        window=0, windows={"box1/temperature/#": 60, "+/temperature/#": 10}
+    )
+    assert aggregator.window_for("box1/temperature/sensorA") == 60
+    assert aggregator.window_for("box2/temperature/sensorA") == 10
+    # Unmatched topics pass through unaggregated
+    metric = make_metric(1.0, 0)
+    assert aggregator.add("box1/pressure/sensorA", metric) == [metric]
+    assert len(aggregator) == 0
+
+    with pytest.raises(ValueError):
+        WindowedAggregator(window=1, statistics=["median"])
+
+
+def test_records_and_flush():
+    tags = MappingProxyType({"module": "box1"})
+    aggregator = WindowedAggregator(window=1, factory=MetricRecord)
+    aggregator.add("t", MetricRecord("temperature", {"sensorA": 1}, 0.2, tags))
+    aggregator.add("t", MetricRecord("temperature", {"sensorA": 3}, 0.7, tags))
+    (record,) = aggregator.flush()
+    assert isinstance(record, MetricRecord)
+    assert record.tags is tags
+    assert record["fields"]["sensorA_mean"] == 2.0
+    assert aggregator.flush() == []
+
+
+def test_metrics_node_buffers_windows(broker_config):
+    node = MQTTMetricsNode.from_config_file(
+        config_file="tests/config-test.toml",
+        broker_config=broker_config,
+        aggregation_config=AggregationConfig(enabled=True, window=3600),
+    )
+    for i in range(100):
+        message = ("sensorbox/temperature/sensorA", b"%d" % i, 0, 7200.0 + i, None)
+        node.process_batch([message])
+    assert len(node.buffer) == 0
+
+    assert node.flush_aggregates(force=True) == 1
+    (metric,) = node.buffer
+    assert metric["fields"]["sensorA_count"] == 100
+    assert metric["fields"]["sensorA_mean"] == 49.5
+    assert metric["time"] == 7200
+    node.stop_aggregation()
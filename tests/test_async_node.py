@@ -0,0 +1,84 @@
+import asyncio
+from unittest.mock import Mock
+
+import paho.mqtt.client as mqtt
+import pytest
+from mqtt_node_network.async_node import AsyncMQTTNode
+from mqtt_node_network.configuration import OutboundSpoolConfig
+from mqtt_node_network.node import NodeError
+
+
+def make_async_node(broker_config):
+    return AsyncMQTTNode.from_config_file(
+        config_file="tests/config-test.toml",
+        broker_config=broker_config,
+        node_id="",
+    )
+
+
+def test_async_node_requires_event_loop(broker_config):
+    node = make_async_node(broker_config)
+
+    with pytest.raises(NodeError):
+        node.loop_start()
+
+    async def read_before_connect():
+        async for _ in node.messages():
+            pass
+
+    with pytest.raises(NodeError):
+        asyncio.run(read_before_connect())
+
+
+def test_async_publish_returns_spooled_messages(broker_config, tmp_path):
+    node = AsyncMQTTNode.from_config_file(
+        config_file="tests/config-test.toml",
+        broker_config=broker_config,
+        node_id="",
+        spool_config=OutboundSpoolConfig(path=str(tmp_path)),
+    )
+
+    async def main():
+        node._loop = asyncio.get_running_loop()
+        # Spooled while disconnected, rather than waiting on mid 0
+        infos = await asyncio.gather(
+            *(node.publish(f"a/b/{i}", i, qos=1) for i in range(3))
+        )
+        assert [info.mid for info in infos] == [0, 0, 0]
+        assert not node._pending_publishes
+
+        # A publish the broker never acknowledges times out with a NodeError
+        node.spool.close()
+        node.spool = None
+        node.client.publish = Mock(return_value=mqtt.MQTTMessageInfo(1))
+        with pytest.raises(NodeError):
+            await node.publish("a/b/c", 1, qos=1)
+
+    asyncio.run(asyncio.wait_for(main(), timeout=10))
+    assert len(node._pending_publishes) == 0
+
+
+def test_async_publish_subscribe(broker_config):
+    async def main():
+        async with make_async_node(broker_config) as node:
+            assert node.is_connected()
+            topic = f"{node.node_id}/test/async"
+
+            reason_codes = await node.subscribe(f"{topic}/#", qos=1)
+            assert len(reason_codes) == 1
+            assert not reason_codes[0].is_failure
+
+            for qos in (0, 1, 2):
+                info = await node.publish(f"{topic}/{qos}", qos, qos=qos)
+                assert info.is_published()
+
+            received = []
+            async for message in node.messages():
+                received.append((message.topic, int(message.payload)))
+                if len(received) == 3:
+                    break
+        assert not node.is_connected()
+        return received
+
+    received = asyncio.run(asyncio.wait_for(main(), timeout=10))
+    assert sorted(qos for _, qos in received) == [0, 1, 2]
@@ -0,0 +1,104 @@
+import pytest
+
+from mqtt_node_network.buffer import BoundedMetricsBuffer, MetricsBufferError
+from mqtt_node_network.configuration import MetricsBufferConfig
+from mqtt_node_network.metrics_node import MetricRecord, MQTTMetricsNode
+
+
+def make_metric(value):
+    return {
+        "measurement": "temperature",
+        "fields": {"sensorA": value},
+        "time": 1629000000 + value,
+        "tags": {"module": "sensorbox"},
+    }
+
+
+def test_drop_oldest():
+    dropped = []
+    buffer = BoundedMetricsBuffer(
+        maxlen=3, policy="drop_oldest", on_drop=dropped.append
+    )
+    buffer.extend(make_metric(i) for i in range(5))
+    assert len(buffer) == 3
+    assert [m["fields"]["sensorA"] for m in buffer] == [2, 3, 4]
+    assert [m["fields"]["sensorA"] for m in dropped] == [0, 1]
+
+
+def test_drop_newest():
+    dropped = []
+    buffer = BoundedMetricsBuffer(
+        maxlen=3, policy="drop_newest", on_drop=dropped.append
+    )
+    assert buffer.extend(make_metric(i) for i in range(5)) == 3
+    assert [m["fields"]["sensorA"] for m in buffer] == [0, 1, 2]
+    assert [m["fields"]["sensorA"] for m in dropped] == [3, 4]
+
+
+def test_block_timeout():
+    buffer = BoundedMetricsBuffer(maxlen=1, policy="block", block_timeout=0.01)
+    assert buffer.append(make_metric(0))
+    assert not buffer.append(make_metric(1))
+    assert len(buffer) == 1
+
+
+def test_spill_to_disk(tmp_path):
+    buffer = BoundedMetricsBuffer(
+        maxlen=2, policy="spill", spill_path=tmp_path / "spill.jsonl"
+    )
+    buffer.extend(make_metric(i) for i in range(5))
+    assert len(buffer) == 2
+    assert buffer.spilled == 3
+
+    # Spilled metrics are read back in order as the buffer drains
+    values = [m["fields"]["sensorA"] for m in buffer.drain()]
+    while buffer:
+        values.append(buffer.popleft()["fields"]["sensorA"])
+    assert values == [0, 1, 2, 3, 4]
+    assert buffer.spilled == 0
+    buffer.close()
+
+
+def test_spilled_metrics_keep_the_node_datatype(broker_config, tmp_path):
+    node = MQTTMetricsNode.from_config_file(
+        config_file="tests/config-test.toml",
+        broker_config=broker_config,
+        datatype="record",
+        buffer_config=MetricsBufferConfig(
+            maxlen=1, policy="spill", spill_path=str(tmp_path / "spill.jsonl")
+        ),
+    )
+    for i in range(3):
+        node.store_metrics(
+            node.process_message(f"sensorbox/temperature/sensor{i}", b"21.5")
+        )
+    assert node.buffer.spilled == 2
+    metrics = node.buffer.drain() + node.buffer.drain() + node.buffer.drain()
+    assert all(isinstance(metric, MetricRecord) for metric in metrics)
+    assert [dict(metric.fields) for metric in metrics] == [
+        {f"sensor{i}": 21.5} for i in range(3)
+    ]
+    assert metrics[2].tags["module"] == "sensorbox"
+    node.close()
+
+
+def test_high_watermark_callback():
+    calls = []
+    buffer = BoundedMetricsBuffer(
+        maxlen=10, high_watermark=0.5, on_high_watermark=calls.append
+    )
+    buffer.extend(make_metric(i) for i in range(6))
+    buffer.append(make_metric(6))
+    assert calls == [buffer]
+
+    # The callback is re-armed once the buffer drains below the watermark
+    buffer.drain()
+    buffer.extend(make_metric(i) for i in range(5))
+    assert len(calls) == 2
+
+
+def test_invalid_policy():
+    with pytest.raises(MetricsBufferError):
+        BoundedMetricsBuffer(maxlen=10, policy="drop_everything")
+    with pytest.raises(MetricsBufferError):
+        BoundedMetricsBuffer(maxlen=10, policy="spill")
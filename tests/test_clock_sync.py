@@ -0,0 +1,153 @@
+import socket
+import threading
+import time
+
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+import pytest
+
+from mqtt_node_network.clock_sync import (
+    NTP_EPOCH_OFFSET,
+    NTP_PACKET,
+    SOURCE_TIME_PROPERTY,
+    ClockSync,
+    ClockSyncError,
+    get_source_time,
+    query_ntp,
+)
+from mqtt_node_network.configuration import ClockSyncConfig
+from mqtt_node_network.metrics_node import MQTTMetricsNode
+
+
+def to_ntp(timestamp):
+    return int((timestamp + NTP_EPOCH_OFFSET) * 2**32)
+
+
+class StandInNTPServer:
+    """A local SNTP server whose clock is ahead of the local clock by `offset`,
+    growing by `drift` seconds per second."""
+
+    def __init__(self, offset, drift=0.0, stratum=2):
+        self.offset = offset
+        self.drift = drift
+        self.stratum = stratum
+        self.started = time.monotonic()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.port = self.sock.getsockname()[1]
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def now(self):
+        elapsed = time.monotonic() - self.started
+        return time.time() + self.offset + self.drift * elapsed
+
+    def _serve(self):
+        while True:
+            try:
+                data, sender = self.sock.recvfrom(1024)
+            except OSError:
+                return
+            received = self.now()
+            originate = NTP_PACKET.unpack(data)[-1]
+            flags = 4 << 3 | 4  # Version 4, server mode
+            response = NTP_PACKET.pack(
+                flags, self.stratum, 0, 0, 0, 0, b"TEST", 0,
+                originate, to_ntp(received), to_ntp(self.now()),
+            )  # fmt: skip
+            self.sock.sendto(response, sender)
+
+    def close(self):
+        self.sock.close()
+
+
+@pytest.fixture
+def ntp_server():
+    server = StandInNTPServer(offset=2.5)
+    yield server
+    server.close()
+
+
+def test_query_ntp(ntp_server):
+    sample = query_ntp("127.0.0.1", ntp_server.port)
+    assert sample.offset == pytest.approx(2.5, abs=0.01)
+    assert 0 <= sample.delay < 0.01
+    assert sample.stratum == 2
+
+    ntp_server.stratum = 0
+    with pytest.raises(ClockSyncError):
+        query_ntp("127.0.0.1", ntp_server.port)
+
+
+def test_clock_sync_estimates_offset_and_drift():
+    server = StandInNTPServer(offset=-1.0, drift=0.1)
+    clock = ClockSync(servers=["127.0.0.1"], port=server.port, burst=3, window=5)
+    assert not clock.synchronized
+    assert clock.offset() == 0.0
+    try:
+        for _ in range(5):
+            assert clock.sync() is not None
+            time.sleep(0.05)
+    finally:
+        server.close()
+    assert clock.synchronized
+    assert clock.drift == pytest.approx(0.1, abs=0.02)
+    # The offset is extrapolated between polls
+    expected = server.now() - time.time()
+    assert clock.offset() == pytest.approx(expected, abs=0.005)
+    assert clock.time() == pytest.approx(time.time() + expected, abs=0.005)
+
+    # A step of the local clock restarts the fit
+    now = time.monotonic()
+    clock.add_sample(clock.offset(now) + 1.0, now)
+    assert clock.drift == 0.0
+    assert clock.offset(now) == pytest.approx(expected + 1.0, abs=0.005)
+
+
+def test_clock_sync_without_servers():
+    clock = ClockSync(servers=["127.0.0.1"], port=9, burst=1, timeout=0.1)
+    assert clock.sync() is None
+    assert not clock.synchronized
+
+
+def source_time_properties(source_time):
+    properties = Properties(PacketTypes.PUBLISH)
+    properties.UserProperty = (SOURCE_TIME_PROPERTY, str(int(source_time * 1e9)))
+    return properties
+
+
+def test_metrics_are_stamped_with_source_time(broker_config, ntp_server):
+    clock_sync_config = ClockSyncConfig(
+        enabled=True, servers=["127.0.0.1"], port=ntp_server.port, burst=1
+    )
+    node = MQTTMetricsNode.from_config_file(
+        config_file="tests/config-test.toml",
+        broker_config=broker_config,
+        clock_sync_config=clock_sync_config,
+    )
+    assert node.clock is ClockSync.shared(clock_sync_config)
+    deadline = time.monotonic() + 5
+    while not node.clock.synchronized and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert node.clock.offset() == pytest.approx(2.5, abs=0.01)
+
+    # Published messages carry the corrected source time
+    published = []
+    node.client.publish = lambda *args, **kwargs: published.append(kwargs)
+    node.publish("box1/temperature/a", 21.5)
+    source_time = get_source_time(published[0]["properties"])
+    assert source_time == pytest.approx(time.time() + 2.5, abs=0.01)
+
+    latency = node._one_way_latency
+    total = latency._sum.get()
+    sent = node.clock.time() - 0.05
+    metrics = node.process_message(
+        "box1/temperature/a", b"21.5", properties=source_time_properties(sent)
+    )
+    assert metrics[0]["time"] == pytest.approx(sent, abs=1e-6)
+    assert latency._sum.get() - total == pytest.approx(0.05, abs=0.01)
+
+    # Without a source time, metrics are stamped with the corrected receive time
+    (metric,) = node.process_message("box1/temperature/a", b"21.5")
+    assert metric["time"] == pytest.approx(time.time() + 2.5, abs=0.01)
+    node.clock.stop()
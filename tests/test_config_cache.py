@@ -0,0 +1,65 @@
+import os
+import shutil
+
+from mqtt_node_network import configuration
+from mqtt_node_network.configuration import clear_config_cache, load_config_cached
+from mqtt_node_network.metrics_node import MQTTMetricsNode
+from mqtt_node_network.node import MQTTNode
+
+CONFIG_FILE = "tests/config-test.toml"
+
+
+def test_config_is_parsed_once_per_version(tmp_path, monkeypatch):
+    config_file = tmp_path / "config.toml"
+    shutil.copy(CONFIG_FILE, config_file)
+    calls = []
+    initialize_config = configuration.initialize_config
+
+    def counting_initialize_config(**kwargs):
+        calls.append(kwargs)
+        return initialize_config(**kwargs)
+
+    monkeypatch.setattr(configuration, "initialize_config", counting_initialize_config)
+    clear_config_cache()
+
+    first = load_config_cached(config_file)
+    second = load_config_cached(str(config_file))
+    assert len(calls) == 1
+    assert first["MQTTNode"] is second["MQTTNode"]
+
+    # Modifying the file invalidates the cached configuration
+    stat = config_file.stat()
+    os.utime(config_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    load_config_cached(config_file)
+    assert len(calls) == 2
+
+    # As does changing the environment substituted into it
+    monkeypatch.setenv("MQTT_NODE_TEST_PASSWORD", "changed")
+    load_config_cached(config_file)
+    assert len(calls) == 3
+    load_config_cached(config_file)
+    assert len(calls) == 3
+    clear_config_cache()
+
+
+def test_from_config_file_many(broker_config):
+    nodes = MQTTMetricsNode.from_config_file_many(
+        5,
+        CONFIG_FILE,
+        name_template="device-{}",
+        broker_config=broker_config,
+    )
+    assert [node.name for node in nodes] == [f"device-{i}" for i in range(5)]
+    assert len({node.node_id for node in nodes}) == 5
+    assert all(isinstance(node, MQTTMetricsNode) for node in nodes)
+    assert all(node.topic_structure == nodes[0].topic_structure for node in nodes)
+
+    # Without a template, the name from kwargs or the config file is kept
+    (node,) = MQTTNode.from_config_file_many(
+        1, CONFIG_FILE, broker_config=broker_config, name="gateway"
+    )
+    assert node.name == "gateway"
+    (node,) = MQTTNode.from_config_file_many(
+        1, CONFIG_FILE, broker_config=broker_config
+    )
+    assert node.name == "test_node_987123"
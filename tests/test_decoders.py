@@ -0,0 +1,72 @@
+import json
+
+import pytest
+
+from mqtt_node_network.decoders import PayloadDecoder, decode_numeric
+
+
+PAYLOADS = [
+    b"22.5",
+    b"-3",
+    b"0",
+    b"1e-3",
+    b" 42 ",
+    b"true",
+    b"null",
+    b'"quoted"',
+    b'{"a": 1}',
+    b"[1, 2]",
+    b"hello",
+    b"nothing",
+    b"NaN",
+    b"007",
+    b"1.",
+    b"",
+]
+
+
+def legacy_decode(payload: bytes):
+    data = payload.decode()
+    try:
+        return json.loads(data)
+    except json.JSONDecodeError:
+        return data
+
+
+@pytest.mark.parametrize("json_backend", ["json", "auto"])
+def test_decoder_matches_json_loads(json_backend):
+    decoder = PayloadDecoder(json_backend=json_backend)
+    for i, payload in enumerate(PAYLOADS):
+        if json_backend != "json" and payload == b"NaN":
+            # orjson does not accept the non-standard NaN literal
+            continue
+        expected = legacy_decode(payload)
+        value = decoder.decode(f"topic/{i}", payload)
+        assert value == expected or (value != value and expected != expected)
+        assert type(value) is type(expected)
+
+
+def test_decode_numeric():
+    assert decode_numeric(b"22.5") == 22.5
+    assert decode_numeric(memoryview(b"-3")) == -3
+    assert isinstance(decode_numeric(b"-3"), int)
+    assert decode_numeric(b"inf") is None
+    assert decode_numeric(b"1_000") is None
+
+
+def test_learned_topic_types():
+    decoder = PayloadDecoder(max_learned_topics=2)
+    assert decoder.decode("sensor/a", b"22.5") == 22.5
+    assert decoder.learned_types["sensor/a"] == "float"
+    assert decoder.decode("sensor/a", memoryview(b"23.5")) == 23.5
+    # Integers on a float topic stay floats
+    assert isinstance(decoder.decode("sensor/a", b"24"), float)
+
+    # A topic carrying a different type is no longer decoded as a float
+    assert decoder.decode("sensor/a", b"offline") == "offline"
+    assert decoder.learned_types["sensor/a"] == "json"
+    assert decoder.decode("sensor/a", b"24.5") == 24.5
+
+    decoder.decode("sensor/b", b"1")
+    decoder.decode("sensor/c", b"1")
+    assert len(decoder.learned_types) == 2
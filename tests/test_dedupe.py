@@ -0,0 +1,72 @@
+from paho.mqtt.client import MQTTMessage
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+import pytest
+
+from mqtt_node_network.configuration import DuplicateFilterConfig
+from mqtt_node_network.dedupe import DuplicateFilter
+from mqtt_node_network.metrics_node import MQTTMetricsNode
+
+
+def sequence_properties(sequence):
+    properties = Properties(PacketTypes.PUBLISH)
+    properties.UserProperty = ("seq", str(sequence))
+    return properties
+
+
+def test_hash_keys_only_suppress_redeliveries():
+    dedupe = DuplicateFilter(window=10)
+    assert not dedupe.is_duplicate("box/temperature/a", b"22.5", now=0)
+    # A steady value published again is not a duplicate
+    assert not dedupe.is_duplicate("box/temperature/a", b"22.5", now=1)
+    assert dedupe.is_duplicate("box/temperature/a", b"22.5", dup=True, now=2)
+    assert not dedupe.is_duplicate("box/temperature/b", b"22.5", dup=True, now=3)
+    # Keys are forgotten once the window has passed
+    assert not dedupe.is_duplicate("box/temperature/a", b"22.5", dup=True, now=11)
+
+    strict = DuplicateFilter(dup_only=False)
+    assert not strict.is_duplicate("box/temperature/a", b"22.5", now=0)
+    assert strict.is_duplicate("box/temperature/a", b"22.5", now=1)
+
+
+def test_sequence_keys():
+    dedupe = DuplicateFilter(key="sequence")
+    assert not dedupe.is_duplicate("t", b"1", properties=sequence_properties(1))
+    assert dedupe.is_duplicate("t", b"1", properties=sequence_properties(1))
+    assert not dedupe.is_duplicate("t", b"1", properties=sequence_properties(2))
+    # Messages without sequence numbers are not checked
+    assert not dedupe.is_duplicate("t", b"1", dup=True)
+    assert not dedupe.is_duplicate("t", b"1", dup=True)
+    assert len(dedupe) == 2
+
+    with pytest.raises(ValueError):
+        DuplicateFilter(key="payload")
+
+
+def test_memory_is_bounded():
+    dedupe = DuplicateFilter(window=60, max_entries=100, dup_only=False)
+    for i in range(1000):
+        dedupe.is_duplicate(f"box/{i}", b"1", now=0)
+    assert len(dedupe) == 100
+    # The oldest keys were forgotten first
+    assert not dedupe.is_duplicate("box/0", b"1", now=0)
+    assert dedupe.is_duplicate("box/999", b"1", now=0)
+
+
+def test_metrics_node_suppresses_redelivery(broker_config):
+    node = MQTTMetricsNode.from_config_file(
+        config_file="tests/config-test.toml",
+        broker_config=broker_config,
+        dedupe_config=DuplicateFilterConfig(enabled=True),
+    )
+    counter = node.metric_duplicates_suppressed_count.labels(
+        node.node_id, node.name, node.node_type, node.hostname
+    )
+    before = counter._value.get()
+    for dup in (False, True):
+        message = MQTTMessage(topic=b"sensorbox/temperature/sensorA")
+        message.payload = b"22.5"
+        message.dup = dup
+        node.on_message(node.client, None, message)
+    assert len(node.buffer) == 1
+    assert counter._value.get() == before + 1
@@ -0,0 +1,78 @@
+import os
+from pathlib import Path
+import subprocess
+import sys
+
+import pytest
+
+import mqtt_node_network
+
+# Budget in microseconds for the cumulative import time of the package, as
+# reported by `python -X importtime`. Generous, to catch a heavy dependency
+# being imported eagerly (importing paho-mqtt and prometheus_client alone
+# takes longer) rather than small regressions. Wall-clock timing depends on the
+# machine and its load, so the check only runs when MQTT_NODE_IMPORT_BUDGET is
+# set; test_parse_topic_does_not_import_heavy_modules always runs
+LIGHT_IMPORT_BUDGET_US = 100_000
+
+HEAVY_MODULES = ("paho", "prometheus_client", "config_loader", "asyncio", "ssl")
+
+
+def run_python(code, *options):
+    package_root = str(Path(mqtt_node_network.__file__).parent.parent)
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [package_root, env.get("PYTHONPATH")])
+    )
+    return subprocess.run(
+        [sys.executable, *options, "-c", code],
+        capture_output=True,
+        text=True,
+        env=env,
+        check=True,
+    )
+
+
+def package_import_time_us(stderr):
+    # Sum the outermost imports of the package's modules. Nested imports are
+    # indented further, and are already included in their parent's time
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|")
+        stripped = name.strip()
+        if stripped == "mqtt_node_network" or stripped.startswith("mqtt_node_network."):
+            entries.append((len(name) - len(name.lstrip()), int(cumulative)))
+    outermost = min(indent for indent, _ in entries)
+    return sum(time for indent, time in entries if indent == outermost)
+
+
+def test_parse_topic_does_not_import_heavy_modules():
+    code = (
+        "import sys\n"
+        "from mqtt_node_network import parse_topic\n"
+        "parse_topic('box/temperature/a', 'module/measurement/field')\n"
+        f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))\n"
+    )
+    assert run_python(code).stdout.strip() == ""
+
+
+@pytest.mark.skipif(
+    not os.environ.get("MQTT_NODE_IMPORT_BUDGET"),
+    reason="Timing check, set MQTT_NODE_IMPORT_BUDGET=1 to run",
+)
+def test_light_import_time_budget():
+    code = "import mqtt_node_network; mqtt_node_network.parse_topic"
+    result = run_python(code, "-X", "importtime")
+    assert package_import_time_us(result.stderr) < LIGHT_IMPORT_BUDGET_US
+
+
+def test_lazy_exports():
+    assert set(mqtt_node_network.__all__) <= set(dir(mqtt_node_network))
+    for name in mqtt_node_network.__all__:
+        assert getattr(mqtt_node_network, name) is not None
+    from mqtt_node_network.metrics_node import MQTTMetricsNode, parse_topic
+
+    assert mqtt_node_network.MQTTMetricsNode is MQTTMetricsNode
+    assert mqtt_node_network.parse_topic is parse_topic
@@ -0,0 +1,190 @@
+from collections import Counter
+import json
+import time
+
+from paho.mqtt.client import MQTTMessage
+import pytest
+
+from mqtt_node_network.configuration import LatencyMonitoringConfig
+from mqtt_node_network.latency_node import (
+    ANNOUNCE_EXPIRY_INTERVALS,
+    PROBE_FORMAT,
+    MQTTLatencyNode,
+    ProbeScheduler,
+    RollingQuantiles,
+)
+
+
+def test_rolling_quantiles():
+    quantiles = RollingQuantiles(window=100)
+    assert quantiles.quantile(0.5) is None
+    for value in range(1000):
+        quantiles.add(float(value))
+    # Only the most recent 100 samples are kept
+    assert len(quantiles) == 100
+    assert quantiles.quantile(0) == 900
+    assert quantiles.quantile(1) == 999
+    assert quantiles.quantile(0.5) == 949.5
+    assert quantiles.quantiles((0.9, 0.99)) == {
+        0.9: pytest.approx(989.1),
+        0.99: pytest.approx(998.01),
+    }
+    with pytest.raises(ValueError):
+        quantiles.quantile(1.5)
+
+
+def make_pong(node, sequence, sent=None):
+    # Echo the payload of a pending probe, as the responder would
+    if sent is None:
+        sent = node._pending_probes[sequence][0]
+    message = MQTTMessage(topic=node.latency_config.response_topic.encode())
+    message.payload = PROBE_FORMAT.pack(sequence, sent)
+    return message
+
+
+def test_probes_are_tracked_by_sequence(broker_config):
+    node = MQTTLatencyNode.from_config_file(
+        config_file="tests/config-test.toml", broker_config=broker_config
+    )
+    assert node.latency_config.request_topic == f"{node.node_id}/request"
+
+    answered = node._send_latency_request()
+    lost = node._send_latency_request()
+    pong = make_pong(node, answered)
+    late_pong = make_pong(node, lost)
+    # A pong to a probe of an earlier session with the same sequence number
+    node._update_latency_metric(node.client, None, make_pong(node, answered, 1))
+    assert len(node.round_trip_quantiles) == 0
+    node._update_latency_metric(node.client, None, pong)
+    assert len(node.round_trip_quantiles) == 1
+    assert 0 <= node.latency_quantiles()[0.5] < 1
+    # A duplicate pong is ignored
+    node._update_latency_metric(node.client, None, pong)
+    assert len(node.round_trip_quantiles) == 1
+
+    assert node.expire_probes(now=time.monotonic() + node.latency_config.timeout) == 1
+    assert node._probes_lost._value.get() == 1
+    node._update_latency_metric(node.client, None, late_pong)
+    assert node._pongs_late._value.get() == 1
+    assert len(node.round_trip_quantiles) == 1
+    assert node._probes_sent._value.get() == 2
+
+
+def announce(node, peer, request_topic=None):
+    message = MQTTMessage(topic=f"latency/nodes/{peer}".encode())
+    message.payload = (
+        json.dumps({"request_topic": request_topic}).encode() if request_topic else b""
+    )
+    node._update_peer(node.client, None, message)
+
+
+def test_mesh_probes_ring_successors(broker_config):
+    nodes = MQTTLatencyNode.from_config_file_many(
+        5,
+        "tests/config-test.toml",
+        broker_config=broker_config,
+        latency_config=LatencyMonitoringConfig(mesh=True, mesh_fanout=2),
+    )
+    for node in nodes:
+        for peer in nodes:
+            announce(node, peer.node_id, peer.latency_config.request_topic)
+    ring = sorted(node.node_id for node in nodes)
+    for node in nodes:
+        index = ring.index(node.node_id)
+        assert node.probe_targets == [ring[(index + 1) % 5], ring[(index + 2) % 5]]
+    # Every node is probed by as many peers as it probes
+    probed = Counter(peer for node in nodes for peer in node.probe_targets)
+    assert set(probed.values()) == {2}
+
+    node = nodes[0]
+    node.run_probe_round()
+    assert sorted(target for _, target in node._pending_probes.values()) == sorted(
+        node.probe_targets
+    )
+    for sequence in list(node._pending_probes):
+        node._update_latency_metric(node.client, None, make_pong(node, sequence))
+    assert set(node.rtt_row()) == set(node.probe_targets)
+
+    # A withdrawn peer is no longer probed
+    announce(node, node.probe_targets[0])
+    assert len(node.peers) == 3
+    assert len(node.rtt_row()) == 1
+
+    # Peers which stop announcing themselves, e.g. after a crash, are dropped
+    expiry = node.latency_config.announce_interval * ANNOUNCE_EXPIRY_INTERVALS
+    assert node._announce_properties.MessageExpiryInterval == expiry
+    assert node.expire_peers() == 0
+    peer = node.probe_targets[0]
+    later = time.monotonic() + expiry
+    node._peers_announced[peer] = later
+    assert node.expire_peers(now=later + 1) == 2
+    assert list(node.peers) == [peer]
+    assert node.probe_targets == [peer]
+
+
+class FakeNode:
+    def __init__(self, node_id):
+        self.node_id = node_id
+        self.rounds = []
+
+    def run_probe_round(self):
+        self.rounds.append(time.monotonic())
+
+
+def test_probe_scheduler_staggers_rounds():
+    interval = 0.2
+    scheduler = ProbeScheduler()
+    nodes = [FakeNode(f"node-{i}") for i in range(3)]
+    for node in nodes:
+        scheduler.add(node, interval)
+    time.sleep(interval * 3)
+    for node in nodes:
+        assert 2 <= len(node.rounds) <= 4
+        # Each round runs in the node's slot of the interval
+        offset = ProbeScheduler.slot_offset(node.node_id, interval)
+        for start in node.rounds:
+            assert (start - offset) % interval == pytest.approx(0, abs=0.05) or (
+                start - offset
+            ) % interval == pytest.approx(interval, abs=0.05)
+
+    scheduler.remove(nodes[0])
+    count = len(nodes[0].rounds)
+    time.sleep(interval * 1.5)
+    assert len(nodes[0].rounds) == count
+    assert len(nodes[1].rounds) > 2
+
+
+def test_probe_is_echoed_in_binary(broker_config):
+    node = MQTTLatencyNode.from_config_file(
+        config_file="tests/config-test.toml", broker_config=broker_config
+    )
+    published = []
+    node.publish = lambda topic, **kwargs: published.append((topic, kwargs))
+
+    sequence = node._send_latency_request()
+    topic, probe = published.pop()
+    assert topic == node.latency_config.request_topic
+    assert len(probe["payload"]) == PROBE_FORMAT.size
+    assert PROBE_FORMAT.unpack(probe["payload"])[0] == sequence
+    # Probes share the properties built by the node
+    assert probe["properties"] is node._probe_properties
+    node._send_latency_request()
+    assert published.pop()[1]["properties"] is node._probe_properties
+
+    request = MQTTMessage(topic=topic.encode())
+    request.payload = probe["payload"]
+    request.properties = probe["properties"]
+    node._send_latency_response(node.client, None, request)
+    topic, pong = published.pop()
+    assert topic == node.latency_config.response_topic
+    assert pong["payload"] == probe["payload"]
+
+    response = MQTTMessage(topic=topic.encode())
+    response.payload = pong["payload"]
+    node._update_latency_metric(node.client, None, response)
+    assert len(node.round_trip_quantiles) == 1
+
+    # Invalid pongs are ignored
+    response.payload = b"pong"
+    node._update_latency_metric(node.client, None, response)
+    assert len(node.round_trip_quantiles) == 1
@@ -82,3 +82,58 @@ def test_metric_deletion():
     del metric.tags
     with pytest.raises(AttributeError):
         "tags" not in metric
+
+
+def test_metric_record():
+    import pickle
+    from mqtt_node_network.metrics_node import MetricRecord
+
+    metric = MetricRecord(
+        measurement="temperature",
+        fields={"value": 25.0},
+        time=1629000000,
+        tags={"location": "bedroom"},
+    )
+    assert metric["measurement"] == "temperature"
+    assert metric.fields == {"value": 25.0}
+    assert dict(metric) == metric.to_dict()
+    assert metric == {
+        "measurement": "temperature",
+        "fields": {"value": 25.0},
+        "time": 1629000000,
+        "tags": {"location": "bedroom"},
+    }
+    assert not hasattr(metric, "__dict__")
+    assert pickle.loads(pickle.dumps(metric)) == metric
+
+    with pytest.raises(KeyError):
+        metric["invalid_key"]
+    with pytest.raises(TypeError):
+        metric["measurement"] = "humidity"
+    with pytest.raises(AttributeError):
+        metric.measurement = "humidity"
+
+
+def test_metric_record_datatype():
+    from mqtt_node_network.metrics_node import (
+        MetricRecord,
+        TopicStructure,
+        parse_payload_to_metric,
+    )
+
+    structure = TopicStructure("module/measurement/field*")
+    first = parse_payload_to_metric(
+        25.5, "sensorbox/temperature/sensorA", structure, datatype=MetricRecord
+    )
+    second = parse_payload_to_metric(
+        26.5, "sensorbox/temperature/sensorA", structure, datatype=MetricRecord
+    )
+    assert isinstance(first, MetricRecord)
+    assert first.tags == {"module": "sensorbox"}
+    # Records parsed from the same topic share their tags
+    assert first.tags is second.tags
+
+    metric = parse_payload_to_metric(25.5, "sensorbox/temperature/sensorA", structure)
+    assert type(metric) is dict
+    assert metric["tags"] == {"module": "sensorbox"}
+    assert type(metric["tags"]) is dict
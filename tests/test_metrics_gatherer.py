@@ -1,4 +1,5 @@
 from dataclasses import asdict
+import time
 import pytest
 from mqtt_node_network.metrics_node import parse_topic
 
@@ -131,3 +132,120 @@ def test_incorrect_topic_length():
 
     with pytest.raises(ValueError):
         parse_topic(topic, structure)
+
+
+def test_topic_structure_cache():
+    from mqtt_node_network.metrics_node import TopicStructure
+
+    structure = TopicStructure("machine/module/measurement/field*", cache_size=2)
+    topic = "pzero/sensorbox_lower/temperature/sensorA/0"
+
+    parsed = structure.parse(topic)
+    assert parsed == parse_topic(topic, "machine/module/measurement/field*")
+    assert structure.parse(topic) is parsed
+    assert structure.cache_info().hits == 1
+    assert structure.cache_info().misses == 1
+
+    # Cached results are read-only
+    with pytest.raises(TypeError):
+        parsed["machine"] = "pone"
+
+    # The cache is bounded
+    structure.parse("pzero/sensorbox_upper/temperature/sensorA")
+    structure.parse("pzero/sensorbox_upper/humidity/sensorA")
+    assert structure.cache_info().currsize == 2
+
+    with pytest.raises(ValueError):
+        structure.parse("pzero/sensorbox_lower")
+
+
+def test_batched_ingestion(broker_config):
+    import time
+    from types import SimpleNamespace
+    from mqtt_node_network.metrics_node import MQTTMetricsNode
+
+    node = MQTTMetricsNode.from_config_file(
+        config_file="tests/config-test.toml",
+        broker_config=broker_config,
+        ingest_workers=1,
+        ingest_batch_size=10,
+        ingest_batch_interval_ms=20,
+    )
+    for i in range(25):
+        message = SimpleNamespace(
+            topic=f"sensorbox/temperature/sensor{i}",
+            payload=b"22.5",
+            qos=0,
+            properties=None,
+        )
+        node.on_message(node.client, None, message)
+
+    deadline = time.monotonic() + 2
+    while len(node.buffer) < 25 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    node.stop_ingest_workers()
+
+    assert len(node.buffer) == 25
+    assert node.buffer[0]["fields"] == {"sensor0": 22.5}
+    assert node.buffer[0]["tags"] == {"module": "sensorbox"}
+
+
+def test_no_message_lost_stopping_ingest_workers(broker_config):
+    import threading
+    from types import SimpleNamespace
+    from prometheus_client import REGISTRY
+    from mqtt_node_network.metrics_node import MQTTMetricsNode
+
+    node = MQTTMetricsNode.from_config_file(
+        config_file="tests/config-test.toml",
+        broker_config=broker_config,
+        ingest_workers=1,
+        ingest_batch_size=1,
+    )
+    message = SimpleNamespace(
+        topic="sensorbox/temperature/sensorA", payload=b"22.5", qos=0, properties=None
+    )
+    # Hold the worker in its first batch
+    process_batch = node.process_batch
+    release = threading.Event()
+
+    def blocked_process_batch(batch):
+        release.wait(5)
+        return process_batch(batch)
+
+    node.process_batch = blocked_process_batch
+    node.on_message(node.client, None, message)
+    deadline = time.monotonic() + 2
+    while node._ingest_queue.qsize() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    for _ in range(4):
+        node.on_message(node.client, None, message)
+
+    # The queue depth is current while the worker is busy
+    labels = {
+        "node_id": node.node_id,
+        "node_name": node.name,
+        "node_type": node.node_type,
+        "host": node.hostname,
+    }
+    assert REGISTRY.get_sample_value("metric_ingest_queue_depth", labels) == 4
+    node.process_batch = process_batch
+    release.set()
+
+    # Messages arriving while the workers stop are parsed inline or drained
+    sent = 5
+    stopping = threading.Event()
+
+    def receive():
+        nonlocal sent
+        while not stopping.is_set():
+            node.on_message(node.client, None, message)
+            sent += 1
+
+    thread = threading.Thread(target=receive)
+    thread.start()
+    node.stop_ingest_workers()
+    stopping.set()
+    thread.join()
+    assert len(node.buffer) == sent
+    assert REGISTRY.get_sample_value("metric_ingest_queue_depth", labels) == 0
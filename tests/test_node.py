@@ -133,7 +133,7 @@ def test_message_callback_add(mqtt_test_client: MQTTNode):
     # Add the callback, and assert that it was added to the client
     mqtt_test_client.message_callback_add(topic, test_callback, qos=0)
     assert (
-        mqtt_test_client.client._on_message_filtered[topic].__name__
+        mqtt_test_client.client.callback_router[topic].__name__
         == test_callback.__name__
     )
     # Ensure that the callback is called when a message is received
@@ -147,7 +147,7 @@ def test_message_callback_add(mqtt_test_client: MQTTNode):
     mqtt_test_client.message_callback_remove(topic)
     # Ensure that the callback is removed
     with pytest.raises(KeyError):
-        mqtt_test_client.client._on_message_filtered[topic]
+        mqtt_test_client.client.callback_router[topic]
 
 
 @pytest.mark.skip()
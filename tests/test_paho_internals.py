@@ -0,0 +1,55 @@
+"""
+NodeReactor and NodeClient rely on private paho-mqtt internals, so paho is
+pinned to a minor version. These tests fail loudly if an upgrade changes them.
+"""
+
+import inspect
+
+import paho.mqtt.client as mqtt
+from paho.mqtt.client import CallbackAPIVersion
+from paho.mqtt.enums import _ConnectionState
+
+from mqtt_node_network.node import NodeClient
+from mqtt_node_network.swarm import _DISCONNECT_STATES
+
+
+def test_connection_state_internals():
+    # NodeReactor does not reconnect clients asked to disconnect
+    client = mqtt.Client(CallbackAPIVersion.VERSION2)
+    assert isinstance(client._state, _ConnectionState)
+    assert client._state not in _DISCONNECT_STATES
+    client.disconnect()
+    assert client._state in _DISCONNECT_STATES
+    assert client.socket() is None
+
+
+def test_message_dispatch_internals():
+    # NodeClient overrides the method paho dispatches received messages with,
+    # and restores aliased topics before paho dispatches them
+    assert list(inspect.signature(mqtt.Client._handle_on_message).parameters) == [
+        "self",
+        "message",
+    ]
+    assert "self._handle_on_message(message)" in inspect.getsource(
+        mqtt.Client._handle_publish
+    )
+    assert callable(mqtt.Client._handle_connack)
+    # NodeClient resolves the topic alias of QoS 2 messages held for PUBREL
+    assert "self._in_messages[message.mid] = message" in inspect.getsource(
+        mqtt.Client._handle_publish
+    )
+
+    client = NodeClient(CallbackAPIVersion.VERSION2)
+    for name in (
+        "_callback_mutex",
+        "_in_callback_mutex",
+        "_in_message_mutex",
+        "_in_messages",
+        "_in_packet",
+        "_userdata",
+    ):
+        assert hasattr(client, name), name
+    assert callable(client._easy_log)
+    assert isinstance(client.suppress_exceptions, bool)
+    message = mqtt.MQTTMessage(topic=b"a/b")
+    assert message._topic == b"a/b"
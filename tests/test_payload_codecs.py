@@ -0,0 +1,97 @@
+from types import SimpleNamespace
+from unittest.mock import Mock
+
+import pytest
+
+from mqtt_node_network.payload_codecs import CodecError, get_codec
+from mqtt_node_network.metrics_node import MQTTMetricsNode
+
+
+def test_codec_round_trip():
+    for name, value in [
+        ("json", {"a": 1.5}),
+        ("float64", 22.5),
+        ("float64", [1.0, 2.0, 3.0]),
+        ("float32", 0.5),
+    ]:
+        codec = get_codec(name)
+        assert codec.decode(codec.encode(value)) == value
+        assert get_codec(codec.content_type) is codec
+
+
+def test_unknown_codec():
+    with pytest.raises(CodecError):
+        get_codec("not-a-codec")
+    with pytest.raises(CodecError):
+        get_codec("float64").decode(b"\x00\x01\x02")
+
+
+def test_publish_and_receive_with_codec(broker_config):
+    node = MQTTMetricsNode.from_config_file(
+        config_file="tests/config-test.toml", broker_config=broker_config
+    )
+    node.client.publish = Mock()
+
+    node.publish("sensorbox/temperature/sensorA", 22.5, codec="float64")
+    topic, payload, qos, retain = node.client.publish.call_args.args
+    properties = node.client.publish.call_args.kwargs["properties"]
+    assert properties.ContentType == "application/x-float64"
+    assert payload == get_codec("float64").encode(22.5)
+
+    message = SimpleNamespace(
+        topic=topic, payload=payload, qos=qos, properties=properties
+    )
+    node.on_message(node.client, None, message)
+    assert node.buffer[-1]["fields"] == {"sensorA": 22.5}
+
+
+@pytest.mark.parametrize("codec", ["json", "float64"])
+def test_publish_snapshot(broker_config, codec):
+    node = MQTTMetricsNode.from_config_file(
+        config_file="tests/config-test.toml", broker_config=broker_config
+    )
+    node.client.publish = Mock()
+
+    values = {"sensorA": 22.5, "sensorB": 23.5, "sensorC/0": 24.5}
+    node.publish_snapshot("sensorbox/temperature", values, codec=codec)
+    assert node.client.publish.call_count == 1
+
+    topic, payload, qos, retain = node.client.publish.call_args.args
+    message = SimpleNamespace(
+        topic=topic,
+        payload=payload,
+        qos=qos,
+        properties=node.client.publish.call_args.kwargs["properties"],
+    )
+    node.on_message(node.client, None, message)
+
+    assert [metric["fields"] for metric in node.buffer] == [
+        {"sensorA": 22.5},
+        {"sensorB": 23.5},
+        {"sensorC-0": 24.5},
+    ]
+    assert all(metric["measurement"] == "temperature" for metric in node.buffer)
+    assert all(metric["tags"] == {"module": "sensorbox"} for metric in node.buffer)
+
+
+def test_publish_snapshot_leaves_properties_unchanged(broker_config):
+    from paho.mqtt.packettypes import PacketTypes
+    from paho.mqtt.properties import Properties
+
+    node = MQTTMetricsNode.from_config_file(
+        config_file="tests/config-test.toml", broker_config=broker_config
+    )
+    node.client.publish = Mock()
+    properties = Properties(PacketTypes.PUBLISH)
+    properties.UserProperty = ("source", "test")
+
+    for _ in range(2):
+        node.publish_snapshot(
+            "sensorbox/temperature",
+            {"sensorA": 22.5},
+            properties=properties,
+            codec="float64",
+        )
+        sent = node.client.publish.call_args.kwargs["properties"]
+        assert [key for key, _ in sent.UserProperty].count("fields") == 1
+    assert properties.UserProperty == [("source", "test")]
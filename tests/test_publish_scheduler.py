@@ -0,0 +1,137 @@
+from contextlib import contextmanager
+import logging
+import time
+
+import pytest
+
+from mqtt_node_network.publish_scheduler import PublishScheduler
+
+
+class FakeNode:
+    node_type = "FakeNode"
+    hostname = "localhost"
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, node_id):
+        self.node_id = node_id
+        self.name = node_id
+        self.published = []
+        self.batches = []
+
+    def publish(self, topic, payload, qos=0, retain=False, properties=None):
+        self.published.append((time.monotonic(), topic, payload))
+
+    @contextmanager
+    def publish_batch(self):
+        start = len(self.published)
+        yield self
+        self.batches.append(len(self.published) - start)
+
+
+def test_publications_do_not_drift():
+    interval = 0.05
+    scheduler = PublishScheduler(tick=0.005, slots=16)
+    node = FakeNode("node-0")
+
+    def slow_payload():
+        # Would drift by 10 ms a period if rescheduled after publishing
+        time.sleep(0.01)
+        return 1
+
+    start = time.monotonic()
+    publication = scheduler.schedule(node, "slow", slow_payload, interval)
+    time.sleep(interval * 10.5)
+    publication.cancel()
+    times = [published for published, _, _ in node.published]
+    assert len(times) == 10
+    offsets = [
+        published - (start + period * interval)
+        for period, published in enumerate(times, start=1)
+    ]
+    # Each is published within a tick or two of its due time, after the
+    # payload function, however many periods have passed
+    assert all(0.01 <= offset < 0.05 for offset in offsets)
+    assert abs(offsets[-1] - offsets[0]) < 0.02
+    assert publication.published == 10
+
+    # A cancelled publication is not published again
+    time.sleep(interval * 2)
+    assert len(node.published) == 10
+    assert len(scheduler) == 0
+
+
+def test_many_publications_coalesce_per_tick():
+    interval = 0.1
+    scheduler = PublishScheduler(tick=0.01, slots=8)
+    nodes = [FakeNode(f"node-{i}") for i in range(10)]
+    publications = {}
+    for node in nodes:
+        publications[node] = [
+            scheduler.schedule(node, f"topic/{index}", lambda: 1, interval)
+            for index in range(200)
+        ]
+    assert len(scheduler) == 2000
+    time.sleep(interval * 3.5)
+    for node in nodes:
+        assert len(node.published) == 600
+        # All of a node's topics due in the same tick are published together
+        rounds = [node.published[i : i + 200] for i in range(0, 600, 200)]
+        for messages in rounds:
+            assert {topic for _, topic, _ in messages} == {
+                f"topic/{index}" for index in range(200)
+            }
+            assert messages[-1][0] - messages[0][0] < interval / 2
+        # In one batch per tick. Scheduling may have crossed a tick boundary
+        ticks = {publication.due_tick for publication in publications[node]}
+        assert len(node.batches) == 3 * len(ticks)
+
+    lag = scheduler.publish_schedule_lag.labels(
+        "node-0", "node-0", "FakeNode", "localhost"
+    )
+    assert sum(bucket.get() for bucket in lag._buckets) >= 600
+
+
+def test_scheduler_sleeps_until_next_publication(monkeypatch):
+    interval = 0.25
+    scheduler = PublishScheduler(tick=0.005, slots=16)
+    node = FakeNode("node-sleep")
+    wakes = []
+    advance = scheduler._advance
+
+    def counting_advance(now):
+        wakes.append(now)
+        return advance(now)
+
+    monkeypatch.setattr(scheduler, "_advance", counting_advance)
+    publication = scheduler.schedule(node, "topic", lambda: 1, interval)
+    time.sleep(interval * 4.5)
+    assert len(node.published) == 4
+    # Not woken every tick, only when the publication's slot comes round,
+    # which is at most a few times a period with 16 slots of 5 ms
+    assert len(wakes) < 4 * (interval / (16 * 0.005) + 2)
+
+    # A publication due before the sleeping thread's next wake is not delayed
+    start = time.monotonic()
+    scheduler.schedule(node, "soon", lambda: 1, 0.02)
+    time.sleep(0.05)
+    first_soon = min(t for t, topic, _ in node.published if topic == "soon")
+    assert first_soon - start < 0.02 + 0.015
+    publication.cancel()
+
+
+def test_jitter_spreads_publications():
+    interval = 0.2
+    scheduler = PublishScheduler(tick=0.005, slots=64)
+    node = FakeNode("node-jitter")
+    start = time.monotonic()
+    for index in range(50):
+        scheduler.schedule(node, f"topic/{index}", lambda: 1, interval, jitter=0.1)
+    with pytest.raises(ValueError):
+        scheduler.schedule(node, "topic", lambda: 1, interval, jitter=interval * 2)
+    time.sleep(interval + 0.15)
+    offsets = [published - start - interval for published, _, _ in node.published]
+    assert len(offsets) == 50
+    assert min(offsets) >= 0
+    assert max(offsets) < 0.1 + 0.02
+    # Spread over the jitter, rather than published in one tick
+    assert max(offsets) - min(offsets) > 0.03
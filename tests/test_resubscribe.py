@@ -0,0 +1,65 @@
+from types import SimpleNamespace
+from unittest.mock import Mock
+
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+from paho.mqtt.reasoncodes import ReasonCode
+from paho.mqtt.subscribeoptions import SubscribeOptions
+
+from mqtt_node_network.node import MQTTNode, batch_subscriptions
+
+
+def test_batch_subscriptions():
+    options = SubscribeOptions()
+    filters = [(f"site/device{i:03}/#", options) for i in range(100)]
+
+    assert batch_subscriptions(filters) == [filters]
+
+    # Each filter takes 2 + 16 + 1 bytes, after 3 bytes of fixed header and
+    # 3 of variable header
+    batches = batch_subscriptions(filters, maximum_packet_size=6 + 19 * 10)
+    assert len(batches) == 10
+    assert all(len(batch) == 10 for batch in batches)
+    assert [f for batch in batches for f in batch] == filters
+
+    # A filter too large for any packet is sent on its own
+    assert batch_subscriptions(filters[:2], maximum_packet_size=10) == [
+        [filters[0]],
+        [filters[1]],
+    ]
+
+
+def test_restore_subscriptions_in_batches(broker_config):
+    node = MQTTNode.from_config_file(
+        config_file="tests/config-test.toml", broker_config=broker_config
+    )
+    node.add_subscription_topic([f"site/device{i:03}/#" for i in range(100)])
+    node.client.subscribe = Mock(side_effect=[(0, mid) for mid in range(1, 100)])
+    connack = Properties(PacketTypes.CONNACK)
+    connack.MaximumPacketSize = 512
+
+    # The broker still holds the session, so nothing is resubscribed
+    node.on_connect(
+        node.client, None, SimpleNamespace(session_present=True), 0, connack
+    )
+    node.client.subscribe.assert_not_called()
+
+    node.on_connect(
+        node.client, None, SimpleNamespace(session_present=False), 0, connack
+    )
+    batches = [call.args[0] for call in node.client.subscribe.call_args_list]
+    assert 1 < len(batches) < len(node.subscriptions)
+    assert [topic for batch in batches for topic, _ in batch] == list(
+        node.subscriptions
+    )
+
+    # Failed filters are reported from the SUBACKs
+    granted = ReasonCode(PacketTypes.SUBACK, "Granted QoS 0")
+    refused = ReasonCode(PacketTypes.SUBACK, "Not authorized")
+    for mid, batch in enumerate(batches, start=1):
+        reason_codes = [granted] * len(batch)
+        if mid == 2:
+            reason_codes[0] = refused
+        node.on_subscribe(node.client, None, mid, reason_codes, None)
+    assert node.failed_subscriptions == {batches[1][0][0]: refused}
+    assert node._pending_resubscribes == {}
@@ -0,0 +1,216 @@
+import csv
+from collections import deque
+import json
+import time
+from types import MappingProxyType
+
+import pytest
+
+from mqtt_node_network.buffer import BoundedMetricsBuffer
+from mqtt_node_network.configuration import FlushPipelineConfig, MetricsWALConfig
+from mqtt_node_network.line_protocol import (
+    LineProtocolSerializer,
+    format_metric,
+    format_metrics,
+)
+from mqtt_node_network.metrics_node import MetricRecord, MQTTMetricsNode
+from mqtt_node_network.sinks import (
+    CallableSink,
+    CSVFileSink,
+    JSONLinesFileSink,
+    LineProtocolFileSink,
+    MetricsFlushPipeline,
+    SinkError,
+    create_sink,
+)
+
+
+def make_metric(i):
+    return {
+        "measurement": "temperature",
+        "fields": {"sensor A": 20.5 + i},
+        "time": 1700000000 + i,
+        "tags": {"module": "box,1"},
+    }
+
+
+def test_format_metric():
+    metric = {
+        "measurement": "my measurement",
+        "fields": {"value": 1.5, "count": 2, "ok": True, "state": 'say "hi"'},
+        "time": 1700000000.5,
+        "tags": {"b": "x=y", "a": "1"},
+    }
+    assert format_metric(metric, precision="ms") == (
+        r"my\ measurement,a=1,b=x\=y "
+        r'value=1.5,count=2i,ok=true,state="say \"hi\"" 1700000000500'
+    )
+
+
+def test_serializer_matches_format_metrics():
+    tags = MappingProxyType({"module": "box 1"})
+    metrics = [make_metric(i) for i in range(5)]
+    metrics += [
+        MetricRecord("pressure", {"value": i, "ok": i % 2 == 0}, 1700000000.25, tags)
+        for i in range(5)
+    ]
+    metrics.append(
+        {
+            "measurement": "state",
+            "fields": {"text": 'say "hi"'},
+            "time": 1700000000,
+            "tags": {},
+        }
+    )
+    serializer = LineProtocolSerializer(precision="us", cache_size=4)
+    expected = format_metrics(metrics, precision="us").encode("utf-8")
+    assert serializer.serialize(metrics) == expected
+    # Cached prefixes give the same output on a second batch
+    assert serializer.serialize(metrics) == expected
+    assert serializer.serialize([]) == b""
+
+    with pytest.raises(ValueError):
+        LineProtocolSerializer(precision="m")
+
+
+def test_file_sinks(tmp_path):
+    metrics = [make_metric(i) for i in range(3)]
+    for sink in [
+        JSONLinesFileSink(tmp_path / "metrics.jsonl"),
+        CSVFileSink(tmp_path / "metrics.csv"),
+        create_sink({"type": "line_protocol", "path": tmp_path / "metrics.lp"}),
+    ]:
+        sink.write(metrics[:2])
+        sink.write(metrics[2:])
+
+    assert isinstance(sink, LineProtocolFileSink)
+
+    lines = (tmp_path / "metrics.jsonl").read_text().splitlines()
+    assert [json.loads(line) for line in lines] == metrics
+    with open(tmp_path / "metrics.csv", newline="") as file:
+        rows = list(csv.reader(file))
+    assert rows[0] == list(CSVFileSink.COLUMNS)
+    assert rows[1] == ["1700000000", "temperature", "module=box,1", "sensor A", "20.5"]
+    assert len(rows) == 4
+    assert (tmp_path / "metrics.lp").read_text().splitlines()[0] == (
+        r"temperature,module=box\,1 sensor\ A=20.5 1700000000000000000"
+    )
+
+    with pytest.raises(SinkError):
+        create_sink({"type": "unknown"})
+
+
+def test_pipeline_flushes_by_size_and_time():
+    buffer = BoundedMetricsBuffer(maxlen=100)
+    batches = []
+    pipeline = MetricsFlushPipeline(
+        buffer, [CallableSink(batches.append)], batch_size=10, flush_interval=0.2
+    ).start()
+
+    buffer.extend(make_metric(i) for i in range(25))
+    pipeline.notify()
+    deadline = time.monotonic() + 5
+    while sum(map(len, batches)) < 25 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    pipeline.stop()
+    assert [len(batch) for batch in batches] == [10, 10, 5]
+
+
+def test_pipeline_retries_then_drops():
+    attempts = []
+
+    def flaky(metrics):
+        attempts.append(len(metrics))
+        if len(attempts) < 3:
+            raise ConnectionError("sink unavailable")
+
+    flushed = []
+    pipeline = MetricsFlushPipeline(
+        deque(make_metric(i) for i in range(5)),
+        [CallableSink(flaky)],
+        retry_backoff=0.01,
+        max_retries=5,
+        on_flushed=flushed.append,
+    )
+    assert pipeline.flush() == 5
+    assert attempts == [5, 5, 5]
+    assert flushed == [5]
+
+    def broken(metrics):
+        raise ConnectionError("sink unavailable")
+
+    dropped = []
+    pipeline = MetricsFlushPipeline(
+        [make_metric(0)],
+        [CallableSink(broken), CallableSink(flaky)],
+        retry_backoff=0.01,
+        max_retries=2,
+        on_flushed=flushed.append,
+        on_dropped=dropped.append,
+    )
+    # The batch is dropped once the retries are exhausted, and is not reported
+    # as flushed, though the other sink wrote it
+    assert pipeline.flush() == 1
+    assert pipeline.buffer == []
+    assert attempts == [5, 5, 5, 1]
+    assert flushed == [5]
+    assert dropped == [1]
+
+
+def test_metrics_node_flushes_and_commits(broker_config, tmp_path):
+    node = MQTTMetricsNode.from_config_file(
+        config_file="tests/config-test.toml",
+        broker_config=broker_config,
+        wal_config=MetricsWALConfig(path=str(tmp_path / "wal")),
+        flush_config=FlushPipelineConfig(
+            enabled=True,
+            flush_interval=0.05,
+            sinks=[{"type": "jsonl", "path": str(tmp_path / "metrics.jsonl")}],
+        ),
+    )
+    node.store_metrics(node.process_message("sensorbox/temperature/sensorA", b"22.5"))
+    node.close()
+
+    (line,) = (tmp_path / "metrics.jsonl").read_text().splitlines()
+    assert json.loads(line)["fields"] == {"sensorA": 22.5}
+    assert len(node.wal) == 0
+
+
+def test_metrics_node_does_not_commit_dropped_batches(broker_config, tmp_path):
+    def broken(metrics):
+        raise ConnectionError("sink unavailable")
+
+    written = []
+    node = MQTTMetricsNode.from_config_file(
+        config_file="tests/config-test.toml",
+        broker_config=broker_config,
+        wal_config=MetricsWALConfig(path=str(tmp_path / "wal")),
+        flush_config=FlushPipelineConfig(
+            flush_interval=0.05, max_retries=1, retry_backoff=0.01
+        ),
+        sinks=[CallableSink(broken)],
+    )
+    node.store_metrics(node.process_message("sensorbox/temperature/sensorA", b"22.5"))
+    deadline = time.monotonic() + 5
+    while node.buffer and time.monotonic() < deadline:
+        time.sleep(0.01)
+    node.close()
+    # The metric the sink dropped is not committed
+    assert node.wal.committed_lsn == 0
+    assert len(node.wal) == 1
+
+    # so it is replayed and flushed on restart
+    node = MQTTMetricsNode.from_config_file(
+        config_file="tests/config-test.toml",
+        broker_config=broker_config,
+        wal_config=MetricsWALConfig(path=str(tmp_path / "wal")),
+        flush_config=FlushPipelineConfig(flush_interval=0.05),
+        sinks=[CallableSink(written.extend)],
+    )
+    node.store_metrics(node.process_message("sensorbox/temperature/sensorB", b"23.5"))
+    node.close()
+    assert [metric["fields"] for metric in written] == [
+        {"sensorA": 22.5},
+        {"sensorB": 23.5},
+    ]
+    assert len(node.wal) == 0
@@ -0,0 +1,212 @@
+import time
+from types import SimpleNamespace
+from unittest.mock import Mock
+
+from paho.mqtt.client import MQTTMessageInfo
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+from mqtt_node_network.configuration import OutboundSpoolConfig
+import pytest
+
+from mqtt_node_network.node import MQTTNode
+from mqtt_node_network.spool import OutboundSpool, SpoolError
+
+
+def test_spool_append_and_replay(tmp_path):
+    spool = OutboundSpool(tmp_path, segment_size=256, max_bytes=4096)
+    properties = Properties(PacketTypes.PUBLISH)
+    properties.ContentType = "application/json"
+    for i in range(20):
+        spool.append(f"a/b/{i}", str(i).encode(), qos=1, retain=i == 0)
+    spool.append("a/b/props", b"{}", properties=properties)
+    assert len(spool) == 21
+    # Messages span several segments
+    assert len(list(tmp_path.glob("*.seg"))) > 1
+    assert spool.oldest_age() >= 0
+
+    message = spool.peek()
+    assert (message.topic, message.payload, message.qos, message.retain) == (
+        "a/b/0",
+        b"0",
+        1,
+        True,
+    )
+    for _ in range(10):
+        spool.advance()
+    spool.close()
+
+    # A restarted spool resumes from the replay cursor
+    spool = OutboundSpool(tmp_path, segment_size=256, max_bytes=4096)
+    assert len(spool) == 11
+    assert spool.peek().topic == "a/b/10"
+    for _ in range(10):
+        spool.advance()
+    assert spool.peek().properties.ContentType == "application/json"
+    spool.advance()
+    assert spool.peek() is None
+    assert len(list(tmp_path.glob("*.seg"))) == 1
+    spool.close()
+
+
+def test_spool_evicts_oldest_segments(tmp_path):
+    spool = OutboundSpool(tmp_path, segment_size=256, max_bytes=512)
+    for i in range(100):
+        spool.append(f"a/b/{i}", b"x" * 10)
+    assert spool.size_bytes <= 512
+    assert 0 < len(spool) < 100
+    # The newest messages are kept
+    topics = []
+    while (message := spool.peek()) is not None:
+        topics.append(message.topic)
+        spool.advance()
+    assert topics[-1] == "a/b/99"
+    assert topics == [f"a/b/{i}" for i in range(100 - len(topics), 100)]
+    spool.close()
+
+
+def test_spool_keeps_replayed_messages_until_acknowledged(tmp_path):
+    spool = OutboundSpool(tmp_path, segment_size=256, max_bytes=4096)
+    for i in range(10):
+        spool.append(f"a/b/{i}", str(i).encode(), qos=1)
+    replayed = [spool.replay_next() for _ in range(4)]
+    assert [(index, message.topic) for index, message in replayed] == [
+        (i, f"a/b/{i}") for i in range(4)
+    ]
+    spool.acknowledge(1)
+    assert len(spool) == 8
+    spool.close()
+
+    # Replayed messages not acknowledged are replayed again after a restart
+    spool = OutboundSpool(tmp_path, segment_size=256, max_bytes=4096)
+    index, message = spool.replay_next()
+    assert (index, message.topic) == (0, "a/b/2")
+    spool.rewind()
+    assert spool.replay_next()[1].topic == "a/b/2"
+    topics = []
+    while (entry := spool.replay_next()) is not None:
+        topics.append(entry[1].topic)
+    assert topics == [f"a/b/{i}" for i in range(3, 10)]
+    spool.acknowledge(7)
+    assert len(spool) == 0
+    spool.close()
+
+
+def test_spool_directory_is_locked(tmp_path):
+    spool = OutboundSpool(tmp_path)
+    with pytest.raises(SpoolError):
+        OutboundSpool(tmp_path)
+    spool.append("a/b/c", b"1")
+    spool.close()
+    # Released once the spool is closed
+    spool = OutboundSpool(tmp_path)
+    assert spool.peek().topic == "a/b/c"
+    spool.close()
+
+
+def test_nodes_spool_to_their_own_directories(broker_config, tmp_path):
+    nodes = MQTTNode.from_config_file_many(
+        2,
+        config_file="tests/config-test.toml",
+        name_template="spool-node/{}",
+        broker_config=broker_config,
+        spool_config=OutboundSpoolConfig(path=str(tmp_path)),
+    )
+    assert [node.spool.path for node in nodes] == [
+        tmp_path / "spool-node_0",
+        tmp_path / "spool-node_1",
+    ]
+    for node in nodes:
+        node.spool.close()
+
+
+def test_spool_syncs_after_writes_stop(tmp_path):
+    spool = OutboundSpool(tmp_path, fsync_batch=100, fsync_interval=0.05)
+    spool.append("a/b/c", b"1")
+    assert spool._unsynced == 1
+    time.sleep(0.2)
+    assert spool._unsynced == 0
+    spool.close()
+
+
+def test_node_spools_while_disconnected(broker_config, tmp_path):
+    node = MQTTNode.from_config_file(
+        config_file="tests/config-test.toml",
+        broker_config=broker_config,
+        spool_config=OutboundSpoolConfig(path=str(tmp_path), drain_rate=0),
+    )
+    sent = []
+
+    def publish(topic, payload, qos=0, retain=False, properties=None):
+        message_info = MQTTMessageInfo(len(sent) + 1)
+        sent.append((topic, payload, qos, message_info))
+        if qos == 0:
+            # Marked as published once sent, rather than when acknowledged
+            message_info._set_as_published()
+        return message_info
+
+    node.client.publish = Mock(side_effect=publish)
+
+    node.publish("a/b/c", 1.5, qos=1)
+    node.publish("a/b/d", "on")
+    node.client.publish.assert_not_called()
+    assert len(node.spool) == 2
+
+    # Replayed in order after reconnecting, and kept in the spool until the
+    # broker acknowledges them
+    node.is_connected = Mock(return_value=True)
+    node.on_connect(node.client, None, SimpleNamespace(session_present=True), 0, None)
+    deadline = time.monotonic() + 5
+    while len(sent) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert [message[:3] for message in sent] == [
+        ("a/b/c", b"1.5", 1),
+        ("a/b/d", b"on", 0),
+    ]
+    time.sleep(0.2)
+    assert len(node.spool) == 2
+    sent[0][3]._set_as_published()
+    node._spool_drain_thread.join(timeout=5)
+    assert len(node.spool) == 0
+
+    node.publish("a/b/e", "direct")
+    assert node.client.publish.call_args.args[0] == "a/b/e"
+    node.spool.close()
+
+
+def test_spool_drain_catches_up_with_live_traffic(broker_config, tmp_path):
+    node = MQTTNode.from_config_file(
+        config_file="tests/config-test.toml",
+        broker_config=broker_config,
+        spool_config=OutboundSpoolConfig(path=str(tmp_path), drain_rate=2),
+    )
+    sent = []
+
+    def publish(topic, payload, qos=0, retain=False, properties=None):
+        message_info = MQTTMessageInfo(len(sent) + 1)
+        message_info._set_as_published()
+        sent.append(topic)
+        return message_info
+
+    node.client.publish = Mock(side_effect=publish)
+    node.publish("a/b/0", 0)
+    node.publish("a/b/1", 1)
+
+    # Messages published while the backlog is replayed are spooled behind it,
+    # but not held to the drain rate
+    node.is_connected = Mock(return_value=True)
+    node.on_connect(node.client, None, SimpleNamespace(session_present=True), 0, None)
+    for i in range(2, 50):
+        node.publish(f"a/b/{i}", i)
+    node._spool_drain_thread.join(timeout=5)
+    assert sent == [f"a/b/{i}" for i in range(50)]
+    assert len(node.spool) == 0
+
+    # A message left in the spool once the drain has stopped is replayed with
+    # the next message spooled
+    node.spool.append("a/b/50", b"50")
+    node.publish("a/b/51", 51)
+    node._spool_drain_thread.join(timeout=5)
+    assert sent[-2:] == ["a/b/50", "a/b/51"]
+    assert len(node.spool) == 0
+    node.spool.close()
@@ -0,0 +1,59 @@
+import time
+
+from mqtt_node_network.node import MQTTNode
+from mqtt_node_network.swarm import NodeReactor, NodeSwarm
+
+NUM_NODES = 20
+
+
+def test_swarm_shares_one_network_thread(broker_config):
+    swarm = NodeSwarm.from_config_file(
+        NUM_NODES,
+        "tests/config-test.toml",
+        broker_config=broker_config,
+        node_id="",
+    )
+    assert len(swarm) == NUM_NODES
+    assert all(isinstance(node, MQTTNode) for node in swarm)
+    # Names are used as client ids, so each node falls back to its unique node_id
+    assert len({node.client._client_id for node in swarm}) == NUM_NODES
+
+    with swarm:
+        swarm.connect(ensure_connected=True, timeout=10)
+        assert swarm.connected_count() == NUM_NODES
+        assert len(swarm.reactor) == NUM_NODES
+        # No node has started its own paho network thread
+        assert not any(node.check_loop_running() for node in swarm)
+
+        received = []
+        subscriber = swarm[0]
+        topic = f"{subscriber.node_id}/test/swarm"
+        subscriber.client.message_callback_add(
+            f"{topic}/#", lambda client, userdata, message: received.append(message)
+        )
+        subscriber.subscribe(f"{topic}/#", qos=1)
+        time.sleep(0.5)
+
+        for index, node in enumerate(swarm):
+            node.publish(f"{topic}/{index}", index, qos=1)
+
+        deadline = time.monotonic() + 5
+        while len(received) < NUM_NODES and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    assert sorted(int(message.payload) for message in received) == list(
+        range(NUM_NODES)
+    )
+    assert swarm.connected_count() == 0
+
+
+def test_reactor_attach(broker_config):
+    reactor = NodeReactor()
+    node = MQTTNode.from_config_file(
+        config_file="tests/config-test.toml",
+        broker_config=broker_config,
+        node_id="",
+    )
+    assert node.attach_reactor(reactor) is node
+    assert node.reactor is reactor
+    assert len(reactor) == 0
@@ -0,0 +1,172 @@
+import struct
+from types import SimpleNamespace
+from unittest.mock import Mock
+
+from paho.mqtt.client import MQTTMessage
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+from mqtt_node_network.node import MQTTNode
+from mqtt_node_network.topic_aliases import TopicAliasTable
+
+
+def test_topic_alias_table_lru():
+    table = TopicAliasTable(maximum=2, policy="lru", min_uses=2)
+
+    # Topics are only aliased once they have been published min_uses times
+    assert table.assign("a/b/c") == ("a/b/c", None)
+    assert table.assign("a/b/c") == ("a/b/c", 1)
+    assert table.assign("a/b/c") == ("", 1)
+
+    table.assign("d/e/f")
+    assert table.assign("d/e/f") == ("d/e/f", 2)
+    table.assign("a/b/c")
+
+    # The least recently used topic gives up its alias
+    table.assign("g/h/i")
+    assert table.assign("g/h/i") == ("g/h/i", 2)
+    assert "d/e/f" not in table
+    assert table.assign("a/b/c") == ("", 1)
+
+
+def test_topic_alias_table_lfu():
+    table = TopicAliasTable(maximum=2, policy="lfu", min_uses=1)
+    for _ in range(3):
+        table.assign("hot")
+    table.assign("cold")
+    table.assign("new")
+    assert "hot" in table
+    assert "cold" not in table
+
+
+def test_topic_alias_table_disabled_and_reset():
+    table = TopicAliasTable(maximum=0, min_uses=1)
+    assert table.assign("a/b/c") == ("a/b/c", None)
+    table.reset(10)
+    assert table.assign("a/b/c") == ("a/b/c", 1)
+    table.reset(10)
+    assert table.assign("a/b/c") == ("a/b/c", 1)
+
+
+def test_publish_with_topic_aliases(broker_config):
+    node = MQTTNode.from_config_file(
+        config_file="tests/config-test.toml",
+        broker_config=broker_config,
+        topic_alias_policy="lru",
+        topic_alias_min_uses=1,
+    )
+    node.client.publish = Mock()
+    connack = Properties(PacketTypes.CONNACK)
+    connack.TopicAliasMaximum = 10
+    node.on_connect(
+        node.client, None, SimpleNamespace(session_present=True), 0, connack
+    )
+
+    topic = "machine/module/measurement/field-0"
+    for _ in range(3):
+        node.publish(topic, "22.5")
+    sent = [
+        (call.args[0], call.kwargs["properties"].TopicAlias)
+        for call in node.client.publish.call_args_list
+    ]
+    assert sent == [(topic, 1), ("", 1), ("", 1)]
+
+    # QoS 1 messages may be retransmitted on a later connection, so keep their topic
+    node.publish(topic, "22.5", qos=1)
+    assert node.client.publish.call_args.args[0] == topic
+
+
+def test_resolve_inbound_topic_alias(broker_config):
+    node = MQTTNode.from_config_file(
+        config_file="tests/config-test.toml", broker_config=broker_config
+    )
+    received = []
+    node.client.on_message = lambda client, userdata, message: received.append(
+        message.topic
+    )
+
+    # The first message binds the alias, the second only carries the alias
+    for topic in [b"machine/module/measurement/field-0", b""]:
+        message = MQTTMessage(topic=topic)
+        message.properties = Properties(PacketTypes.PUBLISH)
+        message.properties.TopicAlias = 7
+        node.client._handle_on_message(message)
+
+    assert received == ["machine/module/measurement/field-0"] * 2
+
+
+def publish_packet(topic, alias, qos, mid=1):
+    # A received PUBLISH packet, as paho holds it before handling it
+    properties = Properties(PacketTypes.PUBLISH)
+    properties.TopicAlias = alias
+    packet = struct.pack("!H", len(topic)) + topic
+    if qos:
+        packet += struct.pack("!H", mid)
+    packet += properties.pack() + b"22.5"
+    return {"command": 0x30 | qos << 1, "packet": bytearray(packet)}
+
+
+def test_inbound_aliases_bind_when_published(broker_config):
+    node = MQTTNode.from_config_file(
+        config_file="tests/config-test.toml", broker_config=broker_config
+    )
+    received = []
+    node.client.on_message = lambda client, userdata, message: received.append(
+        (message.topic, message.qos)
+    )
+
+    # A QoS 2 message binds its alias when it arrives, not when released, so
+    # a QoS 0 message using the alias in between is resolved
+    node.client._in_packet = publish_packet(b"machine/module/a", 7, qos=2)
+    node.client._handle_publish()
+    node.client._in_packet = publish_packet(b"", 7, qos=0)
+    node.client._handle_publish()
+    # A QoS 2 message using an alias rebound before it is released keeps the
+    # topic the alias stood for when it arrived
+    node.client._in_packet = publish_packet(b"", 7, qos=2, mid=2)
+    node.client._handle_publish()
+    node.client._in_packet = publish_packet(b"machine/module/b", 7, qos=0)
+    node.client._handle_publish()
+    for mid in (1, 2):
+        node.client._in_packet = {
+            "command": 0x62,
+            "remaining_length": 2,
+            "packet": bytearray(struct.pack("!H", mid)),
+        }
+        node.client._handle_pubrel()
+    assert received == [
+        ("machine/module/a", 0),
+        ("machine/module/b", 0),
+        ("machine/module/a", 2),
+        ("machine/module/a", 2),
+    ]
+
+
+def test_outbound_aliases_are_disabled_until_on_connect(broker_config):
+    node = MQTTNode.from_config_file(
+        config_file="tests/config-test.toml",
+        broker_config=broker_config,
+        topic_alias_policy="lru",
+        topic_alias_min_uses=1,
+    )
+    connack = Properties(PacketTypes.CONNACK)
+    connack.TopicAliasMaximum = 10
+    node.on_connect(
+        node.client, None, SimpleNamespace(session_present=True), 0, connack
+    )
+    node.topic_aliases.assign("a/b/c")
+    assert node.topic_aliases.maximum == 10
+
+    # paho marks the client connected on CONNACK before calling on_connect
+    maximums = []
+    node.client.on_connect = lambda *args: maximums.append(
+        (node.client.is_connected(), node.topic_aliases.maximum)
+    )
+    node.client._in_packet = {
+        "command": 0x20,
+        "remaining_length": 3,
+        "packet": bytearray(b"\x00\x00\x00"),
+    }
+    node.client._handle_connack()
+    assert maximums == [(True, 0)]
+    assert "a/b/c" not in node.topic_aliases
@@ -0,0 +1,59 @@
+from unittest.mock import Mock
+
+import pytest
+from paho.mqtt.client import CallbackAPIVersion, MQTTMessage, topic_matches_sub
+
+from mqtt_node_network.node import NodeClient, TopicRouter
+
+
+def test_topic_router_wildcards():
+    filters = ["a/b/c", "a/+/c", "a/#", "#", "+/+", "a/b/+/d", "$SYS/#"]
+    router = TopicRouter({f: f for f in filters})
+
+    for topic in ["a/b/c", "a", "a/b", "x/y", "a/b/c/d", "$SYS/broker", "$SYS"]:
+        expected = [f for f in filters if topic_matches_sub(f, topic)]
+        assert sorted(router.match(topic)) == sorted(expected), topic
+
+    # Wildcards in the first level do not match topics starting with $
+    assert router.match_filters("$SYS/broker") == ["$SYS/#"]
+    assert not TopicRouter(["+/broker"]).matches("$SYS/broker")
+
+
+def test_topic_router_bookkeeping():
+    router = TopicRouter(["a/b", "a/b/c"])
+    router["a/b"] = 1
+    assert len(router) == 2
+    assert router["a/b"] == 1
+    assert list(router) == ["a/b", "a/b/c"]
+
+    del router["a/b/c"]
+    assert "a/b/c" not in router
+    assert router.match("a/b/c") == []
+    assert router.match("a/b") == [1]
+    # Branches without filters are pruned
+    del router["a/b"]
+    assert router._root.children == {}
+
+    for topic_filter in ["a/#/c", "a/b+", ""]:
+        with pytest.raises(ValueError):
+            router[topic_filter] = None
+
+
+def test_node_client_dispatches_to_matching_callbacks():
+    client = NodeClient(CallbackAPIVersion.VERSION2, client_id="test")
+    on_message, wildcard, exact = Mock(), Mock(), Mock()
+    client.on_message = on_message
+    client.message_callback_add("sensors/+/temperature", wildcard)
+    client.message_callback_add("sensors/1/temperature", exact)
+
+    message = MQTTMessage(topic=b"sensors/1/temperature")
+    client._handle_on_message(message)
+    wildcard.assert_called_once_with(client, None, message)
+    exact.assert_called_once_with(client, None, message)
+    on_message.assert_not_called()
+
+    # Unmatched messages fall back to on_message
+    client.message_callback_remove("sensors/+/temperature")
+    client._handle_on_message(MQTTMessage(topic=b"sensors/2/temperature"))
+    on_message.assert_called_once()
+    assert wildcard.call_count == 1
@@ -0,0 +1,232 @@
+import time
+
+from paho.mqtt.client import MQTTMessage
+import pytest
+
+from mqtt_node_network.configuration import MetricsBufferConfig, MetricsWALConfig
+from mqtt_node_network.metrics_node import MetricRecord, MQTTMetricsNode
+from mqtt_node_network.wal import (
+    MetricsWAL,
+    MetricsWALError,
+    decode_metric,
+    encode_metric,
+)
+
+
+def make_metric(i):
+    return {
+        "measurement": "temperature",
+        "fields": {f"sensor{i}": 20.5 + i, "count": i, "ok": True, "state": "on"},
+        "time": 1700000000.25 + i,
+        "tags": {"module": "sensorbox"},
+    }
+
+
+def test_encode_decode_metric():
+    data = bytearray()
+    for i in range(2):
+        encode_metric(make_metric(i), data)
+    first, offset = decode_metric(data, 0)
+    second, offset = decode_metric(data, offset)
+    assert [first, second] == [make_metric(0), make_metric(1)]
+    assert offset == len(data)
+
+    # Strings longer than 65535 bytes
+    metric = make_metric(2)
+    metric["fields"]["state"] = "x" * 70_000
+    data = bytearray()
+    encode_metric(metric, data)
+    assert decode_metric(data, 0) == (metric, len(data))
+
+
+def test_wal_replays_uncommitted_metrics(tmp_path):
+    wal = MetricsWAL(tmp_path, segment_size=512)
+    for i in range(0, 30, 3):
+        wal.append([make_metric(j) for j in range(i, i + 3)])
+    assert len(list(tmp_path.glob("*.wal"))) > 1
+
+    # Committing part way through a batch
+    wal.commit(10)
+    wal.close()
+
+    wal = MetricsWAL(tmp_path, segment_size=512)
+    assert wal.replay() == [make_metric(i) for i in range(10, 30)]
+    assert wal.append([make_metric(30)]) == 30
+    wal.commit(21)
+    assert wal.replay() == []
+    # Fully committed segments are deleted
+    assert len(list(tmp_path.glob("*.wal"))) == 1
+    wal.close()
+
+
+def test_wal_truncates_torn_batch(tmp_path):
+    wal = MetricsWAL(tmp_path)
+    wal.append([make_metric(0)])
+    wal.append([make_metric(1)])
+    wal.close()
+    (segment,) = tmp_path.glob("*.wal")
+    segment.write_bytes(segment.read_bytes()[:-5])
+
+    wal = MetricsWAL(tmp_path)
+    assert wal.replay() == [make_metric(0)]
+    assert wal.append([make_metric(2)]) == 1
+    assert wal.replay() == [make_metric(0), make_metric(2)]
+    wal.close()
+
+
+def test_wal_syncs_after_appends_stop(tmp_path):
+    wal = MetricsWAL(tmp_path, fsync_batch=100, fsync_interval=0.05)
+    wal.append([make_metric(0)])
+    assert wal._unsynced == 1
+    time.sleep(0.2)
+    assert wal._unsynced == 0
+    wal.close()
+
+
+def test_wal_commits_out_of_order(tmp_path):
+    wal = MetricsWAL(tmp_path)
+    wal.append([make_metric(i) for i in range(6)])
+    assert wal.commit_lsns([4, 1, 2]) == 0
+    assert len(wal) == 3
+    wal.close()
+
+    # Metrics committed beyond the committed LSN are not replayed
+    wal = MetricsWAL(tmp_path)
+    assert wal.replay_entries() == [
+        (0, make_metric(0)),
+        (3, make_metric(3)),
+        (5, make_metric(5)),
+    ]
+    assert wal.commit_lsns([0, 3]) == 5
+    assert wal.replay() == [make_metric(5)]
+    wal.close()
+
+
+def test_wal_deletes_committed_segments_past_a_gap(tmp_path):
+    wal = MetricsWAL(tmp_path, segment_size=256)
+    for i in range(12):
+        wal.append([make_metric(i)])
+    segments = len(list(tmp_path.glob("*.wal")))
+    # Metric 0 is never committed, so the committed LSN stays at 0
+    assert wal.commit_lsns(range(1, 12)) == 0
+    # Only the segment holding it, and the newest, are kept
+    assert len(list(tmp_path.glob("*.wal"))) == 2 < segments
+    wal.close()
+
+    wal = MetricsWAL(tmp_path, segment_size=256)
+    assert wal.replay() == [make_metric(0)]
+    wal.close()
+
+
+def test_metrics_node_replays_wal(broker_config, tmp_path):
+    def make_node():
+        return MQTTMetricsNode.from_config_file(
+            config_file="tests/config-test.toml",
+            broker_config=broker_config,
+            datatype="record",
+            wal_config=MetricsWALConfig(path=str(tmp_path)),
+        )
+
+    node = make_node()
+    for field, payload in [("sensorA", b"22.5"), ("sensorB", b"23.5")]:
+        message = MQTTMessage(topic=f"sensorbox/temperature/{field}".encode())
+        message.payload = payload
+        node.on_message(node.client, None, message)
+    assert len(node.buffer) == 2
+
+    # The consumer flushed the first metric, then the process crashed
+    node.buffer.popleft()
+    node.commit_metrics(1)
+    node.wal.close()
+
+    node = make_node()
+    (metric,) = node.buffer
+    assert isinstance(metric, MetricRecord)
+    assert dict(metric.fields) == {"sensorB": 23.5}
+    node.wal.close()
+
+
+def test_metrics_node_commits_metrics_the_buffer_kept(broker_config, tmp_path):
+    def make_node(policy):
+        return MQTTMetricsNode.from_config_file(
+            config_file="tests/config-test.toml",
+            broker_config=broker_config,
+            buffer_config=MetricsBufferConfig(maxlen=2, policy=policy),
+            wal_config=MetricsWALConfig(path=str(tmp_path)),
+        )
+
+    def receive(node, *values):
+        for value in values:
+            message = MQTTMessage(topic=b"sensorbox/temperature/sensorA")
+            message.payload = str(value).encode()
+            node.on_message(node.client, None, message)
+
+    # The metric rejected by a full buffer is committed with the next metric
+    # flushed
+    node = make_node("drop_newest")
+    receive(node, 1, 2, 3)
+    assert [m["fields"]["sensorA"] for m in node.buffer] == [1, 2]
+    assert len(node.wal) == 3
+    node.buffer.popleft()
+    node.commit_metrics(1)
+    assert [m["fields"]["sensorA"] for m in node.wal.replay()] == [2]
+    node.wal.close()
+
+    # The metric evicted from a full buffer is committed, and the metric taken
+    # by the consumer is committed rather than the one evicted
+    node = make_node("drop_oldest")
+    assert [m["fields"]["sensorA"] for m in node.buffer] == [2]
+    receive(node, 4)
+    taken = node.buffer.popleft()
+    receive(node, 5, 6)
+    assert [m["fields"]["sensorA"] for m in node.buffer] == [5, 6]
+    node.commit_metrics(1)
+    assert taken["fields"]["sensorA"] == 2
+    assert node.wal.replay() == list(node.buffer)
+    node.wal.close()
+
+
+def test_metrics_node_commits_drops_in_batches(broker_config, tmp_path):
+    node = MQTTMetricsNode.from_config_file(
+        config_file="tests/config-test.toml",
+        broker_config=broker_config,
+        buffer_config=MetricsBufferConfig(maxlen=1, policy="drop_newest"),
+        wal_config=MetricsWALConfig(path=str(tmp_path), fsync_batch=3),
+    )
+    for value in range(6):
+        message = MQTTMessage(topic=b"sensorbox/temperature/sensorA")
+        message.payload = str(value).encode()
+        node.on_message(node.client, None, message)
+        if value == 2:
+            # Drops are left for the next commit
+            assert len(node.wal) == 3
+    # Until fsync_batch of them have accumulated
+    assert len(node.wal) == 3
+    node.close()
+    assert MetricsWAL(node.wal.path).replay() == list(node.buffer)
+
+
+def test_nodes_keep_their_own_logs(broker_config, tmp_path):
+    nodes = MQTTMetricsNode.from_config_file_many(
+        2,
+        config_file="tests/config-test.toml",
+        name_template="wal-node-{}",
+        broker_config=broker_config,
+        buffer_config=MetricsBufferConfig(
+            maxlen=1, policy="spill", spill_path=str(tmp_path / "spill.jsonl")
+        ),
+        wal_config=MetricsWALConfig(path=str(tmp_path / "wal")),
+    )
+    assert [node.wal.path for node in nodes] == [
+        tmp_path / "wal" / "wal-node-0",
+        tmp_path / "wal" / "wal-node-1",
+    ]
+    assert [node.buffer.spill_path for node in nodes] == [
+        tmp_path / "spill" / "wal-node-0.jsonl",
+        tmp_path / "spill" / "wal-node-1.jsonl",
+    ]
+    # A log directory is only opened by one log at a time
+    with pytest.raises(MetricsWALError):
+        MetricsWAL(nodes[0].wal.path)
+    for node in nodes:
+        node.close()